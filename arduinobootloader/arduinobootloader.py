@@ -7,6 +7,10 @@ The module implements the essential parts that Avrdude uses for the
 arduino and wiring protocols. In turn, they are a subset of the
 STK500 V1 and V2 protocols respectively.
 '''
+import errno
+import functools
+import inspect
+import math
 import select
 import socket
 from os import environ
@@ -24,6 +28,12 @@ else:
     import serial.tools.list_ports
 
 import time
+from bisect import bisect_left
+from itertools import chain
+
+from bootloadercache import DetectionCache, FlashJournal, FingerprintStore, PageCache, PAGE_CACHE_PAGES
+from bootloaderstats import CommandStats, RttEstimator, SessionTrace, TIMEOUT_MAX
+from pageplanner import page_runs, pages_digest, page_digest
 
 
 RESP_STK_OK = 0x10
@@ -32,6 +42,9 @@ RESP_STK_OK = 0x10
 RESP_STK_IN_SYNC = 0x14
 """Start message of the Stk500v1"""
 
+PIPELINE_ACK = bytes([RESP_STK_IN_SYNC, RESP_STK_OK, RESP_STK_IN_SYNC, RESP_STK_OK])
+"""Answers of the load address and program page commands of a pipelined Stk500v1 page"""
+
 AVR_ATMEL_CPUS = {0x1E9608: ["ATmega640", (128*2), 1024, 8, 512],
                   0x1E9802: ["ATmega2561", (128*2), 1024, 8, 512],
                   0x1E9801: ["ATmega2560", (128*2), 1024, 8, 512],
@@ -114,14 +127,444 @@ CPU_SIG2 = 1
 CPU_SIG3 = 2
 """Cpu signature part 3"""
 
+MAX_FRAME_SIZE = 5 + 275 + 1
+"""Largest Stk500v2 frame exchanged with the bootloader: header, message buffer and checksum"""
+
+STK500V1_COMMANDS = {0x30: "STK_GET_SYNC", 0x31: "STK_GET_SIGN_ON", 0x41: "STK_GET_PARAMETER",
+                     0x51: "STK_LEAVE_PROGMODE", 0x55: "STK_LOAD_ADDRESS", 0x64: "STK_PROG_PAGE",
+                     0x74: "STK_READ_PAGE", 0x75: "STK_READ_SIGN"}
+"""Names of the Stk500v1 commands used in the statistics"""
+
+STK500V2_COMMANDS = {CMD_SIGN_ON: "CMD_SIGN_ON", CMD_GET_PARAMETER: "CMD_GET_PARAMETER",
+                     CMD_SPI_MULTI: "CMD_SPI_MULTI", CMD_LOAD_ADDRESS: "CMD_LOAD_ADDRESS",
+                     CMD_PROGRAM_FLASH_ISP: "CMD_PROGRAM_FLASH_ISP", CMD_READ_FLASH_ISP: "CMD_READ_FLASH_ISP",
+                     CMD_PROGRAM_EEPROM_ISP: "CMD_PROGRAM_EEPROM_ISP", CMD_READ_EEPROM_ISP: "CMD_READ_EEPROM_ISP",
+                     CMD_LEAVE_PROGMODE_ISP: "CMD_LEAVE_PROGMODE_ISP"}
+"""Names of the Stk500v2 commands used in the statistics"""
+
+RTT_SAMPLE_BYTES = 32
+"""Only the commands with a small answer (sync, parameters, signature, address) are measured"""
+
+FLASH_PAGE_WRITE_TIME = 0.05
+"""Margin for the bootloader to erase and program a flash page (about 9 mS)"""
+
+EEPROM_BYTE_WRITE_TIME = 0.004
+"""Time for the bootloader to program a byte of the eeprom (3.4 mS)"""
+
+NET_BAUDRATE = 57600
+"""Baud rate assumed for the serial link behind a net: server, the slowest of the bootloaders"""
+
+SYNC_ATTEMPTS = 4
+"""Attempts of the sync command when the timeouts are fixed"""
+
+HANDSHAKE_PROFILES = {
+    "default": {"reset_pulse": 0.05, "reset_delay": 0.0, "probe_interval": 0.05, "probe_count": 2,
+                "sync_window": 0.8},
+    "uno": {"reset_pulse": 0.01, "reset_delay": 0.0, "probe_interval": 0.02, "probe_count": 10,
+            "sync_window": 0.6},
+    "nano": {"reset_pulse": 0.01, "reset_delay": 0.0, "probe_interval": 0.03, "probe_count": 8,
+             "sync_window": 0.6},
+    "nano_old": {"reset_pulse": 0.05, "reset_delay": 0.0, "probe_interval": 0.05, "probe_count": 10,
+                 "sync_window": 1.5},
+    "mega": {"reset_pulse": 0.05, "reset_delay": 0.0, "probe_interval": 0.05, "probe_count": 6,
+             "sync_window": 1.0}}
+"""Reset and sync handshake of the boards, in seconds:
+
+- reset_pulse: time that DTR / RTS are asserted to reset the cpu.
+- reset_delay: wait after the release of the reset before the first probe.
+- probe_interval: timeout of each sync probe, until the round trip time is measured.
+- probe_count: probes sent at that interval, while the bootloader starts. The next ones double the timeout.
+- sync_window: time from the release of the reset to give up.
+
+Optiboot (Uno and new Nano) listens a few milliseconds after the reset, ATmegaBOOT (old Nano) blinks
+the led first, and the wiring bootloader (Mega 2560) needs the 16U2 adapter to forward the sign on."""
+
+AUTODETECT_SYNC_WINDOW = 0.25
+"""Sync window of each combination tried by autodetect"""
+
+VERIFY_STRATEGIES = ("after", "interleaved", "sampled", "none")
+"""Verification of write_pages:
+
+- after: read all the pages once they are written.
+- interleaved: read each page right after writing it, stop at the first that can't be fixed.
+- sampled: read one page of each VERIFY_SAMPLE_INTERVAL and the last one once they are written.
+- none: don't read the pages."""
+
+VERIFY_SAMPLE_INTERVAL = 8
+"""Pages written for each page read back by the sampled verification"""
+
+VERIFY_PAGE_RETRIES = 2
+"""Times that a page that doesn't match is written again"""
+
+PAGE_RETRIES = 3
+"""Times that a page operation that failed is tried again, after synchronizing the communication"""
+
+RETRY_BACKOFF = 0.01
+"""Seconds before the first retry of a page operation, doubled for each next one"""
+
+AUTODETECT_CANDIDATES = [("Stk500v1", 115200), ("Stk500v2", 115200), ("Stk500v1", 57600)]
+"""Protocol and baud rate of the bootloaders, from the most common: Optiboot (Uno and new Nano),
+wiring (Mega 2560) and ATmegaBOOT (old Nano)"""
+
+FINGERPRINT_SAMPLES = 4
+"""Pages read to check that a board still has the image of its fingerprint"""
+
+
+def xor_checksum(data):
+    """Calculate the XOR of all the bytes of the buffer.
+    Instead of iterating each byte, the buffer is converted to an integer
+    that is folded in halves until it fits in a 64 bits word.
+
+    :param data: buffer to verify.
+    :type data: bytes-like
+    :return: the checksum byte.
+    :rtype: int
+    """
+    value = int.from_bytes(data, 'little')
+    size = len(data)
+    while size > 8:
+        half = (size + 1) // 2
+        value = (value >> (half * 8)) ^ (value & ((1 << (half * 8)) - 1))
+        size = half
+
+    value ^= value >> 32
+    value ^= value >> 16
+    value ^= value >> 8
+    return value & 0xFF
+
+
+class FrameCodec(object):
+    """Encode the commands and decode the answers of the Stk500v2 protocol.
+    The commands are built in a preallocated buffer, and the answers are
+    returned as views of the received data, so no bytes are copied or shifted."""
+    def __init__(self, size=MAX_FRAME_SIZE):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    def encode(self, sequence, cmd, data=None):
+        """Build the frame of a command: a fixed header of 5 bytes, the command, the data and the checksum.
+
+        :param sequence: sequence number of the command.
+        :type sequence: int
+        :param cmd: supported command.
+        :type cmd: int
+        :param data: if it is not None, it is added after the command.
+        :type data: bytes-like
+        :return: the frame, valid until the next call.
+        :rtype: memoryview
+        """
+        data_len = 1 if data is None else len(data) + 1
+        frame_len = 5 + data_len + 1
+        if frame_len > len(self._buffer):
+            self._buffer = bytearray(frame_len)
+            self._view = memoryview(self._buffer)
+
+        buff = self._buffer
+        buff[0] = MESSAGE_START
+        buff[1] = sequence
+        buff[2] = ((data_len >> 8) & 0xFF)
+        buff[3] = (data_len & 0xFF)
+        buff[4] = TOKEN
+        buff[5] = cmd
+        if data_len > 1:
+            self._view[6:5 + data_len] = data
+
+        buff[frame_len - 1] = xor_checksum(self._view[:frame_len - 1])
+        return self._view[:frame_len]
+
+    @staticmethod
+    def decode(head, body):
+        """Validate the checksum of an answer.
+
+        :param head: header without the MESSAGE_START byte (sequence, length and token).
+        :type head: bytes-like
+        :param body: command, status, data and checksum.
+        :type body: bytes-like
+        :return: the view of the data without command, status and checksum, or None when the checksum fails.
+        :rtype: memoryview
+        """
+        """The checksum of the whole frame including its checksum byte is zero."""
+        if MESSAGE_START ^ xor_checksum(head) ^ xor_checksum(body):
+            return None
+        return memoryview(body)[2:-1]
+
+
+class FrameReader(object):
+    """Receive buffer of the Stk500v2 answers.
+    Reads from the device all the bytes that the frame needs in a single call,
+    and looks in the buffer for the header of the expected answer, discarding
+    the bytes that don't belong to it. The received bytes are copied once to a
+    preallocated buffer, and the frames are returned as views of it. The length
+    of a header is not trusted when the frame would be longer than MAX_FRAME_SIZE.
+
+    :param size: initial size of the buffer.
+    :type size: int
+    """
+    def __init__(self, size=2 * MAX_FRAME_SIZE):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._bytes_discarded = 0
+        self._frames_received = 0
+
+    @property
+    def bytes_discarded(self):
+        """Bytes discarded while looking for the header of a frame.
+
+        :type: int
+        """
+        return self._bytes_discarded
+
+    @property
+    def frames_received(self):
+        """Complete frames delivered to the protocol.
+
+        :type: int
+        """
+        return self._frames_received
+
+    def clear(self):
+        """Discard the pending bytes of the buffer."""
+        self._bytes_discarded += self._end - self._start
+        self._start = self._end = 0
+
+    def feed(self, data):
+        """Add the received bytes to the buffer. The frames returned before are no longer valid.
+
+        :param data: received bytes.
+        :type data: bytes-like
+        """
+        end = self._end
+        size = len(data)
+        if end + size > len(self._buffer):
+            pending = end - self._start
+            if pending + size > len(self._buffer):
+                """A new buffer, because the views of the previous frames don't allow to resize it."""
+                buffer = bytearray(max(2 * len(self._buffer), pending + size))
+                buffer[:pending] = self._view[self._start:end]
+                self._buffer = buffer
+                self._view = memoryview(buffer)
+            else:
+                self._view[:pending] = self._view[self._start:end]
+            self._start = 0
+            end = pending
+
+        self._view[end:end + size] = data
+        self._end = end + size
+
+    def missing(self):
+        """Bytes needed to complete the frame at the start of the buffer.
+
+        :return: the count of bytes, at least one.
+        :rtype: int
+        """
+        buff = self._buffer
+        start = self._start
+        pending = self._end - start
+        if pending < 5:
+            """The minimum frame has the header, the command, the status and the checksum."""
+            return 8 - pending
+
+        frame_len = 5 + ((buff[start + 2] << 8) | buff[start + 3]) + 1
+        if buff[start] != MESSAGE_START or buff[start + 4] != TOKEN or frame_len > MAX_FRAME_SIZE:
+            return 1
+
+        return max(frame_len - pending, 1)
+
+    def next_frame(self, sequence):
+        """Extract from the buffer the first complete frame with the sequence number.
+
+        :param sequence: sequence number of the command.
+        :type sequence: int
+        :return: the header without MESSAGE_START and the body with the checksum, as views of the buffer
+                 that are valid until the next feed, or None when there is no frame.
+        :rtype: tuple
+        """
+        buff = self._buffer
+        end = self._end
+        start = self._start
+        while True:
+            found = buff.find(MESSAGE_START, start, end)
+            if found < 0:
+                found = end
+            self._bytes_discarded += found - start
+            start = self._start = found
+
+            if end - start < 5:
+                return None
+
+            """The header is valid, when the trailing byte sequence number and token match,
+            and the length fits in the message buffer of the bootloader."""
+            frame_len = 5 + ((buff[start + 2] << 8) | buff[start + 3]) + 1
+            if buff[start + 1] != sequence or buff[start + 4] != TOKEN or frame_len > MAX_FRAME_SIZE:
+                self._bytes_discarded += 1
+                start += 1
+                continue
+
+            if end - start < frame_len:
+                return None
+
+            if start + frame_len == end:
+                self._start = self._end = 0
+            else:
+                self._start = start + frame_len
+            self._frames_received += 1
+            view = self._view
+            return view[start + 1:start + 5], view[start + 5:start + frame_len]
+
+    def read_frame(self, sequence):
+        """Read from the device until a complete frame is received, yielding the
+        read requests of the port (see ArduinoBootloader._run).
+
+        :param sequence: sequence number of the command.
+        :type sequence: int
+        :return: the header and the body, or None when timeout.
+        :rtype: tuple
+        """
+        while True:
+            frame = self.next_frame(sequence)
+            if frame is not None:
+                return frame
+
+            data = yield ("read", self.missing())
+            if not data:
+                return None
+            self.feed(data)
+
+
+def traced(*arg_names):
+    """Decorator that records a span with the duration and the result of a method,
+    when the trace of the ArduinoBootloader is enabled. Supports the generators of the operations.
+
+    :param arg_names: arguments of the method added to the span, for example the address.
+    :return: the decorator.
+    """
+    def decorator(method):
+        name = ".".join(method.__qualname__.split(".")[-2:])
+        signature = inspect.signature(method)
+
+        def span_args(args, kwargs):
+            if not arg_names:
+                return {}
+            bound = signature.bind(*args, **kwargs).arguments
+            return {arg: bound[arg] if isinstance(bound[arg], (bool, int, float, str, type(None))) else str(bound[arg])
+                    for arg in arg_names if arg in bound}
+
+        if inspect.isgeneratorfunction(method):
+            @functools.wraps(method)
+            def wrapper(self, *args, **kwargs):
+                trace = getattr(self, "_ab", self)._trace
+                if trace is None:
+                    return (yield from method(self, *args, **kwargs))
+
+                with trace.span(name, span_args((self,) + args, kwargs)) as span:
+                    result = yield from method(self, *args, **kwargs)
+                    span["result"] = result is not None and result is not False
+                    return result
+        else:
+            @functools.wraps(method)
+            def wrapper(self, *args, **kwargs):
+                trace = getattr(self, "_ab", self)._trace
+                if trace is None:
+                    return method(self, *args, **kwargs)
+
+                with trace.span(name, span_args((self,) + args, kwargs)) as span:
+                    result = method(self, *args, **kwargs)
+                    span["result"] = result is not None and result is not False
+                    return result
+
+        return wrapper
+
+    return decorator
+
+
+def retried(method):
+    """Decorator of the page operations of the programmers, that returns False or None
+    on error. After an error the link is drained, the communication is synchronized
+    again with get_sync, and the operation is repeated up to the page retries of the
+    ArduinoBootloader, waiting RETRY_BACKOFF seconds doubled each time.
+
+    :param method: generator method of a programmer class.
+    :return: the wrapper.
+    """
+    name = method.__name__.lstrip("_")
+
+    def failed(result):
+        return result is None or result is False
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        result = yield from method(self, *args, **kwargs)
+        retrying = self._ab._retrying
+        try:
+            for attempt in range(1, self._ab.page_retries + 1):
+                if not failed(result) or not self._ab.device:
+                    break
+                """As in TCP, the answers of a repeated operation could belong to the commands that
+                timed out, so their round trip time is not measured."""
+                self._ab._retrying = True
+                yield ("sleep", self._ab._before_retry(name, attempt))
+                yield ("reset_input_buffer",)
+                if (yield from self.get_sync.steps()):
+                    result = yield from method(self, *args, **kwargs)
+        finally:
+            self._ab._retrying = retrying
+        return result
+
+    return wrapper
+
+
+class operation(object):
+    """Decorator of the methods that communicate with the board. The method is a generator
+    that yields the input / output requests of the port, for example ("read", size), and
+    receives their results, so the protocols don't depend on how the port is accessed.
+    Calling the method runs the requests with the _run of the ArduinoBootloader, that blocks,
+    or with the one of the AsyncArduinoBootloader, that returns a coroutine. Inside another
+    operation, the generator of steps is run with yield from.
+
+    :param method: generator method of the ArduinoBootloader or of a programmer class.
+    """
+    def __init__(self, method):
+        functools.update_wrapper(self, method)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return BoundOperation(self.__wrapped__, instance)
+
+
+class BoundOperation(object):
+    """Operation of an instance, see operation."""
+    __slots__ = ("_method", "_instance")
+
+    def __init__(self, method, instance):
+        self._method = method
+        self._instance = instance
+
+    def __call__(self, *args, **kwargs):
+        return getattr(self._instance, "_ab", self._instance)._run(self._method(self._instance, *args, **kwargs))
+
+    def steps(self, *args, **kwargs):
+        """Generator of the requests of the operation, to run it inside another one.
+
+        :return: the generator, whose return value is the result of the operation.
+        :rtype: generator
+        """
+        return self._method(self._instance, *args, **kwargs)
+
 
 class SocketWrapper(object):
+    """TCP connection with the interface of a serial port, for boards
+    connected through a network serial server (for example ser2net)."""
     def __init__(self, host, port):
         self._host = host
         self._port = port
         self._socket = None
         self._connected = False
         self._timeout = 1
+        self._buffer = bytearray(MAX_FRAME_SIZE)
+        self._view = memoryview(self._buffer)
         self.connect()
 
     def __del__(self):
@@ -129,8 +572,9 @@ class SocketWrapper(object):
             self._socket.close()
 
     def connect(self):
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.connect((self._host, self._port))
+        self._socket = socket.create_connection((self._host, self._port))
+        """The commands are small, don't wait to group them with the following data."""
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self._socket.settimeout(0)
         self._connected = True
 
@@ -147,22 +591,37 @@ class SocketWrapper(object):
         return self._connected
 
     def read(self, size):
-        init_time = time.time()
-        elapsed = time.time() - init_time
-        data = b''
-        while len(data) < size and elapsed <= self.timeout:
-            select_timeout = self.timeout - elapsed
-            if select_timeout < 0:
-                select_timeout = 0
-            rin, _, _ = select.select([self._socket], [], [], select_timeout)
-            if self._socket in rin:
-                d = self._socket.recv(size-len(data))
-                if d:
-                    data += d
-                else:
+        """Read up to size bytes, waiting until the timeout expires.
+
+        :param size: bytes to read.
+        :type size: int
+        :return: the received bytes, less than size when timeout.
+        :rtype: bytes
+        """
+        if size > len(self._buffer):
+            self._buffer = bytearray(size)
+            self._view = memoryview(self._buffer)
+
+        deadline = time.monotonic() + self._timeout
+        received = 0
+        while received < size:
+            try:
+                count = self._socket.recv_into(self._view[received:size])
+            except BlockingIOError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                rin, _, _ = select.select([self._socket], [], [], remaining)
+                if not rin:
                     break
-            elapsed = time.time() - init_time
-        return data
+                continue
+
+            if not count:
+                """The connection was closed by the server."""
+                break
+            received += count
+
+        return bytes(self._view[:received])
 
     def write(self, buffer):
         return self._socket.sendall(buffer)
@@ -172,11 +631,13 @@ class SocketWrapper(object):
         self._connected = False
 
     def reset_input_buffer(self):
-        if self._socket:
-            self._socket.close()
-            del self._socket
-        self._connected = False
-        self.connect()
+        """Discard the received bytes that were not read."""
+        while True:
+            try:
+                if not self._socket.recv_into(self._view):
+                    break
+            except BlockingIOError:
+                break
 
 
 class ArduinoBootloader(object):
@@ -186,16 +647,41 @@ class ArduinoBootloader(object):
     def __init__(self, *args, **kwargs):
         self.device = None
         self.port = None
+        self.speed = None
         self._hw_version = 0
         self._sw_major = 0
         self._sw_minor = 0
         self._cpu_name = ""
+        self._signature = 0
         self._cpu_page_size = 0
         self._cpu_pages = 0
         self._eeprom_page_size = 0
         self._eeprom_pages = 0
         self._programmer_name = ""
         self._programmer = None
+        self._pages_written = 0
+        self._pages_skipped = 0
+        self._pages_resumed = 0
+        self._pages_verified = 0
+        self._pages_rewritten = 0
+        self._verify_time = 0.0
+        self._mismatch_address = None
+        self._up_to_date = False
+        self._stats = None
+        self._trace = None
+        self._recording = False
+        self._retrying = False
+        self._rtt = None
+        self._byte_time = 10 / 115200
+        self._timeout = None
+        self._profile = dict(HANDSHAKE_PROFILES["default"])
+        self._sync_window = None
+        self._sync_start = None
+        self._time_to_sync = None
+        self._page_cache = None
+        self._page_retries = 0
+        self._journal = None
+        self._fingerprints = None
 
     @property
     def hw_version(self):
@@ -270,6 +756,417 @@ class ArduinoBootloader(object):
         """
         return self._programmer_name
 
+    @property
+    def pages_written(self):
+        """Pages sent to the bootloader by the last call to write_pages.
+
+        :setter: pages
+        :type: int
+        """
+        return self._pages_written
+
+    @property
+    def pages_skipped(self):
+        """Pages that the last call to write_pages in delta mode found
+        already programmed with the same content, and therefore were not sent.
+
+        :setter: pages
+        :type: int
+        """
+        return self._pages_skipped
+
+    @property
+    def pages_resumed(self):
+        """Pages that the last call to write_pages found confirmed by the journal of
+        an interrupted write, and with the same content, and therefore were not sent.
+
+        :setter: pages
+        :type: int
+        """
+        return self._pages_resumed
+
+    @property
+    def up_to_date(self):
+        """True when the last call to write_pages found that the board already has the image
+        of its fingerprint, and therefore no page was sent.
+
+        :type: bool
+        """
+        return self._up_to_date
+
+    @property
+    def pages_verified(self):
+        """Pages read back and compared by the last write_pages or verify_pages.
+
+        :setter: pages
+        :type: int
+        """
+        return self._pages_verified
+
+    @property
+    def pages_rewritten(self):
+        """Pages written again because they didn't match, by the last write_pages.
+
+        :setter: pages
+        :type: int
+        """
+        return self._pages_rewritten
+
+    @property
+    def verify_time(self):
+        """Seconds that the last write_pages or verify_pages spent reading back and
+        writing again the pages, the cost of the verification strategy.
+
+        :setter: seconds
+        :type: float
+        """
+        return self._verify_time
+
+    @property
+    def mismatch_address(self):
+        """Address of the page that didn't match in the last verification, None when all matched.
+
+        :setter: address
+        :type: int
+        """
+        return self._mismatch_address
+
+    @property
+    def stats(self):
+        """Statistics of the commands, None when they are disabled.
+
+        :type: CommandStats
+        """
+        return self._stats
+
+    def enable_stats(self, enable=True):
+        """Start or stop recording the statistics of the commands.
+        When they are disabled, the cost for each command is a comparison.
+
+        :param enable: False to disable them.
+        :type enable: bool
+        :return: the new statistics, or None.
+        :rtype: CommandStats
+        """
+        self._stats = CommandStats() if enable else None
+        self._recording = self._stats is not None or self._trace is not None
+        return self._stats
+
+    @property
+    def trace(self):
+        """Timeline of the session, None when it is disabled.
+
+        :type: SessionTrace
+        """
+        return self._trace
+
+    def enable_trace(self, trace=None, enable=True):
+        """Start or stop recording the spans of the operations and the commands.
+
+        :param trace: trace where the events are added, it can be shared by several boards.
+                      None to create a new one.
+        :type trace: SessionTrace
+        :param enable: False to disable it.
+        :type enable: bool
+        :return: the trace, or None.
+        :rtype: SessionTrace
+        """
+        self._trace = (trace or SessionTrace()) if enable else None
+        self._recording = self._stats is not None or self._trace is not None
+        return self._trace
+
+    @property
+    def rtt(self):
+        """Round trip time estimator used to calculate the timeout of each command,
+        None when the timeouts are fixed.
+
+        :type: RttEstimator
+        """
+        return self._rtt
+
+    def enable_adaptive_timeout(self, enable=True):
+        """Calculate the timeout of each command with the measured round trip time,
+        the size of the command and its answer, and the baud rate. It is disabled by default,
+        and the timeouts are fixed (1 second and 0.5 seconds for the sync command).
+
+        :param enable: False to disable it.
+        :type enable: bool
+        :return: the estimator, or None.
+        :rtype: RttEstimator
+        """
+        self._rtt = RttEstimator(self._profile["probe_interval"]) if enable else None
+        return self._rtt
+
+    @property
+    def page_retries(self):
+        """Times that a page operation that failed is tried again, 0 when it is disabled.
+
+        :type: int
+        """
+        return self._page_retries
+
+    def enable_page_retry(self, enable=True, retries=PAGE_RETRIES):
+        """Recover from the errors of the communication page by page: when the write or
+        the read of a page fails, for example by a byte lost in a noisy USB hub, the link
+        is drained, the communication is synchronized again and only that page is repeated.
+        The retries and the resyncs are counted in the statistics. It is disabled by default,
+        and the operations give up at the first error.
+
+        :param enable: False to give up at the first error.
+        :type enable: bool
+        :param retries: times that each page operation is tried again.
+        :type retries: int
+        """
+        self._page_retries = retries if enable else 0
+
+    @property
+    def journal(self):
+        """Journal of the pages confirmed by the board, None when it is disabled.
+
+        :type: FlashJournal
+        """
+        return self._journal
+
+    def enable_journal(self, journal=None, enable=True):
+        """Keep the pages confirmed by write_pages in a journal by board and image, so that
+        a write that is interrupted continues with the same image from the pages that were
+        not confirmed. The confirmed pages are read and compared, which is faster than
+        writing them, and the entry of the board is removed when the write completes.
+        The board is identified by its USB adapter (see port_key) and the cpu signature.
+
+        :param journal: journal where the pages are saved, it can be shared by several boards.
+                        None to use the default file.
+        :type journal: FlashJournal
+        :param enable: False to disable it.
+        :type enable: bool
+        :return: the journal, or None.
+        :rtype: FlashJournal
+        """
+        self._journal = (journal or FlashJournal()) if enable else None
+        return self._journal
+
+    @property
+    def fingerprints(self):
+        """Store of the images written in each board, None when it is disabled.
+
+        :type: FingerprintStore
+        """
+        return self._fingerprints
+
+    def enable_fingerprints(self, store=None, enable=True):
+        """Save the fingerprint of the image written by write_pages for each board, so that
+        writing the same image again only reads FINGERPRINT_SAMPLES pages to know that the
+        board is up to date. The board is identified by its USB adapter (see port_key) and
+        the cpu signature.
+
+        :param store: store where the fingerprints are saved, it can be shared by several boards.
+                      None to use the default file.
+        :type store: FingerprintStore
+        :param enable: False to disable it.
+        :type enable: bool
+        :return: the store, or None.
+        :rtype: FingerprintStore
+        """
+        self._fingerprints = (store or FingerprintStore()) if enable else None
+        return self._fingerprints
+
+    @property
+    def page_cache(self):
+        """Cache of the pages read and written, None when it is disabled.
+
+        :type: PageCache
+        """
+        return self._page_cache
+
+    def enable_page_cache(self, enable=True, max_pages=PAGE_CACHE_PAGES):
+        """Serve the reads of the pages already read or written in the session from memory.
+        The cache is cleared when the port is opened and after a communication error.
+
+        :param enable: False to disable it.
+        :type enable: bool
+        :param max_pages: pages kept.
+        :type max_pages: int
+        :return: the cache, or None.
+        :rtype: PageCache
+        """
+        self._page_cache = PageCache(max_pages) if enable else None
+        return self._page_cache
+
+    def _cache_read(self, address, count, flash):
+        page_size = self._cpu_page_size if flash else self._eeprom_page_size
+        if self._page_cache is None or not page_size:
+            return None
+        return self._page_cache.read(address, count, page_size, flash)
+
+    def _cache_fill(self, start, buffer, flash, cache=True):
+        """Copy the cached pages to the buffer of a read.
+
+        :return: list of (address, count) tuples of the parts to read from the board.
+        :rtype: list
+        """
+        page_size = self._cpu_page_size if flash else self._eeprom_page_size
+        if not cache or self._page_cache is None or not page_size:
+            return [(start, len(buffer))]
+        return self._page_cache.fill(start, buffer, page_size, flash)
+
+    def _cache_update(self, address, buffer, flash):
+        page_size = self._cpu_page_size if flash else self._eeprom_page_size
+        if self._page_cache is not None and page_size:
+            self._page_cache.update(address, buffer, page_size, flash)
+
+    def _cache_invalidate(self):
+        if self._page_cache is not None:
+            self._page_cache.invalidate()
+
+    @property
+    def profile(self):
+        """Parameters of the reset and sync handshake (see HANDSHAKE_PROFILES).
+
+        :type: dict
+        """
+        return dict(self._profile)
+
+    def select_profile(self, profile):
+        """Select the reset and sync handshake of the board.
+
+        :param profile: name of a profile of HANDSHAKE_PROFILES, or a dictionary with the parameters
+                        to change of the default profile.
+        :type profile: str
+        :return: the parameters, None for an unknown profile.
+        :rtype: dict
+        """
+        if isinstance(profile, dict):
+            if not set(profile) <= set(HANDSHAKE_PROFILES["default"]):
+                return None
+            self._profile = dict(HANDSHAKE_PROFILES["default"], **profile)
+        elif profile in HANDSHAKE_PROFILES:
+            self._profile = dict(HANDSHAKE_PROFILES[profile])
+        else:
+            return None
+
+        if self._rtt is not None:
+            self._rtt.reset(self._profile["probe_interval"])
+        return self.profile
+
+    @property
+    def time_to_sync(self):
+        """Seconds from the release of the reset (or the open when the board was not reset)
+        to the answer of the sync command, None until the board is synced.
+
+        :type: float
+        """
+        return self._time_to_sync
+
+    def _sync_probes(self):
+        """Generate the attempt of each sync probe while the sync window is open.
+        The first probe_count probes use the probe interval, then each one doubles it.
+
+        :return: iterator of the attempts, for _set_timeout.
+        :rtype: iterator
+        """
+        start = time.perf_counter() if self._sync_start is None else self._sync_start
+        deadline = start + (self._sync_window or self._profile["sync_window"])
+        probe = 0
+        while True:
+            yield max(probe + 1 - self._profile["probe_count"], 0)
+            probe += 1
+            if time.perf_counter() >= deadline:
+                return
+
+    def _synced(self):
+        """Measure the time to sync after the open of the port."""
+        if self._sync_start is None:
+            return
+
+        self._time_to_sync = time.perf_counter() - self._sync_start
+        self._sync_start = None
+        if self._trace is not None:
+            self._trace.instant("synced", {"time_to_sync": self._time_to_sync})
+
+    def _set_timeout(self, bytes_count, busy=0.0, attempt=0, round_trips=1):
+        """Set the read timeout of the port for the next command.
+
+        :param bytes_count: bytes of the command and its answer.
+        :type bytes_count: int
+        :param busy: seconds that the bootloader needs to execute the command, for example to write a page.
+        :type busy: float
+        :param attempt: retries of the command, each one doubles the round trip timeout.
+        :type attempt: int
+        :param round_trips: commands sent together whose answers are read at once.
+        :type round_trips: int
+        """
+        if self._rtt is None:
+            return
+
+        timeout = min(self._rtt.timeout * round_trips * (1 << min(attempt, 16)), TIMEOUT_MAX) + \
+            bytes_count * self._byte_time + busy
+        """Rounded to 10 mS, because pyserial reconfigures the port each time that it changes."""
+        timeout = math.ceil(timeout * 100) / 100
+        if timeout != self._timeout:
+            self.device.timeout = timeout
+            self._timeout = timeout
+
+    def _learn_rtt(self, start, bytes_count):
+        """Measure the round trip time of a command answered in time, except while an operation is repeated.
+
+        :param start: time when the command was sent (time.perf_counter).
+        :type start: float
+        :param bytes_count: bytes of the command and its answer.
+        :type bytes_count: int
+        """
+        if self._rtt is not None and not self._retrying and bytes_count <= RTT_SAMPLE_BYTES:
+            self._rtt.update(max(time.perf_counter() - start - bytes_count * self._byte_time, 0.0))
+
+    def _record_command(self, command, start, bytes_tx, bytes_rx, timeout=False, error=False, discarded=0):
+        """Add a command and its answer to the statistics and the trace.
+
+        :param command: name of the command.
+        :type command: str
+        :param start: time when the command was sent (time.perf_counter).
+        :type start: float
+        """
+        seconds = time.perf_counter() - start
+        if self._stats is not None:
+            self._stats.record(command, seconds, bytes_tx, bytes_rx, timeout, error, discarded)
+        if self._trace is not None:
+            self._trace.complete(command, start, seconds, "command",
+                                 {"bytes_tx": bytes_tx, "bytes_rx": bytes_rx, "timeout": timeout,
+                                  "error": error, "discarded": discarded})
+
+    def _record_retry(self, command):
+        if self._stats is not None:
+            self._stats.retry(command)
+        if self._trace is not None:
+            self._trace.instant("retry", {"command": command})
+
+    def _record_resync(self):
+        if self._stats is not None:
+            self._stats.resync()
+        if self._trace is not None:
+            self._trace.instant("resync")
+
+    def _before_retry(self, operation, attempt):
+        """Count the retry of a page operation, forget the state that the error made unreliable,
+        and double the round trip timeout until the next measure, in case the board became slower.
+
+        :param operation: name of the operation.
+        :type operation: str
+        :param attempt: number of the retry, from 1.
+        :type attempt: int
+        :return: seconds to wait before synchronizing again, at least the round trip timeout
+            so that the late answer of the failed command is drained.
+        :rtype: float
+        """
+        self._cache_invalidate()
+        wait = min(RETRY_BACKOFF * (1 << (attempt - 1)), TIMEOUT_MAX)
+        if self._rtt is not None:
+            self._rtt.back_off()
+            wait = max(wait, self._rtt.timeout)
+        if self._recording:
+            self._record_retry(operation)
+            self._record_resync()
+        return wait
+
     def select_programmer(self, protocol):
         """Select the communication protocol to connect with the Arduino bootloader.
 
@@ -287,6 +1184,493 @@ class ArduinoBootloader(object):
 
         return self._programmer
 
+    @operation
+    @traced("delta", "verify", "force")
+    def write_pages(self, pages, flash=True, delta=False, progress=None, verify="none", force=False, manifest=None):
+        """Write a sequence of pages with the selected programmer.
+        In delta mode each page is read first, and it is only written when the
+        content of the memory differs from the new one, so that updating a board
+        that already has most of the firmware takes a fraction of the time.
+        The written pages are read back with the verification strategy (see VERIFY_STRATEGIES),
+        and a page that doesn't match is written again up to VERIFY_PAGE_RETRIES times.
+        With the journal enabled, the pages confirmed by an interrupted write of the same
+        image are only read and compared. With the fingerprints enabled, a board that already
+        has the image is detected reading a few pages, and nothing is written (see up_to_date),
+        but the pages are still verified with the strategy, and written when they don't match.
+        The digests of the manifest of the image avoid hashing the pages, and the pages are not
+        used when the board is up to date, so they can be read from the file only then.
+
+        :param pages: iterable of (address, buffer) tuples, one per memory page.
+        :type pages: iterable
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :param delta: read and compare each page before writing it.
+        :type delta: bool
+        :param progress: optional function called with the address of each processed page.
+        :type progress: callable
+        :param verify: after, interleaved, sampled or none.
+        :type verify: str
+        :param force: write the image even when the fingerprint of the board matches.
+        :type force: bool
+        :param manifest: manifest of the pages for the page size of the memory, None to hash them.
+        :type manifest: PageManifest
+        :return: True when all pages are written or skipped, and the verified ones match.
+        :rtype: bool
+        """
+        self._pages_written = 0
+        self._pages_skipped = 0
+        self._pages_resumed = 0
+        self._up_to_date = False
+        self._reset_verify()
+
+        if self._programmer is None or verify not in VERIFY_STRATEGIES:
+            return False
+
+        key = self._board_key(flash)
+        if key is None or (self._fingerprints is None and self._journal is None):
+            return (yield from self._write_pages(pages, flash, delta, progress, verify))
+
+        if manifest is None:
+            pages = list(pages)
+        image, digests, page_size = self._image_digests(pages, manifest)
+        if self._fingerprints is not None:
+            samples = None if force else self._fingerprint_samples(key, image, digests, page_size)
+            if samples and (yield from self._samples_match(samples, flash)) and \
+                    (yield from self._verify_digests(digests, page_size, flash, verify)):
+                self._set_up_to_date(digests, progress)
+                return True
+            self._fingerprints.remove(key)
+            self._reset_verify()
+
+        result = yield from self._write_journal(key, image, list(pages), flash, delta, progress, verify)
+        if result and self._fingerprints is not None:
+            self._fingerprints.put(key, image, digests)
+        return result
+
+    def _write_journal(self, key, image, pages, flash, delta, progress, verify):
+        """Write the pages keeping them in the journal when it is enabled, see write_pages."""
+        if self._journal is None:
+            return (yield from self._write_pages(pages, flash, delta, progress, verify))
+
+        resumed, pages = self._journal_split(key, image, pages)
+        result = False
+        try:
+            for start, length, run in page_runs(resumed):
+                read_buffer = yield from self._programmer.read_range.steps(start, length, flash)
+                pages += self._resumed_pages(start, run, read_buffer, progress)
+
+            pages.sort(key=lambda page: page[0])
+            result = yield from self._write_pages(pages, flash, delta, self._journal_progress(key, pages, progress),
+                                                  verify)
+        finally:
+            """Also with an exception, for example of the port, the confirmed pages are saved to resume the write."""
+            self._journal.finish(key, result)
+        return result
+
+    def _write_pages(self, pages, flash, delta, progress, verify):
+        """Write the pages with the verification strategy, see write_pages."""
+        if delta:
+            """The comparison is done before writing, because the programmer can have
+            several pages in flight and the reads can't be mixed with its answers."""
+            changed = []
+            for address, buffer in pages:
+                read_buffer = yield from self._programmer.read_memory.steps(address, len(buffer), flash)
+                if read_buffer is not None and read_buffer == buffer:
+                    self._pages_skipped += 1
+                    if progress:
+                        progress(address)
+                else:
+                    changed.append((address, buffer))
+            pages = changed
+
+        if verify == "interleaved":
+            """Each page is written and read in lock step, so the first page that
+            can't be fixed stops the write."""
+            for address, buffer in pages:
+                if not (yield from self._programmer.write_memory.steps(buffer, address, flash)):
+                    return False
+                self._pages_written += 1
+                if not (yield from self._verify_page(address, buffer, flash)):
+                    return False
+                if progress:
+                    progress(address)
+            return True
+
+        def page_written(address):
+            self._pages_written += 1
+            if progress:
+                progress(address)
+
+        if verify == "none":
+            return (yield from self._programmer.write_pages.steps(pages, flash, progress=page_written))
+
+        pages = list(pages)
+        if not (yield from self._programmer.write_pages.steps(pages, flash, progress=page_written)):
+            return False
+
+        if verify == "sampled":
+            pages = pages[VERIFY_SAMPLE_INTERVAL - 1:-1:VERIFY_SAMPLE_INTERVAL] + pages[-1:]
+        return (yield from self._verify_runs(pages, flash, None, rewrite=True))
+
+    @operation
+    @traced()
+    def verify_pages(self, pages, flash=True, progress=None):
+        """Read a sequence of pages and compare them with the given content.
+        The consecutive pages are read with a single read_range, without the page cache.
+        When they don't match, the fingerprint of the board is removed.
+
+        :param pages: iterable of (address, buffer) tuples ordered by address.
+        :type pages: iterable
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :param progress: optional function called with the address following each read block.
+        :type progress: callable
+        :return: True when the memory has the content of all the pages.
+        :rtype: bool
+        """
+        self._reset_verify()
+        if self._programmer is None:
+            return False
+
+        result = yield from self._verify_runs(pages, flash, progress, rewrite=False)
+        if not result:
+            self._forget_fingerprint(flash)
+        return result
+
+    @operation
+    @traced()
+    def verify_manifest(self, manifest, flash=True, progress=None):
+        """Read the pages of a manifest and compare them with their digests, without the image.
+        The consecutive pages are read with a single read_range, without the page cache.
+        When they don't match, the fingerprint of the board is removed.
+
+        :param manifest: manifest of the image for the page size of the memory (see load_manifest).
+        :type manifest: PageManifest
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :param progress: optional function called with the address following each read block.
+        :type progress: callable
+        :return: True when the memory has the image of the manifest.
+        :rtype: bool
+        """
+        self._reset_verify()
+        if self._programmer is None or manifest.page_size != self._memory_page_size(flash):
+            return False
+
+        start_time = time.perf_counter()
+        try:
+            for start, length, run in manifest.runs():
+                read_buffer = yield from self._programmer.read_range.steps(start, length, flash, progress, cache=False)
+                if read_buffer is None:
+                    return False
+
+                self._pages_verified += len(run)
+                for address, digest in self._changed_digests(start, run, read_buffer, manifest.page_size):
+                    if not (yield from self._digest_again(address, digest, manifest.page_size, flash)):
+                        self._mismatch_address = address
+                        self._forget_fingerprint(flash)
+                        return False
+            return True
+        finally:
+            self._verify_time += time.perf_counter() - start_time
+
+    @operation
+    @traced()
+    def changed_pages(self, manifest, flash=True, progress=None):
+        """Compare the memory with the digests of a manifest, to know the pages that a delta
+        write has to send without the image.
+
+        :param manifest: manifest of the image for the page size of the memory (see load_manifest).
+        :type manifest: PageManifest
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :param progress: optional function called with the address following each read block.
+        :type progress: callable
+        :return: list of the addresses of the pages that differ, None when there is error.
+        :rtype: list
+        """
+        if self._programmer is None or manifest.page_size != self._memory_page_size(flash):
+            return None
+
+        changed = []
+        for start, length, run in manifest.runs():
+            read_buffer = yield from self._programmer.read_range.steps(start, length, flash, progress)
+            if read_buffer is None:
+                return None
+            changed += [address for address, digest in self._changed_digests(start, run, read_buffer,
+                                                                             manifest.page_size)]
+        return changed
+
+    def _memory_page_size(self, flash):
+        return self._cpu_page_size if flash else self._eeprom_page_size
+
+    @staticmethod
+    def _changed_digests(start, run, read_buffer, page_size):
+        """Compare the pages of a run with their digests.
+
+        :return: list of the (address, digest) tuples of the pages that don't match.
+        :rtype: list
+        """
+        return [(address, digest) for address, digest in run
+                if page_digest(address, read_buffer[address - start:address - start + page_size]) != digest]
+
+    def _digest_again(self, address, digest, page_size, flash):
+        """Read again a page that doesn't match its digest, up to the page retries, see _read_again.
+
+        :return: True when the page matches.
+        :rtype: bool
+        """
+        for _ in range(self._page_retries):
+            if self._recording:
+                self._record_retry("verify_page")
+            self._pages_verified += 1
+            if self._sample_matches(address, digest,
+                                    (yield from self._programmer.read_memory.steps(address, page_size, flash,
+                                                                                   cache=False))):
+                return True
+        return False
+
+    def _board_key(self, flash):
+        """Identify the board and the memory in the journal and the fingerprints.
+
+        :return: the key, or None when the port is not an adapter.
+        :rtype: str
+        """
+        board = self.port_key(self.port)
+        if board is None:
+            return None
+        return "{}/{:06X}/{}".format(board, self._signature, "flash" if flash else "eeprom")
+
+    @staticmethod
+    def _image_digests(pages, manifest):
+        """Get the digests of the image and its pages from the manifest, or hashing the pages.
+
+        :param pages: list of (address, buffer) tuples, it is only used without manifest.
+        :type pages: list
+        :return: the digest of the image, the list of (address, digest) tuples of the pages and the page size.
+        :rtype: tuple
+        """
+        if manifest is not None:
+            return manifest.image, manifest.pages(), manifest.page_size
+
+        return (pages_digest(pages), [(address, page_digest(address, buffer)) for address, buffer in pages],
+                len(pages[0][1]) if pages else 0)
+
+    def _fingerprint_samples(self, key, image, digests, page_size):
+        """Select the pages read to check that the board has the image of its fingerprint,
+        spread over the image from the first page to the last one.
+
+        :return: list of (address, length, digest) tuples, None when the fingerprint is of another image.
+        :rtype: list
+        """
+        fingerprint = self._fingerprints.get(key)
+        if fingerprint is None or fingerprint[0] != image or not digests:
+            return None
+
+        count = min(FINGERPRINT_SAMPLES, len(digests))
+        samples = []
+        for index in sorted({i * (len(digests) - 1) // max(count - 1, 1) for i in range(count)}):
+            address, digest = digests[index]
+            if fingerprint[1].get(address) != digest:
+                return None
+            samples.append((address, page_size, digest))
+        return samples
+
+    def _samples_match(self, samples, flash):
+        """Read the pages selected by _fingerprint_samples and compare them with their digests.
+
+        :return: True when all the pages match.
+        :rtype: bool
+        """
+        for address, length, digest in samples:
+            if not self._sample_matches(address, digest,
+                                        (yield from self._programmer.read_memory.steps(address, length, flash,
+                                                                                       cache=False))):
+                return False
+        return True
+
+    def _verify_digests(self, digests, page_size, flash, verify):
+        """Verify with the strategy the pages of a board that has the image of its fingerprint,
+        because only a few pages were read. The after and interleaved strategies read all the pages.
+
+        :param digests: list of (address, digest) tuples of the pages.
+        :type digests: list
+        :return: True when the pages match, otherwise the image has to be written.
+        :rtype: bool
+        """
+        if verify == "none":
+            return True
+        if verify == "sampled":
+            digests = digests[VERIFY_SAMPLE_INTERVAL - 1:-1:VERIFY_SAMPLE_INTERVAL] + digests[-1:]
+
+        start_time = time.perf_counter()
+        try:
+            for start, length, run in page_runs(digests, page_size):
+                read_buffer = yield from self._programmer.read_range.steps(start, length, flash, cache=False)
+                if read_buffer is None:
+                    return False
+
+                self._pages_verified += len(run)
+                for address, digest in self._changed_digests(start, run, read_buffer, page_size):
+                    if not (yield from self._digest_again(address, digest, page_size, flash)):
+                        return False
+            return True
+        finally:
+            self._verify_time += time.perf_counter() - start_time
+
+    @staticmethod
+    def _sample_matches(address, digest, read_buffer):
+        return read_buffer is not None and page_digest(address, read_buffer) == digest
+
+    def _forget_fingerprint(self, flash):
+        """The memory doesn't match, so the fingerprint of the board is no longer valid."""
+        key = self._board_key(flash)
+        if self._fingerprints is not None and key is not None:
+            self._fingerprints.remove(key)
+
+    def _set_up_to_date(self, digests, progress):
+        self._up_to_date = True
+        self._pages_skipped = len(digests)
+        if progress:
+            for address, digest in digests:
+                progress(address)
+
+    def _journal_split(self, key, image, pages):
+        """Separate the pages confirmed by an interrupted write of the same image.
+
+        :return: the confirmed pages and the rest.
+        :rtype: tuple
+        """
+        confirmed = self._journal.resume(key, image)
+        if not confirmed:
+            return [], pages
+
+        starts = [start for start, end in confirmed]
+        resumed = []
+        rest = []
+        for address, buffer in pages:
+            index = bisect_left(starts, address + 1) - 1
+            if index >= 0 and address + len(buffer) <= confirmed[index][1]:
+                resumed.append((address, buffer))
+            else:
+                rest.append((address, buffer))
+        return resumed, rest
+
+    def _resumed_pages(self, start, run, read_buffer, progress):
+        """Compare the confirmed pages with the memory.
+
+        :return: the pages that have to be written again.
+        :rtype: list
+        """
+        rest = []
+        for address, buffer in run:
+            if read_buffer is not None and read_buffer[address - start:address - start + len(buffer)] == buffer:
+                self._pages_resumed += 1
+                if progress:
+                    progress(address)
+            else:
+                rest.append((address, buffer))
+        return rest
+
+    def _journal_progress(self, key, pages, progress):
+        """Confirm in the journal each processed page.
+
+        :return: the progress function for the write.
+        :rtype: callable
+        """
+        lengths = {address: len(buffer) for address, buffer in pages}
+
+        def page_confirmed(address):
+            self._journal.confirm(key, address, address + lengths[address])
+            if progress:
+                progress(address)
+
+        return page_confirmed
+
+    def _reset_verify(self):
+        self._pages_verified = 0
+        self._pages_rewritten = 0
+        self._verify_time = 0.0
+        self._mismatch_address = None
+
+    def _verify_runs(self, pages, flash, progress, rewrite):
+        """Read the runs of consecutive pages and compare them.
+
+        :param rewrite: write again and verify the pages that don't match.
+        :type rewrite: bool
+        :return: True when all the pages match.
+        :rtype: bool
+        """
+        start_time = time.perf_counter()
+        try:
+            for start, length, run in page_runs(pages):
+                read_buffer = yield from self._programmer.read_range.steps(start, length, flash, progress, cache=False)
+                if read_buffer is None:
+                    return False
+
+                for address, buffer in run:
+                    self._pages_verified += 1
+                    if read_buffer[address - start:address - start + len(buffer)] == buffer or \
+                            (yield from self._read_again(address, buffer, flash)):
+                        continue
+                    if not rewrite or not (yield from self._rewrite_page(address, buffer, flash)):
+                        self._mismatch_address = address
+                        return False
+            return True
+        finally:
+            self._verify_time += time.perf_counter() - start_time
+
+    def _read_again(self, address, buffer, flash):
+        """Read again a page that doesn't match, up to the page retries.
+        The answers of the Stk500v1 don't have a checksum, so an error of the link
+        can change the data read without breaking the sync.
+
+        :return: True when the page matches.
+        :rtype: bool
+        """
+        for _ in range(self._page_retries):
+            if self._recording:
+                self._record_retry("verify_page")
+            self._pages_verified += 1
+            if (yield from self._programmer.read_memory.steps(address, len(buffer), flash, cache=False)) == buffer:
+                return True
+        return False
+
+    def _verify_page(self, address, buffer, flash):
+        """Read back a written page, and write it again when it doesn't match.
+
+        :return: True when the page matches.
+        :rtype: bool
+        """
+        start_time = time.perf_counter()
+        try:
+            self._pages_verified += 1
+            read_buffer = yield from self._programmer.read_memory.steps(address, len(buffer), flash, cache=False)
+            if read_buffer is None:
+                return False
+            if read_buffer == buffer or (yield from self._rewrite_page(address, buffer, flash)):
+                return True
+
+            self._mismatch_address = address
+            return False
+        finally:
+            self._verify_time += time.perf_counter() - start_time
+
+    def _rewrite_page(self, address, buffer, flash):
+        """Write again a page that doesn't match until it does, up to VERIFY_PAGE_RETRIES times.
+
+        :return: True when the page matches.
+        :rtype: bool
+        """
+        for _ in range(VERIFY_PAGE_RETRIES):
+            self._pages_rewritten += 1
+            if not (yield from self._programmer.write_memory.steps(buffer, address, flash)):
+                return False
+            self._pages_verified += 1
+            if (yield from self._programmer.read_memory.steps(address, len(buffer), flash, cache=False)) == buffer:
+                return True
+        return False
+
     def _is_cpu_signature(self, signature):
         """Look for the CPU signature in the list of Arduino boards.
 
@@ -296,6 +1680,7 @@ class ArduinoBootloader(object):
         :rtype: bool
         """
         try:
+            self._signature = signature
             list_cpu = AVR_ATMEL_CPUS[signature]
             self._cpu_name = list_cpu[0]
             self._cpu_page_size = list_cpu[1]
@@ -311,90 +1696,261 @@ class ArduinoBootloader(object):
             self._eeprom_pages = 0
             return False
 
-    def _find_device_port(self):
-        """Look in the list of serial ports, one that corresponds to CH340 or XXX
+    def find_device_ports(self):
+        """Look in the list of serial ports, all that correspond to CH340 or XXX
         that Arduino boards typically use.
 
-        :return: True when success.
-        :rtype: bool
+        :return: the port identifiers.
+        :rtype: list
         """
         if OS_ANDROID:
-            ports = usb.get_usb_device_list()
-            port = ports[0].getDeviceName()
-            return port
+            return [port.getDeviceName() for port in usb.get_usb_device_list()]
         else:
             ports = serial.tools.list_ports.comports()
-            for port in ports:
-                if ("VID:PID=1A86:7523" in port.hwid) or ("VID:PID=2341:0043" in port.hwid):
-                    return port.device
-        return ""
+            return [port.device for port in ports
+                    if ("VID:PID=1A86:7523" in port.hwid) or ("VID:PID=2341:0043" in port.hwid)]
+
+    def _find_device_port(self):
+        """Look in the list of serial ports, one that corresponds to CH340 or XXX
+        that Arduino boards typically use.
+
+        :return: the port identifier, or an empty string when there is no board.
+        :rtype: str
+        """
+        ports = self.find_device_ports()
+        return ports[0] if ports else ""
+
+    def port_key(self, port):
+        """Identify the adapter of a port by its USB VID:PID and serial number, that
+        don't change when the port gets another name.
+
+        :param port: serial port identifier or net:host.
+        :type port: str
+        :return: the identifier, the port itself when it is not an USB adapter, or None for the device objects.
+        :rtype: str
+        """
+        if not isinstance(port, str):
+            return None
 
-    def open(self, port=None, speed=115200):
+        if not OS_ANDROID and port[0:4] != 'net:':
+            for info in serial.tools.list_ports.comports():
+                if info.device == port and info.vid is not None:
+                    return "{:04X}:{:04X}:{}".format(info.vid, info.pid, info.serial_number or "")
+        return port
+
+    def _detect_candidates(self, port, candidates, cache):
+        """Order the candidates of autodetect, first the one that worked the last time.
+
+        :return: the cache, the key of the port and the candidates.
+        :rtype: tuple
+        """
+        candidates = list(candidates or AUTODETECT_CANDIDATES)
+        if cache is None:
+            cache = DetectionCache()
+        key = self.port_key(port) if cache else None
+        if key is not None:
+            cached = cache.get(key)
+            if cached in candidates:
+                candidates.remove(cached)
+                candidates.insert(0, cached)
+
+        return cache, key, candidates
+
+    @operation
+    @traced("port")
+    def autodetect(self, port=None, candidates=None, cache=None, reset=True):
+        """Find the protocol and baud rate of the bootloader, and open the port with them.
+        It tries the combination that worked the last time with the same adapter, and
+        then the candidates from the most common. Each combination resets the board,
+        and only probes the sync for AUTODETECT_SYNC_WINDOW seconds to fail fast.
+
+        :param port: serial port identifier (example: ttyUSB0 or COM1). None for automatic board search.
+        :type port: str
+        :param candidates: list of (protocol, speed) tuples, AUTODETECT_CANDIDATES by default.
+        :type candidates: list
+        :param cache: where the result is saved, None for the default file, False to disable it.
+        :type cache: DetectionCache
+        :param reset: False when the board is already in the bootloader.
+        :type reset: bool
+        :return: the opened programmer, or None when no combination answers.
+        :rtype: object
+        """
+        if not port:
+            port = self._find_device_port()
+        if not port:
+            return None
+
+        cache, key, candidates = self._detect_candidates(port, candidates, cache)
+        self._sync_window = AUTODETECT_SYNC_WINDOW
+        try:
+            for protocol, speed in candidates:
+                prg = self.select_programmer(protocol)
+                if (yield from prg.open.steps(port, speed, reset)):
+                    if key is not None:
+                        cache.put(key, protocol, speed)
+                    return prg
+                yield from prg.close.steps()
+        finally:
+            self._sync_window = None
+
+        return None
+
+    @operation
+    @traced("port", "speed", "reset")
+    def open(self, port=None, speed=115200, reset=True):
         """ Find and open the communication port where the Arduino is connected.
-        Generate the reset sequence with the DTR / RTS pins.
-        Send the sync command to verify that there is a valid bootloader.
+        Generate the reset sequence with the DTR / RTS pins, with the timing of the selected profile.
 
         :param port: serial port identifier (example: ttyUSB0 or COM1). None for automatic board search.
+                     It can also be an object with the interface of a serial port, for example the emulator.
         :type port: str
         :param speed: comunication baurate.
         :type speed: int
+        :param reset: False when the board is already in the bootloader, for example after a
+                      previous session that didn't leave it.
+        :type reset: bool
         :return: True when the serial port was opened and the connection to the board was established.
         :rtype: bool
         """
         if not port:
             port = self._find_device_port()
 
+        self.speed = speed
         if not port:
             return False
+        elif not isinstance(port, str):
+            self.device = port
         else:
-            if OS_ANDROID:
-                device = usb.get_usb_device(port)
-                if not usb.has_usb_permission(device):
-                    usb.request_usb_permission(device)
-                    return
-                self.device = serial4a.get_serial_port(port, speed, 8, 'N', 1, timeout=1)
-
-                if self.device:
-                    self.device.USB_READ_TIMEOUT_MILLIS = 1000
-            else:
-                if port[0:4] == 'net:':
-                    port = port[4:]
-                    self.device = SocketWrapper(port, speed)
-                else:
-                    self.device = serial.Serial(port, speed, 8, 'N', 1, timeout=1)
+            self.device = yield ("connect", port, speed)
+            if not self.device:
+                return False
+            if self._net_address(port, speed):
+                port = port[4:]
+                speed = NET_BAUDRATE
 
         self.port = port
-
-        ''' Clear DTR and RTS to unload the RESET capacitor of the Arduino boards'''
-        self.device.dtr = True
-        self.device.rts = True
-        time.sleep(1 / 20)
-        ''' Set DTR and RTS back to high '''
-        self.device.dtr = False
-        self.device.rts = False
-        time.sleep(1 / 20)
+        self._byte_time = 10 / speed
+        self._timeout = None
+        self._time_to_sync = None
+        self._sync_start = time.perf_counter()
+        self._cache_invalidate()
+        if self._rtt is not None:
+            self._rtt.reset(self._profile["probe_interval"])
+
+        if reset:
+            try:
+                ''' Clear DTR and RTS to unload the RESET capacitor of the Arduino boards'''
+                self.device.dtr = True
+                self.device.rts = True
+                yield ("sleep", self._profile["reset_pulse"])
+                ''' Set DTR and RTS back to high '''
+                self.device.dtr = False
+                self.device.rts = False
+                self._sync_start = time.perf_counter()
+                """The sync is probed while the bootloader starts, instead of waiting for it."""
+                yield ("sleep", self._profile["reset_delay"])
+            except OSError as e:
+                """The pseudo terminals don't have modem lines, as pyserial does on open."""
+                if e.errno not in (errno.EINVAL, errno.ENOTTY):
+                    raise
 
         """Discards bytes generated by the initialization sequence."""
-        self.device.reset_input_buffer()
+        yield ("reset_input_buffer",)
         return True
 
+    @operation
     def close(self):
         """Close the serial communication port."""
         if (not self.device is None) and self.device.is_open:
-            self.device.close()
+            yield ("close",)
             self.device = None
 
+    @staticmethod
+    def _net_address(port, speed):
+        """Get the address of a net: port, the TCP port is the speed, unless it is given as net:host:port.
+
+        :return: the host and the TCP port, or None when it is not a net: port.
+        :rtype: tuple
+        """
+        if port[0:4] != 'net:':
+            return None
+        host, _, tcp_port = port[4:].partition(':')
+        return host, int(tcp_port) if tcp_port else speed
+
+    def _connect(self, port, speed):
+        """Open the serial port, or the TCP connection of a net: port.
+
+        :return: the device, or None when the permission of the USB device was requested.
+        :rtype: object
+        """
+        if OS_ANDROID:
+            device = usb.get_usb_device(port)
+            if not usb.has_usb_permission(device):
+                usb.request_usb_permission(device)
+                return None
+            device = serial4a.get_serial_port(port, speed, 8, 'N', 1, timeout=1)
+            if device:
+                device.USB_READ_TIMEOUT_MILLIS = 1000
+            return device
+
+        address = self._net_address(port, speed)
+        if address:
+            return SocketWrapper(*address)
+        return serial.Serial(port, speed, 8, 'N', 1, timeout=1)
+
+    def _transfer(self, request, *args):
+        """Execute an input / output request of an operation, see _run.
+
+        :param request: read, write, reset_input_buffer or close of the device, sleep or connect.
+        :type request: str
+        :return: the result of the request.
+        """
+        if request == "sleep":
+            return time.sleep(*args)
+        if request == "connect":
+            return self._connect(*args)
+        return getattr(self.device, request)(*args)
+
+    def _run(self, steps):
+        """Run the generator of an operation, executing its requests until it returns.
+        The exceptions of the requests are raised inside the generator, so that its cleanup
+        (for example saving the journal) is done.
+
+        :param steps: generator of the operation.
+        :type steps: generator
+        :return: the result of the operation.
+        """
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    result = self._transfer(*request)
+                except BaseException as e:
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
     class Stk500v1(object):
         """It encapsulates the communication protocol that Arduino uses for the first
            versions of bootoloader, which can write up to 128 K bytes of flash memory.
            For example: Nano, Uno, etc.
            The older version (ATmegaBOOT_168.c) works at 57600 baudios,
            the new version (OptiBoot) at 115200"""
+
+        read_chunk_size = 256
+        """Optiboot keeps the length of STK_READ_PAGE in an 8 bits counter and ignores its
+        high byte (0 is 256), so a longer read is truncated. ATmegaBOOT uses the 16 bits
+        length, but 256 bytes is the largest size that both bootloaders read."""
+
         def __init__(self, ab):
             self._ab = ab
             self._answer = None
 
-        def open(self, port=None, speed=57600):
+        @operation
+        @traced("port", "speed", "reset")
+        def open(self, port=None, speed=57600, reset=True):
             """Find and open the communication port where the Arduino is connected.
             Generate the reset sequence with the DTR / RTS pins.
             Send the sync command to verify that there is a valid bootloader.
@@ -403,49 +1959,69 @@ class ArduinoBootloader(object):
             :type port: str
             :param speed: comunication baurate, for older bootloader use 57600.
             :type speed: int
+            :param reset: False when the board is already in the bootloader.
+            :type reset: bool
             :return: True when the serial port was opened and the connection to the board was established.
             :rtype: bool
             """
-            if self._ab.open(port, speed):
-                return self.get_sync()
+            if (yield from self._ab.open.steps(port, speed, reset)):
+                return (yield from self.get_sync.steps())
 
             return False
 
+        @operation
         def close(self):
             """Close the communication port."""
-            self._ab.close()
+            yield from self._ab.close.steps()
 
+        @operation
+        @traced()
         def get_sync(self):
             """Send the sync command whose function is to discard the reception buffers of both serial units.
-            Set the receive unit timeout to 500mS and send the sync command up to 5 times to eliminate noise from the line.
+            The sync is probed with the cadence of the handshake profile until the sync window expires,
+            which also eliminates the noise of the line (4 times with 500mS when the adaptive timeout is disabled).
 
             :return: True when success.
             :rtype: bool
             """
-            self._ab.device.timeout = 1 / 2
-            for i in range(1, 5):
-                if self._cmd_request(b"0 ", answer_len=2):
-                    self._ab.device.timeout = 1
+            adaptive = self._ab.rtt is not None
+            if not adaptive:
+                self._ab.device.timeout = 1 / 2
+            probes = self._ab._sync_probes() if adaptive else [0] * SYNC_ATTEMPTS
+            for i, attempt in enumerate(probes):
+                if i and self._ab._recording:
+                    self._ab._record_retry(STK500V1_COMMANDS[ord('0')])
+                if (yield from self._cmd_request(b"0 ", answer_len=2, attempt=attempt)):
+                    self._ab._synced()
+                    if not adaptive:
+                        self._ab.device.timeout = 1
+                    elif i:
+                        """The answers of the previous probes can arrive late and desync the next command,
+                        they are discarded after waiting one probe interval."""
+                        yield ("sleep", self._ab.profile["probe_interval"])
+                        yield ("reset_input_buffer",)
                     return True
             return False
 
+        @operation
+        @traced()
         def board_request(self):
             """Get the firmware and hardware version of the bootloader.
 
             :return: True when success.
             :rtype: bool
             """
-            if not self._cmd_request(b"A\x80 ", answer_len=3):
+            if not (yield from self._cmd_request(b"A\x80 ", answer_len=3)):
                 return False
 
             self._ab._hw_version = self._answer[1]
 
-            if not self._cmd_request(b"A\x81 ", answer_len=3):
+            if not (yield from self._cmd_request(b"A\x81 ", answer_len=3)):
                 return False
 
             self._ab._hw_version = self._answer[1]
 
-            if not self._cmd_request(b"A\x82 ", answer_len=3):
+            if not (yield from self._cmd_request(b"A\x82 ", answer_len=3)):
                 return False
 
             self._ab._sw_minor = self._answer[1]
@@ -453,7 +2029,7 @@ class ArduinoBootloader(object):
             """As the Optiboot does not implement the STK_GET_SIGN_ON command and it always 
             returns 0x14 0x10, the function send command without checking the length of the 
             response is used."""
-            if not self._cmd_request_no_len(b"1 ", answer_len=7):
+            if not (yield from self._cmd_request_no_len(b"1 ", answer_len=7)):
                 return False
 
             """The name of the programmer is between the beginning and end of the frame."""
@@ -464,16 +2040,21 @@ class ArduinoBootloader(object):
 
             return True
 
+        @operation
+        @traced()
         def cpu_signature(self):
             """Get CPU information: name, size and count of the flash memory pages
 
             :return: True when success.
             :rtype: bool
             """
-            if self._cmd_request(b"u ", answer_len=5):
+            if (yield from self._cmd_request(b"u ", answer_len=5)):
                 return self._ab._is_cpu_signature((self._answer[1] << 16) | (self._answer[2] << 8) | self._answer[3])
             return False
 
+        @operation
+        @traced("address", "flash")
+        @retried
         def write_memory(self, buffer, address, flash=True):
             """Write the buffer to the requested address of memory.
 
@@ -486,22 +2067,90 @@ class ArduinoBootloader(object):
             :return: True the buffer was successfully written.
             :rtype: bool
             """
-            if self._set_address(address, flash):
-                buff_len = len(buffer)
+            if (yield from self._set_address(address, flash)):
+                if (yield from self._cmd_request(self._write_msg(buffer, flash), answer_len=2)):
+                    self._ab._cache_update(address, buffer, flash)
+                    return True
+            return False
+
+        @operation
+        @traced()
+        def write_pages(self, pages, flash=True, progress=None):
+            """Write a sequence of pages with one round trip per page: the load address and
+            program page commands of a page are sent together, and both answers are read at once.
+            Only one page is in flight, because the bootloaders don't read the serial port while
+            they program the page, so the commands of the next page could overflow the receiver.
+            When an answer is not the expected, the input is discarded, the communication is
+            synchronized again, and the unconfirmed pages are written one command at a time.
+
+            :param pages: iterable of (address, buffer) tuples.
+            :type pages: iterable
+            :param flash: for old bootloader version can be flash or eeprom.
+            :type flash: bool
+            :param progress: optional function called with the address of each written page.
+            :type progress: callable
+            :return: True when all the pages were successfully written.
+            :rtype: bool
+            """
+            if not self._ab.device:
+                return False
 
-                cmd = bytearray(4)
-                cmd[0] = ord('d')
-                cmd[1] = ((buff_len >> 8) & 0xFF)
-                cmd[2] = (buff_len & 0xFF)
-                cmd[3] = ord('F') if flash else ord('E')
+            pages = iter(pages)
+            for address, buffer in pages:
+                msg = self._address_msg(address, flash) + self._write_msg(buffer, flash)
+                start = time.perf_counter()
+                self._ab._set_timeout(len(msg) + len(PIPELINE_ACK), self._busy_time(msg), round_trips=2)
+                yield ("write", msg)
+                if not (yield from self._pipeline_ack(start, len(msg))):
+                    return (yield from self._write_lock_step(chain([(address, buffer)], pages), flash, progress))
 
-                cmd.extend(buffer)
-                cmd.append(ord(' '))
+                self._ab._cache_update(address, buffer, flash)
+                if progress:
+                    progress(address)
 
-                return self._cmd_request(cmd, answer_len=2)
-            return False
+            return True
+
+        def _pipeline_ack(self, start, bytes_tx):
+            """Read the answers of the load address and program page commands of a page.
+
+            :param start: time when the commands were sent (time.perf_counter).
+            :type start: float
+            :param bytes_tx: length of the commands.
+            :type bytes_tx: int
+            :return: True when both answers are in sync.
+            :rtype: bool
+            """
+            answer = yield ("read", 4)
+            if self._ab._recording:
+                self._ab._record_command(STK500V1_COMMANDS[ord('d')], start, bytes_tx, len(answer),
+                                         timeout=len(answer) < 4, error=len(answer) == 4 and answer != PIPELINE_ACK)
+            return answer == PIPELINE_ACK
+
+        @traced()
+        def _write_lock_step(self, pages, flash, progress):
+            """Recover from a pipeline desync and write the pages waiting for each answer.
 
-        def read_memory(self, address, count, flash=True):
+            :return: True when all the pages were successfully written.
+            :rtype: bool
+            """
+            yield ("reset_input_buffer",)
+            self._ab._cache_invalidate()
+            if self._ab._recording:
+                self._ab._record_resync()
+            if not (yield from self.get_sync.steps()):
+                return False
+
+            for address, buffer in pages:
+                if not (yield from self.write_memory.steps(buffer, address, flash)):
+                    return False
+                if progress:
+                    progress(address)
+
+            return True
+
+        @operation
+        @traced("address", "count", "flash")
+        def read_memory(self, address, count, flash=True, cache=True):
             """Read the memory from requested address.
 
             :param address: memory address of the first byte to read. (16 bits).
@@ -510,23 +2159,73 @@ class ArduinoBootloader(object):
             :type count: int
             :param flash: eeprom supported only by the older version of bootloader.
             :type flash: bool
+            :param cache: False to read the board even when the pages are in the page cache.
+            :type cache: bool
             :return: the buffer read or None when there is error.
             :rtype: bytearray
             """
-            if self._set_address(address, flash):
-                cmd = bytearray(5)
-                cmd[0] = ord('t')
-                cmd[1] = ((count >> 8) & 0xFF)
-                cmd[2] = (count & 0xFF)
-                cmd[3] = ord('F') if flash else ord('E')
-                cmd[4] = ord(' ')
+            buffer = self._ab._cache_read(address, count, flash) if cache else None
+            if buffer is not None:
+                return buffer
+
+            if (yield from self._read_chunk(address, count, flash)):
+                # The answer start with RESP_STK_IN_SYNC and finish with RESP_STK_OK
+                buffer = bytearray(self._answer[1:count+1])
+                self._ab._cache_update(address, buffer, flash)
+                return buffer
+            return None
 
-                if self._cmd_request(cmd, answer_len=count+2):
-                    # The answer start with RESP_STK_IN_SYNC and finish with RESP_STK_OK
-                    buffer = bytearray(self._answer[1:count+1])
+        @operation
+        @traced("start", "length", "flash")
+        def read_range(self, start, length, flash=True, progress=None, cache=True):
+            """Read a memory range of any size, splitting it in commands of the largest
+            size supported by the bootloader, that are stored in a single buffer.
 
-                    return buffer
-            return None
+            :param start: memory address of the first byte to read, even for the flash (16 bits).
+            :type start: int
+            :param length: bytes to read.
+            :type length: int
+            :param flash: eeprom supported only by the older version of bootloader.
+            :type flash: bool
+            :param progress: optional function called with the address following each read block.
+            :type progress: callable
+            :param cache: False to read the board even when the pages are in the page cache.
+            :type cache: bool
+            :return: the buffer read or None when there is error.
+            :rtype: bytearray
+            """
+            buffer = bytearray(length)
+            view = memoryview(buffer)
+            for address, run_length in self._ab._cache_fill(start, buffer, flash, cache):
+                offset = address - start
+                end = offset + run_length
+                while offset < end:
+                    count = min(self.read_chunk_size, end - offset)
+                    if not (yield from self._read_chunk(start + offset, count, flash)):
+                        return None
+
+                    view[offset:offset+count] = memoryview(self._answer)[1:count+1]
+                    offset += count
+                    if progress:
+                        progress(start + offset)
+
+            self._ab._cache_update(start, buffer, flash)
+            return buffer
+
+        @retried
+        def _read_chunk(self, address, count, flash):
+            """Load the address and read a block of memory, that is kept in the answer.
+
+            :param address: memory address of the first byte (16 bits).
+            :type address: int
+            :param count: bytes to read, up to read_chunk_size.
+            :type count: int
+            :type flash: bool
+            :return: True when success.
+            :rtype: bool
+            """
+            return (yield from self._set_address(address, flash)) and \
+                (yield from self._cmd_request(self._read_msg(count, flash), answer_len=count+2))
 
         def _set_address(self, address, flash):
             """The address flash are in words, and the eeprom in bytes.
@@ -537,6 +2236,18 @@ class ArduinoBootloader(object):
             :return: True when success.
             :rtype: bool
             """
+            return (yield from self._cmd_request(self._address_msg(address, flash), answer_len=2))
+
+        @staticmethod
+        def _address_msg(address, flash):
+            """Build the load address command, the address flash are in words, and the eeprom in bytes.
+
+            :param address: address in memory of the first byte (16 bits).
+            :type address: int
+            :type flash: bool
+            :return: the command.
+            :rtype: bytearray
+            """
             if flash:
                 address = int(address / 2)
 
@@ -547,38 +2258,127 @@ class ArduinoBootloader(object):
             cmd[2] = ((address >> 8) & 0xFF)
             cmd[3] = ord(' ')
 
-            return self._cmd_request(cmd, answer_len=2)
+            return cmd
+
+        @staticmethod
+        def _read_msg(count, flash):
+            """Build the read page command.
+
+            :param count: bytes to read.
+            :type count: int
+            :type flash: bool
+            :return: the command.
+            :rtype: bytearray
+            """
+            cmd = bytearray(5)
+            cmd[0] = ord('t')
+            cmd[1] = ((count >> 8) & 0xFF)
+            cmd[2] = (count & 0xFF)
+            cmd[3] = ord('F') if flash else ord('E')
+            cmd[4] = ord(' ')
+
+            return cmd
+
+        @staticmethod
+        def _write_msg(buffer, flash):
+            """Build the program page command.
+
+            :param buffer: data to write.
+            :type buffer: bytearray
+            :type flash: bool
+            :return: the command.
+            :rtype: bytearray
+            """
+            buff_len = len(buffer)
+
+            cmd = bytearray(4)
+            cmd[0] = ord('d')
+            cmd[1] = ((buff_len >> 8) & 0xFF)
+            cmd[2] = (buff_len & 0xFF)
+            cmd[3] = ord('F') if flash else ord('E')
+
+            cmd.extend(buffer)
+            cmd.append(ord(' '))
+
+            return cmd
 
+        @operation
+        @traced()
         def leave_bootloader(self):
             """Leave programming mode and start executing the stored firmware
 
             :return: True when success.
             :rtype: bool
             """
-            return self._cmd_request(b"Q ", answer_len=2)
+            return (yield from self._cmd_request(b"Q ", answer_len=2))
 
-        def _cmd_request_no_len(self, msg, answer_len):
+        def _cmd_request_no_len(self, msg, answer_len, attempt=0):
             """Send and receive a command in stk500v1 format", but don't check the answer len
 
             :param msg: command to send.
             :type msg: bytearray
             :param answer_len: bytescount of the response.
             :type answer_len: int
+            :param attempt: retries of the command, to increase the timeout.
+            :type attempt: int
             :return: True when success.
             :rtype: bool
             """
             if self._ab.device:
-                self._ab.device.write(msg)
-                self._answer = self._ab.device.read(answer_len)
-
-                """If the answer has at least two characters, check that the first and last 
-                corresponds to the start and end sentinel."""
-                if len(self._answer) >= 2 and \
-                        self._answer[0] == RESP_STK_IN_SYNC and self._answer[-1] == RESP_STK_OK:
+                self._ab._set_timeout(len(msg) + answer_len, self._busy_time(msg), attempt)
+                start = time.perf_counter()
+                yield ("write", msg)
+                self._answer = yield ("read", answer_len)
+
+                if self._ab._recording:
+                    self._record(msg, answer_len, start)
+                if self._is_in_sync(self._answer):
+                    if len(self._answer) == answer_len:
+                        self._ab._learn_rtt(start, len(msg) + answer_len)
                     return True
             return False
 
-        def _cmd_request(self, msg, answer_len):
+        @staticmethod
+        def _busy_time(msg):
+            """Time that the bootloader needs to execute a command.
+
+            :param msg: command.
+            :type msg: bytearray
+            :return: seconds.
+            :rtype: float
+            """
+            if msg[0] != ord('d'):
+                return 0.0
+
+            return FLASH_PAGE_WRITE_TIME if msg[3] == ord('F') else (len(msg) - 5) * EEPROM_BYTE_WRITE_TIME
+
+        def _record(self, msg, answer_len, start):
+            """Add the command and its answer to the statistics and the trace.
+
+            :param msg: command sent.
+            :type msg: bytearray
+            :param answer_len: bytes count of the expected response.
+            :type answer_len: int
+            :param start: time when the command was sent.
+            :type start: float
+            """
+            timeout = len(self._answer) < answer_len
+            self._ab._record_command(STK500V1_COMMANDS.get(msg[0], hex(msg[0])), start, len(msg), len(self._answer),
+                                     timeout=timeout, error=not timeout and not self._is_in_sync(self._answer))
+
+        @staticmethod
+        def _is_in_sync(answer):
+            """If the answer has at least two characters, check that the first and last
+            corresponds to the start and end sentinel.
+
+            :param answer: received bytes.
+            :type answer: bytes
+            :return: True when the answer is valid.
+            :rtype: bool
+            """
+            return len(answer) >= 2 and answer[0] == RESP_STK_IN_SYNC and answer[-1] == RESP_STK_OK
+
+        def _cmd_request(self, msg, answer_len, attempt=0):
             """Send and receive a command in stk500v1 format
             verifies that the response size matches what is expected.
 
@@ -586,23 +2386,44 @@ class ArduinoBootloader(object):
             :type msg: bytearray
             :param answer_len: bytescount of the response.
             :type answer_len: int
+            :param attempt: retries of the command, to increase the timeout.
+            :type attempt: int
             :return: True when success.
             :rtype: bool
             """
-            if self._cmd_request_no_len(msg, answer_len):
-                return len(self._answer) == answer_len
+            if (yield from self._cmd_request_no_len(msg, answer_len, attempt)) and len(self._answer) == answer_len:
+                return True
 
+            self._ab._cache_invalidate()
             return False
 
     class Stk500v2(object):
         """It encapsulates the communication protocol that Arduino uses in bootloaders
         with more than 128K bytes of flash memory. For example: Mega 2560 etc"""
+
+        read_chunk_size = 256
+        """The answer is built in the message buffer of the bootloader (285 bytes)."""
+
         def __init__(self, ab):
             self._ab = ab
             self._answer = None
             self._sequence_number = 0
+            self._codec = FrameCodec()
+            self._reader = FrameReader()
+            self._sent = None
+            self._next_read = None
 
-        def open(self, port=None, speed=115200):
+        @property
+        def reader(self):
+            """Receive buffer with the counters of frames and discarded bytes.
+
+            :type: FrameReader
+            """
+            return self._reader
+
+        @operation
+        @traced("port", "speed", "reset")
+        def open(self, port=None, speed=115200, reset=True):
             """Find and open the communication port where the Arduino is connected.
             Generate the reset sequence with the DTR / RTS pins.
             Send the sync command to verify that there is a valid bootloader.
@@ -611,56 +2432,71 @@ class ArduinoBootloader(object):
             :type port: str
             :param speed: comunication baurate (115200).
             :type speed: int
+            :param reset: False when the board is already in the bootloader.
+            :type reset: bool
             :return: True when the serial port was opened and the connection to the board was established.
             :rtype: bool
             """
-            if self._ab.open(port, speed):
-                return self.get_sync()
+            if (yield from self._ab.open.steps(port, speed, reset)):
+                return (yield from self.get_sync.steps())
 
             return False
 
+        @operation
         def close(self):
             """Close the communication port."""
-            self._ab.close()
+            yield from self._ab.close.steps()
 
+        @operation
+        @traced()
         def get_sync(self):
             """Send the sync command
 
             :return: True when success.
             :rtype: bool
             """
-            if self._send_command(CMD_SIGN_ON):
-                if self._recv_answer(CMD_SIGN_ON):
-                    prog_name_len = self._answer[0]
-                    del self._answer[0]
-
-                    self._ab._programmer_name = self._answer.decode("utf-8")
-                    return True
+            self._reader.clear()
+            """The address counter of the bootloader is not trusted after a resync."""
+            self._next_read = None
+            """With the adaptive timeout the probes are short, so they are sent until the sync window expires."""
+            for i, attempt in enumerate(self._ab._sync_probes() if self._ab.rtt is not None else [0]):
+                if i and self._ab._recording:
+                    self._ab._record_retry(STK500V2_COMMANDS[CMD_SIGN_ON])
+                if (yield from self._send_command(CMD_SIGN_ON, attempt=attempt)):
+                    if (yield from self._recv_answer(CMD_SIGN_ON)):
+                        self._ab._synced()
+                        """The first byte is the length of the name."""
+                        self._ab._programmer_name = bytes(self._answer[1:]).decode("utf-8")
+                        return True
             return False
 
+        @operation
+        @traced()
         def board_request(self):
             """Get the firmware and hardware version of the bootloader.
 
             :return: True when success.
             :rtype: bool
             """
-            if not self._get_params(OPT_HW_VERSION):
+            if not (yield from self._get_params(OPT_HW_VERSION)):
                 return False
 
             self._ab._hw_version = self._answer[0]
 
-            if not self._get_params(OPT_SW_MAJOR):
+            if not (yield from self._get_params(OPT_SW_MAJOR)):
                 return False
 
             self._ab._hw_version = self._answer[0]
 
-            if not self._get_params(OPT_SW_MINOR):
+            if not (yield from self._get_params(OPT_SW_MINOR)):
                 return False
 
             self._ab._sw_minor = self._answer[0]
 
             return True
 
+        @operation
+        @traced()
         def cpu_signature(self):
             """Get CPU information: name, size and count of the flash memory pages
 
@@ -668,20 +2504,23 @@ class ArduinoBootloader(object):
             :rtype: bool
             """
             signature = 0
-            if not self._get_signature(CPU_SIG1):
+            if not (yield from self._get_signature(CPU_SIG1)):
                 return False
             signature = (self._answer[3] << 16)
 
-            if not self._get_signature(CPU_SIG2):
+            if not (yield from self._get_signature(CPU_SIG2)):
                 return False
             signature |= (self._answer[3] << 8)
 
-            if not self._get_signature(CPU_SIG3):
+            if not (yield from self._get_signature(CPU_SIG3)):
                 return False
             signature |= self._answer[3]
 
             return self._ab._is_cpu_signature(signature)
 
+        @operation
+        @traced("address", "flash")
+        @retried
         def write_memory(self, buffer, address, flash=True):
             """Write the buffer to the requested address of memory.
 
@@ -694,19 +2533,39 @@ class ArduinoBootloader(object):
             :return: True the buffer was successfully written.
             :rtype: bool
             """
-            if self._load_address(address, flash):
-                buff_len = len(buffer)
-
-                msg = bytearray(9)
-                msg[0] = ((buff_len >> 8) & 0xFF)
-                msg[1] = (buff_len & 0xFF)
-                msg.extend(buffer)
-                """The seven bytes preceding the data are not used."""
-                if self._send_command(CMD_PROGRAM_FLASH_ISP if flash else CMD_PROGRAM_EEPROM_ISP, msg):
-                    return self._recv_answer(CMD_PROGRAM_FLASH_ISP if flash else CMD_PROGRAM_EEPROM_ISP)
+            if (yield from self._load_address(address, flash)):
+                if (yield from self._send_command(CMD_PROGRAM_FLASH_ISP if flash else CMD_PROGRAM_EEPROM_ISP,
+                                                  self._program_msg(buffer))):
+                    if (yield from self._recv_answer(CMD_PROGRAM_FLASH_ISP if flash else CMD_PROGRAM_EEPROM_ISP)):
+                        self._ab._cache_update(address, buffer, flash)
+                        return True
             return False
 
-        def read_memory(self, address, count, flash=True):
+        @operation
+        @traced()
+        def write_pages(self, pages, flash=True, progress=None):
+            """Write a sequence of pages, one command at a time.
+
+            :param pages: iterable of (address, buffer) tuples.
+            :type pages: iterable
+            :param flash: stk500v2 version only supports flash.
+            :type flash: bool
+            :param progress: optional function called with the address of each written page.
+            :type progress: callable
+            :return: True when all the pages were successfully written.
+            :rtype: bool
+            """
+            for address, buffer in pages:
+                if not (yield from self.write_memory.steps(buffer, address, flash)):
+                    return False
+                if progress:
+                    progress(address)
+
+            return True
+
+        @operation
+        @traced("address", "count", "flash")
+        def read_memory(self, address, count, flash=True, cache=True):
             """Read the memory from requested address.
 
             :param address: memory address of the first byte to read. (32 bits).
@@ -715,22 +2574,113 @@ class ArduinoBootloader(object):
             :type count: int
             :param flash: stk500v2 version only supports flash.
             :type flash: bool
+            :param cache: False to read the board even when the pages are in the page cache.
+            :type cache: bool
             :return: the buffer read or None when there is error.
             :rtype: bytearray
             """
-            if self._load_address(address, flash):
-                msg = bytearray(3)
-                msg[0] = ((count >> 8) & 0xFF)
-                msg[1] = (count & 0xFF)
-                """The third byte is not used"""
-                if self._send_command(CMD_READ_FLASH_ISP if flash else CMD_READ_EEPROM_ISP, msg):
-                    if self._recv_answer(CMD_READ_FLASH_ISP if flash else CMD_READ_EEPROM_ISP):
-                        """The end of data is marked with STATUS_OK"""
-                        if self._answer[-1] == STATUS_CMD_OK:
-                            del self._answer[-1]
-                            return self._answer
+            buffer = self._ab._cache_read(address, count, flash) if cache else None
+            if buffer is not None:
+                return buffer
+
+            if (yield from self._read_chunk(address, count, flash)):
+                buffer = bytearray(self._answer[:-1])
+                self._ab._cache_update(address, buffer, flash)
+                return buffer
             return None
 
+        @operation
+        @traced("start", "length", "flash")
+        def read_range(self, start, length, flash=True, progress=None, cache=True):
+            """Read a memory range of any size, splitting it in commands of the largest
+            size supported by the bootloader, that are stored in a single buffer.
+            The bootloader increments the address after each read, so it is only loaded at the
+            start of each part that is not in the page cache, and after an error or a resync.
+
+            :param start: memory address of the first byte to read. (32 bits).
+            :type start: int
+            :param length: bytes to read.
+            :type length: int
+            :param flash: stk500v2 version only supports flash.
+            :type flash: bool
+            :param progress: optional function called with the address following each read block.
+            :type progress: callable
+            :param cache: False to read the board even when the pages are in the page cache.
+            :type cache: bool
+            :return: the buffer read or None when there is error.
+            :rtype: bytearray
+            """
+            buffer = bytearray(length)
+            view = memoryview(buffer)
+            for address, run_length in self._ab._cache_fill(start, buffer, flash, cache):
+                offset = address - start
+                end = offset + run_length
+                while offset < end:
+                    count = min(self.read_chunk_size, end - offset)
+                    if not (yield from self._read_chunk(start + offset, count, flash)):
+                        return None
+
+                    view[offset:offset+count] = self._answer[:count]
+                    offset += count
+                    if progress:
+                        progress(start + offset)
+
+            self._ab._cache_update(start, buffer, flash)
+            return buffer
+
+        @retried
+        def _read_chunk(self, address, count, flash):
+            """Read a block of memory, that is kept in the answer. The address is only loaded
+            when it is not the one following the previous read, which the bootloader increments.
+
+            :param address: memory address of the first byte (32 bits).
+            :type address: int
+            :param count: bytes to read, up to read_chunk_size.
+            :type count: int
+            :type flash: bool
+            :return: True when success.
+            :rtype: bool
+            """
+            if self._next_read != (address, flash) and not (yield from self._load_address(address, flash)):
+                return False
+            if not (yield from self._read_block(count, flash)):
+                return False
+
+            self._next_read = (address + count, flash)
+            return True
+
+        def _read_block(self, count, flash):
+            """Read from the current address of the bootloader, the answer
+            contains the data followed by the status.
+
+            :param count: bytes to read.
+            :type count: int
+            :param flash: stk500v2 version only supports flash.
+            :type flash: bool
+            :return: True when success.
+            :rtype: bool
+            """
+            if (yield from self._send_command(CMD_READ_FLASH_ISP if flash else CMD_READ_EEPROM_ISP,
+                                              self._read_msg(count))):
+                if (yield from self._recv_answer(CMD_READ_FLASH_ISP if flash else CMD_READ_EEPROM_ISP)):
+                    return self._is_block(self._answer, count)
+            return False
+
+        @staticmethod
+        def _is_block(answer, count):
+            """The end of data is marked with STATUS_OK
+
+            :param answer: data of the read answer.
+            :type answer: memoryview
+            :param count: requested bytes.
+            :type count: int
+            :return: True when the answer has the requested bytes.
+            :rtype: bool
+            """
+            return len(answer) == count + 1 and answer[-1] == STATUS_CMD_OK
+
+        @operation
+        @traced()
         def leave_bootloader(self):
             """Leave programming mode and start executing the stored firmware
 
@@ -738,8 +2688,8 @@ class ArduinoBootloader(object):
             :rtype: bool
             """
             msg = bytearray(3)
-            if self._send_command(CMD_LEAVE_PROGMODE_ISP, msg):
-                return self._recv_answer(CMD_LEAVE_PROGMODE_ISP)
+            if (yield from self._send_command(CMD_LEAVE_PROGMODE_ISP, msg)):
+                return (yield from self._recv_answer(CMD_LEAVE_PROGMODE_ISP))
 
             return False
 
@@ -753,17 +2703,8 @@ class ArduinoBootloader(object):
             :return: True when success.
             :rtype: bool
             """
-            if flash:
-                address = int(address / 2)
-
-            msg = bytearray(4)
-            msg[0] = (((address >> 24) & 0xFF) | 0x80)
-            msg[1] = ((address >> 16) & 0xFF)
-            msg[2] = ((address >> 8) & 0xFF)
-            msg[3] = (address & 0xFF)
-
-            if self._send_command(CMD_LOAD_ADDRESS, msg):
-                return self._recv_answer(CMD_LOAD_ADDRESS)
+            if (yield from self._send_command(CMD_LOAD_ADDRESS, self._address_msg(address, flash))):
+                return (yield from self._recv_answer(CMD_LOAD_ADDRESS))
             return False
 
         def _get_signature(self, index):
@@ -774,12 +2715,8 @@ class ArduinoBootloader(object):
             :return: True when success.
             :rtype: bool
             """
-            msg = bytearray(6)
-            msg[3] = ord('0') # Get signature
-            msg[5] = index
-
-            if self._send_command(CMD_SPI_MULTI, msg):
-                return self._recv_answer(CMD_SPI_MULTI)
+            if (yield from self._send_command(CMD_SPI_MULTI, self._signature_msg(index))):
+                return (yield from self._recv_answer(CMD_SPI_MULTI))
             return False
 
         def _get_params(self, option):
@@ -790,50 +2727,142 @@ class ArduinoBootloader(object):
             :return: True when success.
             :rtype: bool
             """
-            if self._send_command(CMD_GET_PARAMETER, option):
-                return self._recv_answer(CMD_GET_PARAMETER)
+            if (yield from self._send_command(CMD_GET_PARAMETER, option)):
+                return (yield from self._recv_answer(CMD_GET_PARAMETER))
             return False
 
+        @staticmethod
+        def _address_msg(address, flash):
+            """Build the data of the load address command, the address flash are in words,
+            and the eeprom in bytes.
+
+            :param address: memory address of the first byte:
+            :type address: int
+            :param flash: stk500v2 version only supports flash.
+            :type flash: bool
+            :return: the command data.
+            :rtype: bytearray
+            """
+            if flash:
+                address = int(address / 2)
+
+            msg = bytearray(4)
+            msg[0] = (((address >> 24) & 0xFF) | 0x80)
+            msg[1] = ((address >> 16) & 0xFF)
+            msg[2] = ((address >> 8) & 0xFF)
+            msg[3] = (address & 0xFF)
+
+            return msg
+
+        @staticmethod
+        def _program_msg(buffer):
+            """Build the data of the program command.
+
+            :param buffer: data to write.
+            :type buffer: bytearray
+            :return: the command data.
+            :rtype: bytearray
+            """
+            buff_len = len(buffer)
+
+            msg = bytearray(9)
+            msg[0] = ((buff_len >> 8) & 0xFF)
+            msg[1] = (buff_len & 0xFF)
+            msg.extend(buffer)
+            """The seven bytes preceding the data are not used."""
+            return msg
+
+        @staticmethod
+        def _read_msg(count):
+            """Build the data of the read command.
+
+            :param count: bytes to read.
+            :type count: int
+            :return: the command data.
+            :rtype: bytearray
+            """
+            msg = bytearray(3)
+            msg[0] = ((count >> 8) & 0xFF)
+            msg[1] = (count & 0xFF)
+            """The third byte is not used"""
+            return msg
+
+        @staticmethod
+        def _signature_msg(index):
+            """Build the data of the CMD_SPI_MULTI subcommand that reads the processor signature.
+
+            :param index: index of the signature byte.
+            :type index: int
+            :return: the command data.
+            :rtype: bytearray
+            """
+            msg = bytearray(6)
+            msg[3] = ord('0') # Get signature
+            msg[5] = index
+
+            return msg
+
         def _inc_sequence_numb(self):
             """Controls the overflow of the sequence number (8 bits)"""
             self._sequence_number += 1
             if self._sequence_number > 0xFF:
                 self._sequence_number = 0
 
-        def _send_command(self, cmd, data=None):
+        def _send_command(self, cmd, data=None, attempt=0):
             """The command have two parts: a fixed header of 5 bytes, and the data with the checksum.
 
             :param cmd: supported command.
             :type index: int
             :param data: if it is not None, it is added to the data buffer.
             :type data: bytearray
+            :param attempt: retries of the command, to increase the timeout.
+            :type attempt: int
             :return: True when success.
             :rtype: bool
             """
             if self._ab.device:
+                """Any other command, or a failed read, invalidates the address of the next read."""
+                self._next_read = None
                 self._inc_sequence_numb()
+                frame = self._codec.encode(self._sequence_number, cmd, data)
+                self._ab._set_timeout(len(frame) + self._answer_size(cmd, data), self._busy_time(cmd, data), attempt)
+                self._sent = (time.perf_counter(), len(frame))
+                yield ("write", frame)
+                return True
+            return False
 
-                buff = bytearray(5)
-                checksum = 0
-                data_len = 1 if data is None else len(data) + 1
+        @staticmethod
+        def _answer_size(cmd, data):
+            """Bytes of the answer frame of a command.
 
-                buff[0] = MESSAGE_START
-                buff[1] = self._sequence_number
-                buff[2] = ((data_len >> 8) & 0xFF)
-                buff[3] = (data_len & 0xFF)
-                buff[4] = TOKEN
-                buff.append(cmd)
-                if not data is None:
-                    buff.extend(data)
+            :param cmd: supported command.
+            :type cmd: int
+            :param data: data of the command.
+            :type data: bytearray
+            :return: the size, the sign on is the longest answer without data.
+            :rtype: int
+            """
+            if cmd in (CMD_READ_FLASH_ISP, CMD_READ_EEPROM_ISP):
+                return 5 + 3 + ((data[0] << 8) | data[1]) + 1
 
-                for val in buff:
-                    checksum ^= val
+            return 5 + 11 + 1
 
-                buff.append(checksum)
+        @staticmethod
+        def _busy_time(cmd, data):
+            """Time that the bootloader needs to execute a command.
 
-                self._ab.device.write(buff)
-                return True
-            return False
+            :param cmd: supported command.
+            :type cmd: int
+            :param data: data of the command.
+            :type data: bytearray
+            :return: seconds.
+            :rtype: float
+            """
+            if cmd == CMD_PROGRAM_FLASH_ISP:
+                return FLASH_PAGE_WRITE_TIME
+            if cmd == CMD_PROGRAM_EEPROM_ISP:
+                return ((data[0] << 8) | data[1]) * EEPROM_BYTE_WRITE_TIME
+            return 0.0
 
         def _recv_answer(self, cmd):
             """The response have a fixed size header that inform the data len, and the
@@ -844,43 +2873,58 @@ class ArduinoBootloader(object):
             :return: True when success.
             :rtype: bool
             """
-            head = self._read_headear()
-            if not head is None:
-                """Add one because the length does not include the checksum byte"""
-                len_data = ((head[1] << 8) | head[2]) + 1
-                """The minimum response contains the command and the status of the operation."""
-                if len_data >= 3:
-                    self._answer = bytearray(self._ab.device.read(len_data))
-                    if len(self._answer) == len_data and\
-                        self._answer[0] == cmd and self._answer[1] == STATUS_CMD_OK:
-                        answ_chk = self._answer[-1]
-                        del self._answer[-1]
-
-                        head.extend(self._answer)
-
-                        """The head don't include the START_MESSAGE byte"""
-                        checksum = MESSAGE_START
-                        for val in head:
-                            checksum ^= val
-                        """Discards the command and status from the response"""
-                        del self._answer[0]
-                        del self._answer[0]
-
-                        """The answer is valid when the checksums match"""
-                        return checksum == answ_chk
-            return False
+            discarded = self._reader.bytes_discarded
+            frame = yield from self._reader.read_frame(self._sequence_number)
+            valid = self._check_answer(frame, cmd)
+            if self._ab._recording:
+                self._record(cmd, frame, valid, self._reader.bytes_discarded - discarded)
+            if valid:
+                self._learn(frame)
+            else:
+                self._ab._cache_invalidate()
+            return valid
 
-        def _read_headear(self):
-            """Wait for the reception of the beginning of frame byte
+        def _learn(self, frame):
+            """Measure the round trip time of the command with a valid answer.
 
-            :return: None when timeout, and the header when success.
-            :rtype: bytearray
+            :param frame: header and body of the answer.
+            :type frame: tuple
             """
-            for i in range(1, 10):
-                """The header is valid, when the trailing byte sequence number and token match."""
-                start = self._ab.device.read(1)
-                if len(start) >= 1 and start[0] == MESSAGE_START:
-                    head = bytearray(self._ab.device.read(4))
-                    if len(head) == 4 and head[3] == TOKEN and self._sequence_number == head[0]:
-                        return head
-            return None
+            start, bytes_tx = self._sent
+            self._ab._learn_rtt(start, bytes_tx + 1 + len(frame[0]) + len(frame[1]))
+
+        def _record(self, cmd, frame, valid, discarded):
+            """Add the command and its answer to the statistics and the trace.
+
+            :param cmd: command to which the response belongs.
+            :type cmd: int
+            :param frame: header and body of the answer, None when timeout.
+            :type frame: tuple
+            :param valid: the answer was valid.
+            :type valid: bool
+            :param discarded: bytes discarded while looking for the answer.
+            :type discarded: int
+            """
+            start, bytes_tx = self._sent
+            bytes_rx = discarded + (0 if frame is None else 1 + len(frame[0]) + len(frame[1]))
+            self._ab._record_command(STK500V2_COMMANDS.get(cmd, hex(cmd)), start, bytes_tx, bytes_rx,
+                                     timeout=frame is None, error=frame is not None and not valid, discarded=discarded)
+
+        def _check_answer(self, frame, cmd):
+            """Validate a received frame and keep its data in the answer.
+
+            :param frame: header and body of the answer, None when timeout.
+            :type frame: tuple
+            :param cmd: command to which the response belongs.
+            :type cmd: int
+            :return: True when success.
+            :rtype: bool
+            """
+            if not frame is None:
+                head, body = frame
+                """The minimum response contains the command and the status of the operation."""
+                if len(body) >= 3 and body[0] == cmd and body[1] == STATUS_CMD_OK:
+                    """The answer is valid when the checksums match"""
+                    self._answer = self._codec.decode(head, body)
+                    return self._answer is not None
+            return False
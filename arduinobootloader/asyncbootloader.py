@@ -0,0 +1,213 @@
+'''
+asyncio version of the ArduinoBootloader class, so that one event loop can
+update the firmware of many boards at the same time.
+
+The protocols and the engine are the ones of the synchronous classes: their operations
+yield the input / output requests of the port, and here they are executed with awaits
+instead of blocking calls (see ArduinoBootloader._run).
+The net: transport uses asyncio streams, and the serial ports are read with a
+non-blocking file descriptor, which is only available on POSIX systems (Linux).
+The objects with the interface of the serial port, for example the emulator, are
+used as they are, awaiting their methods when they are coroutines.
+'''
+import asyncio
+import inspect
+
+from arduinobootloader import ArduinoBootloader, OS_ANDROID
+
+if not OS_ANDROID:
+    import serial
+
+DRAIN_TIMEOUT = 1 / 100
+"""Time without receiving bytes to consider the input buffer empty"""
+
+
+class StreamDevice(object):
+    """TCP connection through asyncio streams with the interface of the serial port."""
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self.timeout = 1
+        self.dtr = False
+        self.rts = False
+
+    @classmethod
+    async def connect(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    @property
+    def is_open(self):
+        return not self._writer.is_closing()
+
+    async def read(self, size):
+        """Read up to size bytes, waiting until the timeout expires.
+
+        :param size: bytes to read.
+        :type size: int
+        :return: the received bytes, less than size when timeout.
+        :rtype: bytes
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        data = bytearray()
+        while len(data) < size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                chunk = await asyncio.wait_for(self._reader.read(size - len(data)), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    async def write(self, buffer):
+        """The transport can keep the buffer when it is not sent at once, and the
+        frames are built in a reusable buffer, so a copy is written."""
+        self._writer.write(bytes(buffer))
+        await self._writer.drain()
+
+    async def reset_input_buffer(self):
+        """Discard the received bytes that were not read."""
+        while True:
+            try:
+                if not await asyncio.wait_for(self._reader.read(4096), DRAIN_TIMEOUT):
+                    break
+            except asyncio.TimeoutError:
+                break
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+
+
+class SerialDevice(object):
+    """Serial port whose file descriptor is watched by the event loop."""
+    def __init__(self, port, speed):
+        self._serial = serial.Serial(port, speed, 8, 'N', 1, timeout=0)
+        self._buffer = bytearray()
+        self._event = asyncio.Event()
+        self.timeout = 1
+        asyncio.get_running_loop().add_reader(self._serial.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = self._serial.read(max(self._serial.in_waiting, 1))
+        except serial.SerialException:
+            data = b''
+        if data:
+            self._buffer += data
+            self._event.set()
+
+    @property
+    def is_open(self):
+        return self._serial.is_open
+
+    @property
+    def dtr(self):
+        return self._serial.dtr
+
+    @dtr.setter
+    def dtr(self, value):
+        self._serial.dtr = value
+
+    @property
+    def rts(self):
+        return self._serial.rts
+
+    @rts.setter
+    def rts(self, value):
+        self._serial.rts = value
+
+    async def read(self, size):
+        """Read up to size bytes, waiting until the timeout expires.
+
+        :param size: bytes to read.
+        :type size: int
+        :return: the received bytes, less than size when timeout.
+        :rtype: bytes
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while len(self._buffer) < size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def write(self, buffer):
+        self._serial.write(buffer)
+
+    async def reset_input_buffer(self):
+        """Discard the received bytes that were not read."""
+        self._serial.reset_input_buffer()
+        del self._buffer[:]
+
+    async def close(self):
+        asyncio.get_running_loop().remove_reader(self._serial.fileno())
+        self._serial.close()
+
+
+class AsyncArduinoBootloader(ArduinoBootloader):
+    """ArduinoBootloader whose operations, and the ones of its programmers, are awaitable.
+    """
+    async def _connect(self, port, speed):
+        """Open the serial port, or the TCP connection of a net: port.
+
+        :return: the device, or None when the port is not supported.
+        :rtype: object
+        """
+        if OS_ANDROID:
+            return None
+
+        address = self._net_address(port, speed)
+        if address:
+            return await StreamDevice.connect(*address)
+        return SerialDevice(port, speed)
+
+    async def _transfer(self, request, *args):
+        """Execute an input / output request of an operation, see ArduinoBootloader._run.
+
+        :param request: read, write, reset_input_buffer or close of the device, sleep or connect.
+        :type request: str
+        :return: the result of the request.
+        """
+        if request == "sleep":
+            return await asyncio.sleep(*args)
+        if request == "connect":
+            return await self._connect(*args)
+
+        result = getattr(self.device, request)(*args)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def _run(self, steps):
+        """Run the generator of an operation, awaiting its requests until it returns.
+
+        :param steps: generator of the operation.
+        :type steps: generator
+        :return: the result of the operation.
+        """
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    result = await self._transfer(*request)
+                except BaseException as e:
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
@@ -0,0 +1,362 @@
+'''
+Data that the library keeps in memory during a session, or in files between sessions.
+
+The JSON files are saved in CACHE_DIRECTORY: the protocol and baud rate detected for each
+adapter, the journal of the pages confirmed by an interrupted write, and the fingerprint of
+the image written in each board. The page cache keeps in memory the pages read and written
+in a session.
+'''
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from os import environ
+
+PAGE_CACHE_PAGES = 1024
+"""Pages kept by the page cache, all the flash of the Mega 2560"""
+
+CACHE_DIRECTORY = os.path.join(environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                               "arduinobootloader")
+"""Directory of the files that the library keeps between sessions"""
+
+AUTODETECT_CACHE = os.path.join(CACHE_DIRECTORY, "autodetect.json")
+"""File where autodetect saves the protocol and baud rate found for each adapter"""
+
+FLASH_JOURNAL = os.path.join(CACHE_DIRECTORY, "journal.json")
+"""File where the journal saves the pages confirmed by each board"""
+
+JOURNAL_INTERVAL = 0.5
+"""Seconds between the saves of the journal while the pages are written"""
+
+FINGERPRINT_STORE = os.path.join(CACHE_DIRECTORY, "fingerprints.json")
+"""File where the fingerprint of the image written in each board is saved"""
+
+
+class JsonCache(object):
+    """Entries by key saved in a JSON file, shared by the threads that use the same instance.
+    The file is optional, so the errors reading or writing it are ignored."""
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+
+    @property
+    def filename(self):
+        """Path of the JSON file.
+
+        :type: str
+        """
+        return self._filename
+
+    def _load(self):
+        try:
+            with open(self._filename) as file:
+                entries = json.load(file)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        try:
+            if os.path.dirname(self._filename):
+                os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+            temp = "{}.{}.tmp".format(self._filename, os.getpid())
+            with open(temp, "w") as file:
+                json.dump(entries, file, indent=2)
+            os.replace(temp, self._filename)
+        except OSError:
+            pass
+
+
+class DetectionCache(JsonCache):
+    """Protocol and baud rate detected for each adapter, saved in a JSON file
+    so that the next session connects at the first attempt."""
+    def __init__(self, filename=AUTODETECT_CACHE):
+        super().__init__(filename)
+
+    def get(self, key):
+        """Get the combination that worked the last time.
+
+        :param key: identifier of the adapter.
+        :type key: str
+        :return: the (protocol, speed) tuple, or None when it is unknown.
+        :rtype: tuple
+        """
+        with self._lock:
+            entry = self._load().get(key)
+        return (entry[0], entry[1]) if entry else None
+
+    def put(self, key, protocol, speed):
+        """Save the combination that worked. The cache is optional, so the errors writing it are ignored.
+
+        :param key: identifier of the adapter.
+        :type key: str
+        :param protocol: Stk500v1 or Stk500v2.
+        :type protocol: str
+        :param speed: baud rate.
+        :type speed: int
+        """
+        with self._lock:
+            entries = self._load()
+            if entries.get(key) == [protocol, speed]:
+                return
+
+            entries[key] = [protocol, speed]
+            self._save(entries)
+
+
+class FlashJournal(JsonCache):
+    """Pages confirmed by each board while an image is written, saved in a JSON file,
+    so that a write interrupted, for example by a disconnected cable, continues from
+    the pages that were not confirmed. The entry of the board is removed when the
+    write completes, and it is ignored when the image is another.
+
+    :param filename: path of the JSON file.
+    :type filename: str
+    :param interval: seconds between the saves while the pages are confirmed.
+    :type interval: float
+    """
+    def __init__(self, filename=FLASH_JOURNAL, interval=JOURNAL_INTERVAL):
+        super().__init__(filename)
+        self._interval = interval
+        self._entries = {}
+        self._saved = {}
+
+    def resume(self, key, image):
+        """Start the write of an image, keeping the pages confirmed by a previous write of the same image.
+
+        :param key: identifier of the board and the memory.
+        :type key: str
+        :param image: digest of the pages of the image (see pages_digest).
+        :type image: str
+        :return: list of (start, end) tuples of the confirmed addresses, the end is not included.
+        :rtype: list
+        """
+        with self._lock:
+            entry = self._load().get(key)
+            ranges = entry["ranges"] if isinstance(entry, dict) and entry.get("image") == image else []
+            self._entries[key] = {"image": image, "ranges": [list(r) for r in ranges]}
+            self._saved[key] = time.monotonic()
+        return [tuple(r) for r in ranges]
+
+    def confirm(self, key, start, end):
+        """Add the addresses of a page confirmed by the board.
+
+        :param key: identifier of the board and the memory.
+        :type key: str
+        :param start: first address.
+        :type start: int
+        :param end: address following the last one.
+        :type end: int
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+
+            ranges = entry["ranges"]
+            if ranges and ranges[-1][1] == start:
+                """The usual case, the pages are written in order."""
+                ranges[-1][1] = end
+            else:
+                merged = []
+                for low, high in sorted(ranges + [[start, end]]):
+                    if merged and low <= merged[-1][1]:
+                        merged[-1][1] = max(merged[-1][1], high)
+                    else:
+                        merged.append([low, high])
+                entry["ranges"] = merged
+
+            if time.monotonic() - self._saved[key] >= self._interval:
+                self._flush(key, entry)
+
+    def finish(self, key, complete):
+        """End the write of an image.
+
+        :param key: identifier of the board and the memory.
+        :type key: str
+        :param complete: True removes the entry, False saves the confirmed pages to resume later.
+        :type complete: bool
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if complete:
+                entries = self._load()
+                if entries.pop(key, None) is not None:
+                    self._save(entries)
+            elif entry is not None:
+                self._flush(key, entry)
+            self._saved.pop(key, None)
+
+    def _flush(self, key, entry):
+        entries = self._load()
+        entries[key] = entry
+        self._save(entries)
+        self._saved[key] = time.monotonic()
+
+
+class FingerprintStore(JsonCache):
+    """Fingerprint of the image last written in each board, saved in a JSON file: the digest
+    of the image and the digest of each page. When the same image is written again, a few
+    pages are read and compared with their digests, and the board is up to date when they match.
+
+    :param filename: path of the JSON file.
+    :type filename: str
+    """
+    def __init__(self, filename=FINGERPRINT_STORE):
+        super().__init__(filename)
+
+    def get(self, key):
+        """Get the fingerprint of the image written in the board.
+
+        :param key: identifier of the board and the memory.
+        :type key: str
+        :return: the digest of the image and a dictionary with the digest of each page by address,
+                 or None when it is unknown.
+        :rtype: tuple
+        """
+        with self._lock:
+            entry = self._load().get(key)
+        try:
+            return entry["image"], {address: digest for address, digest in entry["pages"]}
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def put(self, key, image, digests):
+        """Save the fingerprint of the image written in the board.
+
+        :param key: identifier of the board and the memory.
+        :type key: str
+        :param image: digest of the pages of the image (see pages_digest).
+        :type image: str
+        :param digests: iterable of (address, digest) tuples of the pages of the image (see page_digest).
+        :type digests: iterable
+        """
+        with self._lock:
+            entries = self._load()
+            entries[key] = {"image": image, "pages": [[address, digest] for address, digest in digests]}
+            self._save(entries)
+
+    def remove(self, key):
+        """Forget the image of the board, for example before writing another one.
+
+        :param key: identifier of the board and the memory.
+        :type key: str
+        """
+        with self._lock:
+            entries = self._load()
+            if entries.pop(key, None) is not None:
+                self._save(entries)
+
+
+class PageCache(object):
+    """Copy of the memory pages of the board, so that the regions read more than once in a session,
+    for example to compare before writing and to dump, are only read once. It is filled with the
+    pages read and the pages written, and the least recently used pages are discarded.
+
+    :param max_pages: pages kept.
+    :type max_pages: int
+    """
+    def __init__(self, max_pages=PAGE_CACHE_PAGES):
+        self._max_pages = max_pages
+        self._pages = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._pages)
+
+    @property
+    def hits(self):
+        """Pages read from the cache.
+
+        :type: int
+        """
+        return self._hits
+
+    @property
+    def misses(self):
+        """Pages that were not in the cache when they were read.
+
+        :type: int
+        """
+        return self._misses
+
+    def read(self, address, count, page_size, flash=True):
+        """Get a region of the memory when all its pages are cached.
+
+        :param address: first byte.
+        :type address: int
+        :param count: bytes to read.
+        :type count: int
+        :param page_size: page size of the memory.
+        :type page_size: int
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :return: the bytes, or None when a page is missing.
+        :rtype: bytearray
+        """
+        buffer = bytearray(count)
+        return None if self.fill(address, buffer, page_size, flash) else buffer
+
+    def fill(self, address, buffer, page_size, flash=True):
+        """Copy the cached pages of a region of the memory to its buffer.
+
+        :param address: first byte of the region.
+        :type address: int
+        :param buffer: buffer of the region.
+        :type buffer: bytearray
+        :param page_size: page size of the memory.
+        :type page_size: int
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :return: list of (address, count) tuples of the parts that are not cached.
+        :rtype: list
+        """
+        end = address + len(buffer)
+        missing = []
+        for page in range(address - address % page_size, end, page_size):
+            low = max(page, address)
+            high = min(page + page_size, end)
+            data = self._pages.get((flash, page))
+            if data is None:
+                self._misses += 1
+                if missing and sum(missing[-1]) == low:
+                    missing[-1] = (missing[-1][0], high - missing[-1][0])
+                else:
+                    missing.append((low, high - low))
+            else:
+                self._hits += 1
+                self._pages.move_to_end((flash, page))
+                buffer[low - address:high - address] = data[low - page:high - page]
+
+        return missing
+
+    def update(self, address, buffer, page_size, flash=True):
+        """Keep the complete pages of a region read from or written to the memory.
+        The pages partially covered are discarded, because the bootloader writes complete pages.
+
+        :param address: first byte.
+        :type address: int
+        :param buffer: content of the memory.
+        :type buffer: bytearray
+        :param page_size: page size of the memory.
+        :type page_size: int
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        """
+        end = address + len(buffer)
+        for page in range(address - address % page_size, end, page_size):
+            key = (flash, page)
+            if page >= address and page + page_size <= end:
+                self._pages[key] = bytes(buffer[page - address:page - address + page_size])
+                self._pages.move_to_end(key)
+            else:
+                self._pages.pop(key, None)
+
+        while len(self._pages) > self._max_pages:
+            self._pages.popitem(last=False)
+
+    def invalidate(self):
+        """Discard all the pages, for example when the board is reset or the communication fails."""
+        self._pages.clear()
@@ -0,0 +1,322 @@
+'''
+Session with the bootloader of an Arduino board for several operations.
+
+Each open of the port resets the board, synchronizes and queries the bootloader
+and the cpu again. The session opens the connection once, caches the information
+of the board, and runs the operations (write, read and verify of the flash and
+the eeprom) one after the other. Between operations it sends the sync command, so
+that the bootloader doesn't start the application when its watchdog expires.
+The pages read or written are kept in the page cache, so a region is only read
+once, except by the verification, that always reads the board.
+
+    with BootloaderSession("/dev/ttyUSB0") as session:
+        if session.is_open:
+            session.write(firmware)
+            session.write(data, flash=False)
+            session.verify(firmware)
+'''
+import threading
+import time
+from contextlib import contextmanager
+
+from arduinobootloader import ArduinoBootloader, AUTODETECT_CANDIDATES
+from pageplanner import plan_pages
+
+KEEPALIVE_INTERVAL = 0.5
+"""Seconds without commands before the session sends the sync command, Optiboot starts the application after 1 second"""
+
+
+class BootloaderSession(object):
+    """One connection with the bootloader for a sequence of operations.
+    The protocol and the baud rate that are not given are detected.
+
+    :param port: serial port identifier (example: ttyUSB0 or COM1), net:host:port, or an object
+                 with the interface of the serial port. None for automatic board search.
+    :type port: str
+    :param speed: baud rate, None to detect it.
+    :type speed: int
+    :param protocol: Stk500v1 or Stk500v2, None to detect it.
+    :type protocol: str
+    :param profile: reset and sync handshake of the board (see HANDSHAKE_PROFILES).
+    :type profile: str
+    :param reset: False when the board is already in the bootloader.
+    :type reset: bool
+    :param keepalive: seconds without commands before the sync is sent, 0 to disable it.
+    :type keepalive: float
+    :param page_cache: enable the page cache of the bootloader.
+    :type page_cache: bool
+    :param fingerprints: enable the fingerprints of the bootloader, so that writing the image
+                         that the board already has only reads a few pages.
+    :type fingerprints: bool
+    :param ab: bootloader to use, for example with the statistics enabled. None to create one.
+    :type ab: ArduinoBootloader
+    """
+    def __init__(self, port=None, speed=None, protocol=None, profile=None, reset=True,
+                 keepalive=KEEPALIVE_INTERVAL, page_cache=True, fingerprints=False, ab=None):
+        self._ab = ab or ArduinoBootloader()
+        if page_cache and self._ab.page_cache is None:
+            self._ab.enable_page_cache()
+        if fingerprints and self._ab.fingerprints is None:
+            self._ab.enable_fingerprints()
+        self._port = port
+        self._speed = speed
+        self._protocol = protocol
+        self._profile = profile
+        self._reset = reset
+        self._keepalive = keepalive
+        self._prg = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last = 0.0
+        self._error = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def ab(self):
+        """Bootloader of the session, with the information of the board.
+
+        :type: ArduinoBootloader
+        """
+        return self._ab
+
+    @property
+    def programmer(self):
+        """Programmer of the session, None when it is not open.
+
+        :type: object
+        """
+        return self._prg
+
+    @property
+    def is_open(self):
+        """True when the bootloader answered and the board information was read,
+        and the keep alive didn't fail.
+
+        :type: bool
+        """
+        return self._prg is not None and self._error is None
+
+    @property
+    def error(self):
+        """Exception raised by the sync of the keep alive, for example SerialException when the
+        board is disconnected, None when it didn't fail. After it the operations fail until the
+        session is closed.
+
+        :type: Exception
+        """
+        return self._error
+
+    def candidates(self):
+        """Combinations of protocol and baud rate that can be tried with the given ones.
+
+        :return: list of (protocol, speed) tuples, None when both are given.
+        :rtype: list
+        """
+        if self._protocol and self._speed:
+            return None
+
+        candidates = [(protocol, speed) for protocol, speed in AUTODETECT_CANDIDATES
+                      if self._protocol in (None, protocol) and self._speed in (None, speed)]
+        return candidates or [(self._protocol or "Stk500v1", self._speed or 115200)]
+
+    def open(self):
+        """Open the port, synchronize with the bootloader, and read the information of the
+        bootloader and the cpu.
+
+        :return: True when success.
+        :rtype: bool
+        """
+        if self._prg is not None:
+            return self._error is None
+
+        if self._profile and self._ab.select_profile(self._profile) is None:
+            return False
+
+        candidates = self.candidates()
+        if candidates is None:
+            prg = self._ab.select_programmer(self._protocol)
+            if prg is None:
+                return False
+            if not prg.open(self._port, self._speed, self._reset):
+                prg.close()
+                return False
+        else:
+            prg = self._ab.autodetect(self._port, candidates, reset=self._reset)
+            if prg is None:
+                return False
+
+        if not prg.board_request() or not prg.cpu_signature():
+            prg.close()
+            return False
+
+        self._prg = prg
+        self._last = time.perf_counter()
+        if self._keepalive:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._keep_alive, name="keepalive", daemon=True)
+            self._thread.start()
+        return True
+
+    def close(self, leave=True):
+        """Close the session.
+
+        :param leave: start the application of the board.
+        :type leave: bool
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+        if self._prg is not None:
+            if leave and self._error is None:
+                self._prg.leave_bootloader()
+            self._prg.close()
+            self._prg = None
+        self._error = None
+
+    @contextmanager
+    def _command(self):
+        """Exclude the keep alive while an operation is running."""
+        with self._lock:
+            try:
+                yield
+            finally:
+                self._last = time.perf_counter()
+
+    def _keep_alive(self):
+        timeout = self._keepalive
+        while not self._stop.wait(timeout):
+            with self._lock:
+                idle = time.perf_counter() - self._last
+                if idle >= self._keepalive:
+                    try:
+                        self._prg.get_sync()
+                    except Exception as e:
+                        """The port failed, it is kept for the next operation instead of ending the thread silently."""
+                        self._error = e
+                        return
+                    self._last = time.perf_counter()
+                    idle = 0.0
+            timeout = self._keepalive - idle
+
+    def page_size(self, flash=True):
+        """Size of the pages of the memory.
+
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :return: bytes of a page.
+        :rtype: int
+        """
+        return self._ab.cpu_page_size if flash else self._ab.eeprom_page_size
+
+    def memory_size(self, flash=True):
+        """Size of the memory.
+
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :return: bytes of the memory.
+        :rtype: int
+        """
+        if flash:
+            return self._ab.cpu_page_size * self._ab.cpu_pages
+        return self._ab.eeprom_page_size * self._ab.eeprom_pages
+
+    def write(self, ih, flash=True, delta=False, progress=None, verify="none", force=False, manifests=None):
+        """Write the pages of an image that have data, and read them back with
+        the verification strategy (see VERIFY_STRATEGIES). With the fingerprints
+        enabled, nothing is written when the board already has the image (see ab.up_to_date).
+
+        :param ih: firmware or eeprom image.
+        :type ih: HexImage or IntelHex
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :param delta: only write the pages that differ from the memory.
+        :type delta: bool
+        :param progress: optional function called with the address of each processed page.
+        :type progress: callable
+        :param verify: after, interleaved, sampled or none.
+        :type verify: str
+        :param force: write the image even when the fingerprint of the board matches.
+        :type force: bool
+        :param manifests: manifests of the image by page size (see load_manifest), None to hash the pages.
+        :type manifests: dict
+        :return: True when success.
+        :rtype: bool
+        """
+        if not self.is_open:
+            return False
+
+        with self._command():
+            return self._ab.write_pages(plan_pages(ih, self.page_size(flash)), flash, delta, progress, verify,
+                                        force, self._manifest(manifests, flash))
+
+    def verify(self, ih, flash=True, progress=None):
+        """Compare the pages of an image that have data with the memory.
+
+        :param ih: firmware or eeprom image.
+        :type ih: HexImage or IntelHex
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :param progress: optional function called with the address of each read chunk.
+        :type progress: callable
+        :return: True when the memory has the image.
+        :rtype: bool
+        """
+        if not self.is_open:
+            return False
+
+        with self._command():
+            return self._ab.verify_pages(plan_pages(ih, self.page_size(flash)), flash, progress)
+
+    def verify_manifest(self, manifests, flash=True, progress=None):
+        """Compare the pages of an image with the memory using its manifest, without the image.
+
+        :param manifests: manifests of the image by page size (see load_manifest).
+        :type manifests: dict
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :param progress: optional function called with the address of each read chunk.
+        :type progress: callable
+        :return: True when the memory has the image, False also when there is no manifest for the page size.
+        :rtype: bool
+        """
+        manifest = self._manifest(manifests, flash)
+        if not self.is_open or manifest is None:
+            return False
+
+        with self._command():
+            return self._ab.verify_manifest(manifest, flash, progress)
+
+    def _manifest(self, manifests, flash):
+        return manifests.get(self.page_size(flash)) if manifests else None
+
+    def read(self, flash=True, start=0, length=None, progress=None):
+        """Read a region of the memory.
+
+        :param flash: flash or eeprom memory.
+        :type flash: bool
+        :param start: first address.
+        :type start: int
+        :param length: bytes to read, None until the end of the memory.
+        :type length: int
+        :param progress: optional function called with the address of each read chunk.
+        :type progress: callable
+        :return: the buffer read or None when there is error.
+        :rtype: bytearray
+        """
+        if not self.is_open:
+            return None
+
+        if length is None:
+            length = self.memory_size(flash) - start
+
+        with self._command():
+            return self._prg.read_range(start, length, flash, progress)
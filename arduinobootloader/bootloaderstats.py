@@ -0,0 +1,350 @@
+'''
+Statistics, timing and trace of the commands exchanged with the bootloader.
+
+The CommandStats count the latency, the bytes, the errors and the retries of each
+command, to find the slow boards and adapters. The RttEstimator measures the round
+trip time to calculate the timeout of each command, and the SessionTrace records
+the timeline of a session in the Chrome Trace Event format.
+'''
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+"""Upper bounds in seconds of the latency histogram of the commands"""
+
+TIMEOUT_INITIAL = 0.05
+"""Round trip timeout in seconds before the first measure"""
+
+TIMEOUT_MIN = 0.02
+"""Minimum round trip timeout, the USB serial adapters buffer the answers up to 16 mS"""
+
+TIMEOUT_MAX = 1.0
+"""Maximum round trip timeout, the fixed timeout of the previous versions"""
+
+
+class CommandStats(object):
+    """Counters of the commands exchanged with the bootloader, keyed by the command name:
+    latency histogram, bytes sent and received, timeouts, invalid answers, bytes
+    discarded while looking for the answer and retries. It also counts the resyncs
+    of the communication."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._commands = {}
+        self._resyncs = 0
+
+    @property
+    def buckets(self):
+        """Upper bounds in seconds of the latency histogram.
+
+        :type: tuple
+        """
+        return self._buckets
+
+    @property
+    def resyncs(self):
+        """Times that the communication was synchronized again after an error.
+
+        :type: int
+        """
+        return self._resyncs
+
+    def clear(self):
+        """Reset all the counters."""
+        self._commands.clear()
+        self._resyncs = 0
+
+    def _entry(self, command):
+        entry = self._commands.get(command)
+        if entry is None:
+            entry = {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes_tx": 0, "bytes_rx": 0,
+                     "timeouts": 0, "errors": 0, "discarded": 0, "retries": 0,
+                     "histogram": [0] * (len(self._buckets) + 1)}
+            self._commands[command] = entry
+        return entry
+
+    def record(self, command, seconds, bytes_tx, bytes_rx, timeout=False, error=False, discarded=0):
+        """Add a command and its answer.
+
+        :param command: name of the command.
+        :type command: str
+        :param seconds: time from the command to the answer.
+        :type seconds: float
+        :param bytes_tx: bytes sent.
+        :type bytes_tx: int
+        :param bytes_rx: bytes received.
+        :type bytes_rx: int
+        :param timeout: the answer was not complete.
+        :type timeout: bool
+        :param error: the answer was complete but not valid.
+        :type error: bool
+        :param discarded: bytes received that didn't belong to the answer.
+        :type discarded: int
+        """
+        entry = self._entry(command)
+        entry["count"] += 1
+        entry["seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+        entry["bytes_tx"] += bytes_tx
+        entry["bytes_rx"] += bytes_rx
+        entry["timeouts"] += timeout
+        entry["errors"] += error
+        entry["discarded"] += discarded
+        entry["histogram"][bisect_left(self._buckets, seconds)] += 1
+
+    def retry(self, command):
+        """Count a command that is sent again.
+
+        :param command: name of the command.
+        :type command: str
+        """
+        self._entry(command)["retries"] += 1
+
+    def resync(self):
+        """Count a new synchronization of the communication."""
+        self._resyncs += 1
+
+    def summary(self):
+        """Get the counters of each command, and the mean latency in milliseconds.
+
+        :return: dictionary that can be serialized to JSON.
+        :rtype: dict
+        """
+        commands = {}
+        for command, entry in self._commands.items():
+            values = dict(entry)
+            values["mean_ms"] = entry["seconds"] * 1000 / entry["count"] if entry["count"] else 0.0
+            values["histogram"] = {str(bound): count for bound, count in zip(self._buckets + ("+Inf",),
+                                                                              entry["histogram"])}
+            commands[command] = values
+
+        return {"resyncs": self._resyncs, "commands": commands}
+
+    def to_json(self, **kwargs):
+        """Export the summary as JSON.
+
+        :param kwargs: arguments of json.dumps, for example indent.
+        :return: the JSON document.
+        :rtype: str
+        """
+        return json.dumps(self.summary(), **kwargs)
+
+    def to_prometheus(self, prefix="arduinobootloader", labels=None):
+        """Export the counters in the Prometheus text format.
+
+        :param prefix: prefix of the metric names.
+        :type prefix: str
+        :param labels: labels added to all the metrics, for example the port.
+        :type labels: dict
+        :return: the metrics.
+        :rtype: str
+        """
+        common = ",".join('{}="{}"'.format(name, value) for name, value in (labels or {}).items())
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP {}_{} {}".format(prefix, name, help_text))
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+            for suffix, label, value in samples:
+                label = ",".join(text for text in (common, label) if text)
+                lines.append("{}_{}{}{} {}".format(prefix, name, suffix, "{" + label + "}" if label else "", value))
+
+        histogram = []
+        for command, entry in self._commands.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets + ("+Inf",), entry["histogram"]):
+                cumulative += count
+                histogram.append(("_bucket", 'command="{}",le="{}"'.format(command, bound), cumulative))
+            histogram.append(("_sum", 'command="{}"'.format(command), entry["seconds"]))
+            histogram.append(("_count", 'command="{}"'.format(command), entry["count"]))
+        metric("command_seconds", "histogram", "Time from the command to its answer.", histogram)
+
+        for key, name, help_text in (("bytes_tx", "tx_bytes_total", "Bytes sent to the bootloader."),
+                                     ("bytes_rx", "rx_bytes_total", "Bytes received from the bootloader."),
+                                     ("timeouts", "timeouts_total", "Answers not complete."),
+                                     ("errors", "errors_total", "Answers not valid."),
+                                     ("discarded", "discarded_bytes_total", "Bytes that didn't belong to the answer."),
+                                     ("retries", "retries_total", "Commands sent again.")):
+            metric(name, "counter", help_text, [("", 'command="{}"'.format(command), entry[key])
+                                                for command, entry in self._commands.items()])
+
+        metric("resyncs_total", "counter", "New synchronizations of the communication.",
+               [("", "", self._resyncs)])
+        return "\n".join(lines) + "\n"
+
+
+class RttEstimator(object):
+    """Estimation of the round trip time of the commands, with the smoothed average
+    and variance used by TCP (RFC 6298). The timeout is the average plus four times
+    the variance, so it adapts to the latency of the adapter or the network. As in TCP,
+    the timeout is doubled after each command that is repeated because it timed out,
+    until the next measure."""
+    def __init__(self, initial=TIMEOUT_INITIAL, minimum=TIMEOUT_MIN, maximum=TIMEOUT_MAX):
+        self._initial = initial
+        self._minimum = minimum
+        self._maximum = maximum
+        self._srtt = None
+        self._rttvar = 0.0
+        self._samples = 0
+        self._backoff = 0
+
+    @property
+    def srtt(self):
+        """Smoothed round trip time in seconds, None before the first measure.
+
+        :type: float
+        """
+        return self._srtt
+
+    @property
+    def rttvar(self):
+        """Round trip time variation in seconds.
+
+        :type: float
+        """
+        return self._rttvar
+
+    @property
+    def samples(self):
+        """Count of measures.
+
+        :type: int
+        """
+        return self._samples
+
+    @property
+    def timeout(self):
+        """Round trip timeout in seconds, without the transfer time of the bytes.
+
+        :type: float
+        """
+        timeout = self._initial if self._srtt is None else max(self._srtt + 4 * self._rttvar, self._minimum)
+        return min(timeout * (1 << self._backoff), self._maximum)
+
+    @property
+    def backoff(self):
+        """Times that the timeout was doubled since the last measure.
+
+        :type: int
+        """
+        return self._backoff
+
+    def back_off(self):
+        """Double the timeout, for example before repeating a command without answer."""
+        self._backoff = min(self._backoff + 1, 16)
+
+    def reset(self, initial=None):
+        """Forget the measures, for example when a new board is connected.
+
+        :param initial: new timeout before the first measure, None to keep it.
+        :type initial: float
+        """
+        if initial is not None:
+            self._initial = initial
+        self._srtt = None
+        self._rttvar = 0.0
+        self._samples = 0
+        self._backoff = 0
+
+    def update(self, sample):
+        """Add a measure of the round trip time.
+
+        :param sample: seconds from the command to the answer, without the transfer time.
+        :type sample: float
+        """
+        if self._srtt is None:
+            self._srtt = sample
+            self._rttvar = sample / 2
+        else:
+            self._rttvar = 3 / 4 * self._rttvar + 1 / 4 * abs(self._srtt - sample)
+            self._srtt = 7 / 8 * self._srtt + 1 / 8 * sample
+        self._samples += 1
+        self._backoff = 0
+
+
+class SessionTrace(object):
+    """Timeline of a flashing session in the Chrome Trace Event format, that can be
+    loaded in Perfetto or chrome://tracing. The events of each thread are shown in
+    a different track, so a trace can be shared by the boards of a fleet update."""
+    def __init__(self, tid=None):
+        """
+        :param tid: track of the events, None to use the id of the thread that records them.
+        :type tid: int
+        """
+        self._pid = os.getpid()
+        self._tid = tid
+        self._events = []
+
+    @property
+    def events(self):
+        """Recorded trace events.
+
+        :type: list
+        """
+        return self._events
+
+    def _track(self):
+        return self._tid if self._tid is not None else threading.get_ident()
+
+    def name_track(self, name):
+        """Give a name to the track of the current thread, for example the port.
+
+        :param name: name shown in the viewer.
+        :type name: str
+        """
+        self._events.append({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": self._track(),
+                             "args": {"name": name}})
+
+    @contextmanager
+    def span(self, name, args=None):
+        """Record the duration of a block.
+
+        :param name: name of the span.
+        :type name: str
+        :param args: values shown with the span, they can be added inside the block.
+        :type args: dict
+        :return: the arguments of the span.
+        :rtype: dict
+        """
+        args = {} if args is None else args
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.complete(name, start, time.perf_counter() - start, "bootloader", args)
+
+    def complete(self, name, start, seconds, category="bootloader", args=None):
+        """Add an event with its duration.
+
+        :param start: time.perf_counter when it started.
+        :type start: float
+        :param seconds: duration.
+        :type seconds: float
+        """
+        self._events.append({"name": name, "cat": category, "ph": "X", "ts": start * 1e6, "dur": seconds * 1e6,
+                             "pid": self._pid, "tid": self._track(), "args": args or {}})
+
+    def instant(self, name, args=None):
+        """Add an event without duration, for example a retry."""
+        self._events.append({"name": name, "cat": "bootloader", "ph": "i", "s": "t", "ts": time.perf_counter() * 1e6,
+                             "pid": self._pid, "tid": self._track(), "args": args or {}})
+
+    def to_json(self):
+        """Export the events in the JSON Object format of the Chrome Trace Event.
+
+        :return: the JSON document.
+        :rtype: str
+        """
+        return json.dumps({"traceEvents": self._events, "displayTimeUnit": "ms"})
+
+    def save(self, filename):
+        """Write the trace to a file.
+
+        :param filename: name of the file, usually with the .json extension.
+        :type filename: str
+        """
+        with open(filename, "w") as file:
+            file.write(self.to_json())
@@ -0,0 +1,176 @@
+'''
+Streaming reader of the firmware files in Intel hexadecimal format.
+
+The IntelHex library keeps a dictionary entry per byte, and the page planner
+builds each page again with tobinarray for the write and for the verification.
+The reader parses the records of the file line by line, directly into a flat
+buffer filled with the value of the erased bytes (0xFF), so that a page is a
+slice of the buffer. HexImage has the segments, minaddr, maxaddr and tobinarray
+methods of IntelHex, so it can be used with the page planner and the session.
+
+    image = read_hex("firmware.hex")
+    for address, buffer in plan_pages(image, ab.cpu_page_size):
+'''
+from bisect import bisect_left
+
+from pageplanner import BLANK_BYTE
+
+DATA_RECORD = 0
+EOF_RECORD = 1
+EXTENDED_SEGMENT_RECORD = 2
+START_SEGMENT_RECORD = 3
+EXTENDED_LINEAR_RECORD = 4
+START_LINEAR_RECORD = 5
+
+
+class HexFileError(Exception):
+    """Error in the format of a hexadecimal file.
+
+    :param message: description of the error.
+    :type message: str
+    :param line: number of the line of the file, from 1.
+    :type line: int
+    """
+    def __init__(self, message, line=None):
+        super().__init__("line {}: {}".format(line, message) if line else message)
+        self.line = line
+
+
+def parse_records(lines):
+    """Iterate the data of the records of a hexadecimal file, with the extended addresses applied.
+
+    :param lines: iterable of the lines of the file, for example the opened file.
+    :type lines: iterable
+    :return: iterator of (address, data, line) tuples, it raises HexFileError when a record is not valid.
+    :rtype: iterator
+    """
+    base = 0
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        if line[0] != ":":
+            raise HexFileError("the record doesn't start with ':'", number)
+
+        try:
+            record = bytes.fromhex(line[1:])
+        except ValueError:
+            raise HexFileError("invalid hexadecimal digit", number)
+
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise HexFileError("invalid record length", number)
+        if sum(record) & 0xFF:
+            raise HexFileError("invalid checksum", number)
+
+        kind = record[3]
+        if kind == DATA_RECORD:
+            yield base + ((record[1] << 8) | record[2]), record[4:-1], number
+        elif kind == EOF_RECORD:
+            return
+        elif kind in (EXTENDED_SEGMENT_RECORD, EXTENDED_LINEAR_RECORD):
+            if record[0] != 2:
+                raise HexFileError("invalid extended address", number)
+            base = ((record[4] << 8) | record[5]) << (4 if kind == EXTENDED_SEGMENT_RECORD else 16)
+        elif kind not in (START_SEGMENT_RECORD, START_LINEAR_RECORD):
+            raise HexFileError("unknown record type: {}".format(kind), number)
+
+
+class HexImage(object):
+    """Memory image in a flat buffer, with the segments that have data.
+    The buffer grows with each record, so the records are not kept.
+
+    :param records: iterable of (address, data, line) tuples, as parse_records generates.
+                    It raises HexFileError when two records write the same address.
+    :type records: iterable
+    """
+    def __init__(self, records=()):
+        self._start = 0
+        self._buffer = bytearray()
+        self._segments = []
+        for address, data, line in records:
+            if data:
+                self._add(address, data, line)
+
+    def _add(self, address, data, line):
+        end = address + len(data)
+        if not self._buffer:
+            self._start = address
+        elif address < self._start:
+            self._buffer[0:0] = bytes([BLANK_BYTE]) * (self._start - address)
+            self._start = address
+        if end - self._start > len(self._buffer):
+            self._buffer.extend(bytes([BLANK_BYTE]) * (end - self._start - len(self._buffer)))
+
+        if not self._segments or address >= self._segments[-1][1]:
+            """The usual case, the records are ordered by address."""
+            if self._segments and self._segments[-1][1] == address:
+                self._segments[-1][1] = end
+            else:
+                self._segments.append([address, end])
+        else:
+            index = bisect_left([segment[0] for segment in self._segments], end)
+            if index and self._segments[index - 1][1] > address:
+                raise HexFileError("address overlap: 0x{:X}".format(address), line)
+            self._segments.insert(index, [address, end])
+            if index + 1 < len(self._segments) and self._segments[index + 1][0] == end:
+                self._segments[index][1] = self._segments.pop(index + 1)[1]
+            if index and self._segments[index - 1][1] == address:
+                self._segments[index - 1][1] = self._segments.pop(index)[1]
+
+        self._buffer[address - self._start:end - self._start] = data
+
+    def segments(self):
+        """Get the ranges of addresses that have data.
+
+        :return: list of (start, end) tuples, the end address is not included.
+        :rtype: list
+        """
+        return [(start, end) for start, end in self._segments]
+
+    def minaddr(self):
+        """First address with data, 0 when the image is empty.
+
+        :rtype: int
+        """
+        return self._start
+
+    def maxaddr(self):
+        """Last address with data, 0 when the image is empty.
+
+        :rtype: int
+        """
+        return self._start + len(self._buffer) - 1 if self._buffer else 0
+
+    def tobinarray(self, start, size):
+        """Get a region of the image, the addresses without data have the erased value.
+
+        :param start: first address.
+        :type start: int
+        :param size: bytes of the region.
+        :type size: int
+        :return: the bytes of the region.
+        :rtype: bytearray
+        """
+        offset = start - self._start
+        if 0 <= offset and offset + size <= len(self._buffer):
+            return self._buffer[offset:offset + size]
+
+        buffer = bytearray([BLANK_BYTE]) * size
+        low = max(offset, 0)
+        high = min(offset + size, len(self._buffer))
+        if low < high:
+            buffer[low - offset:high - offset] = self._buffer[low:high]
+        return buffer
+
+
+def read_hex(filename):
+    """Read a firmware file in Intel hexadecimal format.
+
+    :param filename: path of the file.
+    :type filename: str
+    :return: the image, it raises HexFileError when the format is not valid, or FileNotFoundError.
+    :rtype: HexImage
+    """
+    with open(filename, encoding="ascii", errors="replace") as file:
+        return HexImage(parse_records(file))
@@ -0,0 +1,89 @@
+'''
+Writer of the memory read from the board, in Intel hexadecimal format or raw binary.
+
+Saving a dump with the IntelHex library needs a dictionary entry per byte before
+the first line is written. The writer formats the records directly from the buffer
+that read_range fills, and can omit the blank regions (0xFF) of the memory, so the
+time of a dump is that of the link.
+
+    buffer = prg.read_range(0, ab.cpu_page_size * ab.cpu_pages)
+    write_hex("dump.hex", buffer, skip_blank=True)
+'''
+from pageplanner import BLANK_BYTE
+
+RECORD_SIZE = 16
+"""Data bytes of each record, as the IntelHex library writes them"""
+
+EOF_LINE = ":00000001FF\n"
+
+
+def _record(kind, address, data):
+    checksum = -(len(data) + (address >> 8) + (address & 0xFF) + kind + sum(data)) & 0xFF
+    return ":{:02X}{:04X}{:02X}{}{:02X}\n".format(len(data), address, kind, data.hex().upper(), checksum)
+
+
+def hex_lines(buffer, start=0, skip_blank=False, record_size=RECORD_SIZE):
+    """Iterate the lines of the Intel hexadecimal file of a memory region.
+    The extended linear address records are added when the region exceeds 64 KB.
+
+    :param buffer: bytes of the region.
+    :type buffer: bytes or bytearray
+    :param start: address of the first byte.
+    :type start: int
+    :param skip_blank: omit the records that only have blank bytes (0xFF).
+    :type skip_blank: bool
+    :param record_size: data bytes of each record.
+    :type record_size: int
+    :return: iterator of the lines, ending with the end of file record.
+    :rtype: iterator
+    """
+    view = memoryview(buffer)
+    blank = bytes([BLANK_BYTE]) * record_size
+    extended = start + len(buffer) > 0x10000
+    segment = None
+    for offset in range(0, len(buffer), record_size):
+        data = view[offset:offset + record_size]
+        if skip_blank and data == blank[:len(data)]:
+            continue
+
+        address = start + offset
+        if extended and address >> 16 != segment:
+            segment = address >> 16
+            yield _record(4, 0, segment.to_bytes(2, "big"))
+        yield _record(0, address & 0xFFFF, data)
+
+    yield EOF_LINE
+
+
+def write_hex(filename, buffer, start=0, skip_blank=False):
+    """Save a memory region in a file in Intel hexadecimal format.
+
+    :param filename: path of the file.
+    :type filename: str
+    :param buffer: bytes of the region.
+    :type buffer: bytes or bytearray
+    :param start: address of the first byte.
+    :type start: int
+    :param skip_blank: omit the blank regions (0xFF) of the memory.
+    :type skip_blank: bool
+    """
+    with open(filename, "w") as file:
+        file.writelines(hex_lines(buffer, start, skip_blank))
+
+
+def write_bin(filename, buffer, skip_blank=False):
+    """Save a memory region in a raw binary file.
+
+    :param filename: path of the file.
+    :type filename: str
+    :param buffer: bytes of the region.
+    :type buffer: bytes or bytearray
+    :param skip_blank: omit the blank bytes (0xFF) at the end of the memory, the blank
+                       regions in the middle are kept to preserve the addresses.
+    :type skip_blank: bool
+    """
+    length = len(buffer)
+    if skip_blank:
+        length = len(bytes(buffer).rstrip(bytes([BLANK_BYTE])))
+    with open(filename, "wb") as file:
+        file.write(memoryview(buffer)[:length])
@@ -0,0 +1,233 @@
+'''
+Manifest of the pages of a firmware image, to verify and update the boards without the file.
+
+The verification and the delta write compare the memory of the board with the pages of
+the image, so they need the hexadecimal file parsed and a buffer per page. The manifest
+has, for a page size, the digest of each page with data, a bitmap of the blank pages and
+the digest of the whole image, in a few bytes per page. It is compiled for the page sizes
+of the cpus in AVR_ATMEL_CPUS, and saved in a JSON file next to the image, that is compiled
+again when the content of the image changes.
+
+    manifests = load_manifest("firmware.hex")
+    if ab.verify_manifest(manifests[ab.cpu_page_size]):
+'''
+import hashlib
+
+from arduinobootloader import AVR_ATMEL_CPUS
+from bootloadercache import JsonCache
+from hexreader import read_hex
+from pageplanner import plan_pages, pages_digest, page_digest
+
+MANIFEST_SUFFIX = ".manifest.json"
+"""Added to the path of the image for the file of its manifests"""
+
+MANIFEST_VERSION = 1
+"""Format of the manifests, the file of another version is compiled again"""
+
+
+def page_sizes(flash=True):
+    """Get the page sizes of the memory of the cpus in AVR_ATMEL_CPUS, the cpus without
+    the eeprom pages are not included.
+
+    :param flash: flash or eeprom memory.
+    :type flash: bool
+    :return: the sizes in bytes, from the smallest.
+    :rtype: list
+    """
+    return sorted({cpu[1] if flash else cpu[3] for cpu in AVR_ATMEL_CPUS.values()} - {0})
+
+
+class PageManifest(object):
+    """Digests of the pages of an image for a page size.
+
+    :param page_size: bytes of each page.
+    :type page_size: int
+    :param image: digest of the pages with data (see pages_digest), the same that write_pages
+                  keeps in the journal and the fingerprints.
+    :type image: str
+    :param start: address of the first page with data.
+    :type start: int
+    :param blank: bitmap of the pages from the first one with data to the last one, with the bit set
+                  when the page is blank or has no data, from the least significant bit of the first byte.
+    :type blank: bytes
+    :param digests: digest of each page with data (see page_digest), ordered by address.
+    :type digests: list
+    """
+    def __init__(self, page_size, image, start=0, blank=b"", digests=()):
+        self._page_size = page_size
+        self._image = image
+        self._start = start
+        self._blank = bytes(blank)
+        self._digests = list(digests)
+
+        addresses = []
+        index = 0
+        while len(addresses) < len(self._digests):
+            if index >= len(self._blank) * 8 or not self._blank[index >> 3] & (1 << (index & 7)):
+                addresses.append(start + index * page_size)
+            index += 1
+        self._pages = dict(zip(addresses, self._digests))
+
+    def __len__(self):
+        return len(self._digests)
+
+    @property
+    def page_size(self):
+        """Bytes of each page.
+
+        :type: int
+        """
+        return self._page_size
+
+    @property
+    def image(self):
+        """Digest of the pages with data of the image.
+
+        :type: str
+        """
+        return self._image
+
+    def pages(self):
+        """Get the pages with data.
+
+        :return: list of (address, digest) tuples ordered by address.
+        :rtype: list
+        """
+        return list(self._pages.items())
+
+    def digest(self, address):
+        """Get the digest of a page.
+
+        :param address: address of the page.
+        :type address: int
+        :return: the digest, None when the page is blank or has no data.
+        :rtype: str
+        """
+        return self._pages.get(address)
+
+    def runs(self):
+        """Group the consecutive pages with data, so that each group can be read with a single read_range.
+
+        :return: iterator of (start, length, pages) tuples, with the (address, digest) tuples of the pages.
+        :rtype: iterator
+        """
+        run = []
+        end = 0
+        for address, digest in self._pages.items():
+            if run and address != end:
+                yield run[0][0], end - run[0][0], run
+                run = []
+            run.append((address, digest))
+            end = address + self._page_size
+
+        if run:
+            yield run[0][0], end - run[0][0], run
+
+    def to_dict(self):
+        """Get the manifest in a dictionary that can be saved in JSON.
+
+        :rtype: dict
+        """
+        return {"page_size": self._page_size, "image": self._image, "start": self._start,
+                "blank": self._blank.hex(), "digests": self._digests}
+
+    @staticmethod
+    def from_dict(entry):
+        """Create the manifest saved with to_dict.
+
+        :param entry: dictionary of the manifest.
+        :type entry: dict
+        :return: the manifest, it raises KeyError, TypeError or ValueError when the dictionary is not valid.
+        :rtype: PageManifest
+        """
+        return PageManifest(entry["page_size"], entry["image"], entry["start"],
+                            bytes.fromhex(entry["blank"]), entry["digests"])
+
+
+def build_manifest(ih, page_size):
+    """Compile the manifest of an image for a page size.
+
+    :param ih: firmware or eeprom image.
+    :type ih: HexImage or IntelHex
+    :param page_size: bytes of each page.
+    :type page_size: int
+    :return: the manifest.
+    :rtype: PageManifest
+    """
+    pages = list(plan_pages(ih, page_size))
+    if not pages:
+        return PageManifest(page_size, pages_digest(pages))
+
+    start = pages[0][0]
+    blank = bytearray(b"\xFF" * ((pages[-1][0] - start) // page_size // 8 + 1))
+    for address, buffer in pages:
+        index = (address - start) // page_size
+        blank[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+    return PageManifest(page_size, pages_digest(pages), start, blank,
+                        [page_digest(address, buffer) for address, buffer in pages])
+
+
+class ManifestFile(JsonCache):
+    """File with the manifests of an image, next to it, with the digest of the content of
+    the image when they were compiled.
+
+    :param filename: path of the image.
+    :type filename: str
+    """
+    def __init__(self, filename):
+        super().__init__(filename + MANIFEST_SUFFIX)
+        self._image_filename = filename
+
+    def manifests(self, sizes, ih=None):
+        """Get the manifests of the image, compiling those that are not in the file or when
+        the image changed.
+
+        :param sizes: page sizes of the manifests.
+        :type sizes: iterable
+        :param ih: image of the file when it was already read, None to read it only when it is needed.
+        :type ih: HexImage or IntelHex
+        :return: dictionary of the manifests by page size, it raises HexFileError when the format
+                 of the image is not valid, or FileNotFoundError.
+        :rtype: dict
+        """
+        with open(self._image_filename, "rb") as file:
+            source = hashlib.sha256(file.read()).hexdigest()
+
+        with self._lock:
+            entries = self._load()
+            if entries.get("version") != MANIFEST_VERSION or entries.get("source") != source or \
+                    not isinstance(entries.get("manifests"), dict):
+                entries = {"version": MANIFEST_VERSION, "source": source, "manifests": {}}
+
+            manifests = {}
+            compiled = False
+            for size in sizes:
+                try:
+                    manifests[size] = PageManifest.from_dict(entries["manifests"][str(size)])
+                except (KeyError, TypeError, ValueError):
+                    if ih is None:
+                        ih = read_hex(self._image_filename)
+                    manifests[size] = build_manifest(ih, size)
+                    entries["manifests"][str(size)] = manifests[size].to_dict()
+                    compiled = True
+
+            if compiled:
+                self._save(entries)
+            return manifests
+
+
+def load_manifest(filename, sizes=None, ih=None):
+    """Get the manifests of a firmware file in Intel hexadecimal format, from the file next
+    to it when the image didn't change, or compiling and saving them.
+
+    :param filename: path of the image.
+    :type filename: str
+    :param sizes: page sizes of the manifests, None for the flash of all the cpus (see page_sizes).
+    :type sizes: iterable
+    :param ih: image of the file when it was already read, None to read it only when it is needed.
+    :type ih: HexImage or IntelHex
+    :return: dictionary of the manifests by page size, it raises HexFileError when the format
+             of the image is not valid, or FileNotFoundError.
+    :rtype: dict
+    """
+    return ManifestFile(filename).manifests(page_sizes() if sizes is None else sizes, ih)
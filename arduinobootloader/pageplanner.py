@@ -0,0 +1,121 @@
+'''
+Plan the pages that have to be written to update the memory of an Arduino board.
+
+The firmware files only contain the addresses used by the program, so instead
+of walking all the pages from address 0 to the end of the image, the planner
+uses the segments of the image to generate the minimal ordered list of page
+aligned write jobs, and discards the pages where every byte is erased (0xFF).
+'''
+import hashlib
+
+BLANK_BYTE = 0xFF
+"""Value of an erased byte of the flash memory"""
+
+
+def page_addresses(segments, page_size):
+    """Get the ordered addresses of the pages that contain at least one byte of the segments.
+
+    :param segments: list of (start, end) tuples, the end address is not included.
+    :type segments: list
+    :param page_size: page size in bytes.
+    :type page_size: int
+    :return: the page aligned start addresses without duplicates.
+    :rtype: list
+    """
+    addresses = []
+    next_page = 0
+    for start, end in sorted(segments):
+        first = max(start - (start % page_size), next_page)
+        for address in range(first, end, page_size):
+            addresses.append(address)
+            next_page = address + page_size
+
+    return addresses
+
+
+def is_blank(buffer):
+    """Check if the buffer only contains erased bytes.
+
+    :param buffer: page data.
+    :type buffer: bytearray
+    :return: True when all the bytes are 0xFF.
+    :rtype: bool
+    """
+    return buffer.count(BLANK_BYTE) == len(buffer)
+
+
+def plan_pages(ih, page_size, skip_blank=True):
+    """Iterate the pages of the image that must be written.
+    The gaps inside a page are filled with the padding value of the image (0xFF by default).
+
+    :param ih: firmware image.
+    :type ih: IntelHex
+    :param page_size: page size in bytes of the memory to write.
+    :type page_size: int
+    :param skip_blank: discard the pages where all the bytes are 0xFF.
+    :type skip_blank: bool
+    :return: iterator of (address, buffer) tuples that can be passed to write_memory.
+    :rtype: iterator
+    """
+    for address in page_addresses(ih.segments(), page_size):
+        buffer = ih.tobinarray(start=address, size=page_size)
+        if skip_blank and is_blank(buffer):
+            continue
+
+        yield address, buffer
+
+
+def page_runs(pages, page_size=None):
+    """Group the consecutive pages, so that each group can be read with a single read_range.
+
+    :param pages: iterable of (address, buffer) tuples ordered by address.
+    :type pages: iterable
+    :param page_size: size of the pages, when the tuples have the digest of the page instead of the buffer.
+    :type page_size: int
+    :return: iterator of (start, length, pages) tuples.
+    :rtype: iterator
+    """
+    run = []
+    start = end = 0
+    for address, buffer in pages:
+        if run and address != end:
+            yield start, end - start, run
+            run = []
+
+        if not run:
+            start = address
+        run.append((address, buffer))
+        end = address + (len(buffer) if page_size is None else page_size)
+
+    if run:
+        yield start, end - start, run
+
+
+def pages_digest(pages):
+    """Identify the content of a sequence of pages, for example to know if a
+    journal of the pages written belongs to the same image.
+
+    :param pages: iterable of (address, buffer) tuples.
+    :type pages: iterable
+    :return: hexadecimal SHA-256 of the addresses and the data of the pages.
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    for address, buffer in pages:
+        digest.update(address.to_bytes(4, "little"))
+        digest.update(buffer)
+    return digest.hexdigest()
+
+
+def page_digest(address, buffer):
+    """Identify the content of a page, for example to compare the page read from the
+    board with a fingerprint of the image written, without keeping the image.
+
+    :param address: address of the page.
+    :type address: int
+    :param buffer: bytes of the page.
+    :type buffer: bytes or bytearray
+    :return: the first 16 hexadecimal digits of the SHA-256 of the address and the data.
+    :rtype: str
+    """
+    return pages_digest([(address, buffer)])[:16]
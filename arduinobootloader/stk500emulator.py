@@ -0,0 +1,413 @@
+'''
+Emulator of the Arduino bootloaders, to exercise the Stk500v1 and Stk500v2
+programmers without hardware.
+
+It implements the subset of the protocols used by the arduinobootloader module,
+backed by the flash and eeprom memories of a CPU of the AVR_ATMEL_CPUS list, and
+models the time of the serial link (baud rate), the latency of each transaction
+(for example the USB adapter) and the time to program a page. It can inject
+errors in the bytes sent to the host, and in the flash pages programmed.
+
+The emulator can be used as the device object of ArduinoBootloader.open, or it
+can be served through a pseudo terminal or a local TCP socket (net: port).
+
+    emulator = BootloaderEmulator("Stk500v1", signature=0x1E950F, latency=0.002)
+    prg = ab.select_programmer("Stk500v1")
+    prg.open(port=emulator)
+'''
+import os
+import random
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+from arduinobootloader import AVR_ATMEL_CPUS, RESP_STK_IN_SYNC, RESP_STK_OK, MESSAGE_START, TOKEN, \
+    STATUS_CMD_OK, CMD_SIGN_ON, CMD_GET_PARAMETER, CMD_SPI_MULTI, CMD_LOAD_ADDRESS, CMD_PROGRAM_FLASH_ISP, \
+    CMD_READ_FLASH_ISP, CMD_PROGRAM_EEPROM_ISP, CMD_READ_EEPROM_ISP, CMD_LEAVE_PROGMODE_ISP, xor_checksum
+
+RESP_STK_NOSYNC = 0x15
+"""Answer of the Stk500v1 when the command doesn't end with the space character"""
+
+STATUS_CMD_FAILED = 0xC0
+"""Answer of the Stk500v2 for the unsupported commands"""
+
+V1_COMMAND_LEN = {ord('0'): 2, ord('A'): 3, ord('1'): 2, ord('u'): 2, ord('U'): 4, ord('t'): 5,
+                  ord('Q'): 2, ord('P'): 2, ord('R'): 2}
+"""Length of the Stk500v1 commands without data, the program page command is variable"""
+
+
+class BootloaderEmulator(object):
+    """Bootloader of an Arduino board with the interface of a serial port.
+
+    :param protocol: Stk500v1 or Stk500v2.
+    :param signature: key of the cpu in AVR_ATMEL_CPUS.
+    :param baudrate: speed of the serial link, None for an infinite speed.
+    :param latency: seconds added to each transaction, from the command to its answer.
+    :param page_write_time: seconds to erase and program a flash page.
+    :param error_rate: probability of corrupting each byte sent to the host.
+    :param seed: seed of the generator of errors, to repeat the results.
+    :param program_error_rate: probability of corrupting a byte of each flash page programmed.
+    :param optiboot: the Stk500v1 read command only uses the low byte of the length (0 is 256),
+                     as Optiboot. False for the 16 bits length of ATmegaBOOT.
+    """
+    def __init__(self, protocol="Stk500v1", signature=0x1E950F, baudrate=115200, latency=0.0,
+                 page_write_time=0.0, error_rate=0.0, seed=None, program_error_rate=0.0, optiboot=True):
+        cpu = AVR_ATMEL_CPUS[signature]
+        self.protocol = protocol
+        self.signature = signature
+        self.flash = bytearray(b'\xff' * (cpu[1] * cpu[2]))
+        self.eeprom = bytearray(b'\xff' * (cpu[3] * cpu[4]))
+        self.byte_time = 10 / baudrate if baudrate else 0
+        self.latency = latency
+        self.page_write_time = page_write_time
+        self.error_rate = error_rate
+        self.program_error_rate = program_error_rate
+        self.optiboot = optiboot
+        self.random = random.Random(seed)
+        self.hw_version = 2
+        self.sw_major = 8
+        self.sw_minor = 0
+        self.timeout = 1
+        self.is_open = True
+        self.transactions = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.errors_injected = 0
+        self.pages_corrupted = 0
+        self._dtr = False
+        self._rts = False
+        self._input = bytearray()
+        self._output = deque()
+        self._link_free = 0
+        self._address = 0
+        self._lock = threading.Lock()
+
+    @property
+    def dtr(self):
+        return self._dtr
+
+    @dtr.setter
+    def dtr(self, value):
+        """The falling edge of DTR resets the board and starts the bootloader."""
+        if self._dtr and not value:
+            self.reset()
+        self._dtr = value
+
+    @property
+    def rts(self):
+        return self._rts
+
+    @rts.setter
+    def rts(self, value):
+        self._rts = value
+
+    @property
+    def in_waiting(self):
+        now = time.monotonic()
+        with self._lock:
+            return sum(len(data) for ready, data in self._output if ready <= now)
+
+    def reset(self):
+        """Restart the bootloader, the pending bytes are lost."""
+        with self._lock:
+            self._input.clear()
+            self._output.clear()
+            self._address = 0
+
+    def close(self):
+        self.is_open = False
+
+    def reset_input_buffer(self):
+        """Discard the bytes already received by the host."""
+        now = time.monotonic()
+        with self._lock:
+            while self._output and self._output[0][0] <= now:
+                self._output.popleft()
+
+    def write(self, data):
+        """Receive the bytes of the host, and process the complete commands."""
+        now = time.monotonic()
+        with self._lock:
+            self.transactions += 1
+            self.bytes_received += len(data)
+            self._link_free = max(now, self._link_free) + len(data) * self.byte_time
+            self._input += data
+            self._process()
+        return len(data)
+
+    def read(self, size):
+        """Wait until the bytes are sent by the bootloader or the timeout expires.
+
+        :param size: bytes to read.
+        :type size: int
+        :return: the received bytes.
+        :rtype: bytes
+        """
+        deadline = time.monotonic() + (self.timeout if self.timeout is not None else 3600)
+        data = bytearray()
+        while len(data) < size:
+            with self._lock:
+                ready = self._output[0][0] if self._output else None
+
+            if ready is None or ready > deadline:
+                time.sleep(max(deadline - time.monotonic(), 0))
+                break
+
+            delay = ready - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self._lock:
+                if not self._output:
+                    continue
+                ready, chunk = self._output[0]
+                needed = size - len(data)
+                data += chunk[:needed]
+                if len(chunk) > needed:
+                    self._output[0] = (ready, chunk[needed:])
+                else:
+                    self._output.popleft()
+
+        return bytes(data)
+
+    def pop_ready(self):
+        """Get the bytes that the bootloader already sent, used by the servers.
+
+        :return: the bytes and the time when the next bytes will be sent, or None.
+        :rtype: tuple
+        """
+        now = time.monotonic()
+        data = bytearray()
+        with self._lock:
+            while self._output and self._output[0][0] <= now:
+                data += self._output.popleft()[1]
+            next_ready = self._output[0][0] if self._output else None
+        return bytes(data), next_ready
+
+    def _send(self, data, busy=0.0):
+        """Queue an answer, available when the link transfers its last byte."""
+        data = bytearray(data)
+        if self.error_rate:
+            for i in range(len(data)):
+                if self.random.random() < self.error_rate:
+                    data[i] ^= 1 << self.random.randrange(8)
+                    self.errors_injected += 1
+
+        start = self._link_free + self.latency + busy
+        self._link_free = start + len(data) * self.byte_time
+        self.bytes_sent += len(data)
+        self._output.append((self._link_free, bytes(data)))
+
+    def _process(self):
+        if self.protocol == "Stk500v1":
+            while self._input and self._process_v1():
+                pass
+        else:
+            while self._input and self._process_v2():
+                pass
+
+    def _program_flash(self, start, data):
+        """Program a flash page, with a wrong byte when an error is injected."""
+        self.flash[start:start + len(data)] = data
+        if data and self.program_error_rate and self.random.random() < self.program_error_rate:
+            self.flash[start + self.random.randrange(len(data))] ^= 0x01
+            self.pages_corrupted += 1
+
+    def _process_v1(self):
+        """Process one Stk500v1 command.
+
+        :return: False when the command is not complete.
+        :rtype: bool
+        """
+        buff = self._input
+        cmd = buff[0]
+        if cmd == ord('d'):
+            if len(buff) < 4:
+                return False
+            cmd_len = 4 + ((buff[1] << 8) | buff[2]) + 1
+        elif cmd in V1_COMMAND_LEN:
+            cmd_len = V1_COMMAND_LEN[cmd]
+        else:
+            """Noise or unsupported command, wait for the next valid one."""
+            del buff[0]
+            return True
+
+        if len(buff) < cmd_len:
+            return False
+
+        msg = bytes(buff[:cmd_len])
+        del buff[:cmd_len]
+
+        if msg[-1] != ord(' '):
+            self._send([RESP_STK_NOSYNC])
+            return True
+
+        busy = 0.0
+        answer = b''
+        if cmd == ord('A'):
+            answer = bytes([{0x80: self.hw_version, 0x81: self.sw_major, 0x82: self.sw_minor}.get(msg[1], 0)])
+        elif cmd == ord('u'):
+            answer = self.signature.to_bytes(3, 'big')
+        elif cmd == ord('U'):
+            self._address = msg[1] | (msg[2] << 8)
+        elif cmd == ord('d'):
+            data = msg[4:-1]
+            if msg[3] == ord('F'):
+                self._program_flash(self._address * 2, data)
+                busy = self.page_write_time
+            else:
+                self.eeprom[self._address:self._address + len(data)] = data
+        elif cmd == ord('t'):
+            count = (msg[1] << 8) | msg[2]
+            if self.optiboot:
+                """Optiboot keeps the length in an uint8_t, the high byte is ignored."""
+                count = msg[2] or 256
+            if msg[3] == ord('F'):
+                start = self._address * 2
+                answer = bytes(self.flash[start:start + count])
+            else:
+                answer = bytes(self.eeprom[self._address:self._address + count])
+
+        self._send(bytes([RESP_STK_IN_SYNC]) + answer + bytes([RESP_STK_OK]), busy)
+        return True
+
+    def _process_v2(self):
+        """Process one Stk500v2 frame.
+
+        :return: False when the frame is not complete.
+        :rtype: bool
+        """
+        buff = self._input
+        start = buff.find(MESSAGE_START)
+        if start < 0:
+            buff.clear()
+            return False
+        del buff[:start]
+
+        if len(buff) < 5:
+            return False
+        if buff[4] != TOKEN:
+            del buff[0]
+            return True
+
+        frame_len = 5 + ((buff[2] << 8) | buff[3]) + 1
+        if len(buff) < frame_len:
+            return False
+
+        frame = bytes(buff[:frame_len])
+        del buff[:frame_len]
+        if xor_checksum(frame):
+            """The bootloader ignores the frames with checksum errors."""
+            return True
+
+        sequence = frame[1]
+        body = frame[5:-1]
+        cmd = body[0]
+        busy = 0.0
+        answer = bytes([cmd, STATUS_CMD_OK])
+        if cmd == CMD_SIGN_ON:
+            answer += bytes([8]) + b"AVRISP_2"
+        elif cmd == CMD_GET_PARAMETER:
+            answer += bytes([{0x90: self.hw_version, 0x91: self.sw_major, 0x92: self.sw_minor}.get(body[1], 0)])
+        elif cmd == CMD_SPI_MULTI:
+            sig = self.signature.to_bytes(3, 'big')[body[6]] if body[6] < 3 else 0
+            answer += bytes([0, body[4], 0, sig, STATUS_CMD_OK])
+        elif cmd == CMD_LOAD_ADDRESS:
+            address = int.from_bytes(body[1:5], 'big') & 0x7FFFFFFF
+            self._address = address
+        elif cmd in (CMD_PROGRAM_FLASH_ISP, CMD_PROGRAM_EEPROM_ISP):
+            count = (body[1] << 8) | body[2]
+            data = body[10:10 + count]
+            if cmd == CMD_PROGRAM_FLASH_ISP:
+                self._program_flash(self._address * 2, data)
+                self._address += count // 2
+                busy = self.page_write_time
+            else:
+                self.eeprom[self._address:self._address + count] = data
+                self._address += count
+        elif cmd in (CMD_READ_FLASH_ISP, CMD_READ_EEPROM_ISP):
+            count = (body[1] << 8) | body[2]
+            if cmd == CMD_READ_FLASH_ISP:
+                start = self._address * 2
+                answer += bytes(self.flash[start:start + count])
+                self._address += count // 2
+            else:
+                answer += bytes(self.eeprom[self._address:self._address + count])
+                self._address += count
+            answer += bytes([STATUS_CMD_OK])
+        elif cmd != CMD_LEAVE_PROGMODE_ISP:
+            answer = bytes([cmd, STATUS_CMD_FAILED])
+
+        head = bytes([MESSAGE_START, sequence, (len(answer) >> 8) & 0xFF, len(answer) & 0xFF, TOKEN])
+        self._send(head + answer + bytes([xor_checksum(head + answer)]), busy)
+        return True
+
+
+def _pump(emulator, recv, send, fileno, stop):
+    """Move the bytes between a file descriptor and the emulator, respecting the time of each answer."""
+    next_ready = None
+    while not stop.is_set():
+        wait = 0.1 if next_ready is None else max(next_ready - time.monotonic(), 0)
+        rin, _, _ = select.select([fileno], [], [], wait)
+        if rin:
+            data = recv()
+            if not data:
+                break
+            emulator.write(data)
+
+        data, next_ready = emulator.pop_ready()
+        if data:
+            send(data)
+
+
+class EmulatorPty(object):
+    """Serve the emulator through a pseudo terminal, the port name is in the port attribute."""
+    def __init__(self, emulator):
+        import tty
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=_pump, daemon=True,
+                                        args=(emulator, lambda: os.read(self._master, 4096),
+                                              lambda data: os.write(self._master, data), self._master, self._stop))
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+
+class EmulatorServer(object):
+    """Serve the emulator through a local TCP socket, use the port attribute as net:127.0.0.1:port.
+    Each new connection resets the bootloader as a network serial server does."""
+    def __init__(self, emulator, host="127.0.0.1", port=0):
+        self._emulator = emulator
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(1)
+        self.port = self._listener.getsockname()[1]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while not self._stop.is_set():
+            rin, _, _ = select.select([self._listener], [], [], 0.1)
+            if not rin:
+                continue
+            conn, _ = self._listener.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._emulator.reset()
+            with conn:
+                _pump(self._emulator, lambda: conn.recv(4096), conn.sendall, conn.fileno(), self._stop)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._listener.close()
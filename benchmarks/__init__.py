@@ -0,0 +1,13 @@
+'''
+Benchmarks of the arduinobootloader module.
+
+    python -m benchmarks.codec          CPU cost per frame of the Stk500v2 codec
+    python -m benchmarks.hexparse       load of a firmware file and planning of its pages, and dump
+    python -m benchmarks.throughput     write, verify and dump against the emulator
+'''
+import os
+import sys
+
+"""The modules of the library are flat, in the arduinobootloader directory, that would be
+imported as a namespace package from the root of the repository."""
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "arduinobootloader"))
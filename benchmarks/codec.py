@@ -0,0 +1,97 @@
+'''
+Microbenchmark of the CPU cost per frame of the Stk500v2 codec.
+
+Compares the FrameCodec with the previous implementation, that built a new
+buffer per command, calculated the checksum byte by byte and shifted the
+answer to remove the command and status.
+
+    python -m benchmarks.codec
+'''
+import argparse
+import os
+import timeit
+
+from arduinobootloader import FrameCodec, MESSAGE_START, TOKEN, STATUS_CMD_OK, \
+    CMD_PROGRAM_FLASH_ISP, CMD_READ_FLASH_ISP
+
+
+def legacy_encode(sequence, cmd, data=None):
+    """Build a command as the previous version of Stk500v2._send_command."""
+    buff = bytearray(5)
+    checksum = 0
+    data_len = 1 if data is None else len(data) + 1
+
+    buff[0] = MESSAGE_START
+    buff[1] = sequence
+    buff[2] = ((data_len >> 8) & 0xFF)
+    buff[3] = (data_len & 0xFF)
+    buff[4] = TOKEN
+    buff.append(cmd)
+    if not data is None:
+        buff.extend(data)
+
+    for val in buff:
+        checksum ^= val
+
+    buff.append(checksum)
+    return buff
+
+
+def legacy_decode(head, body):
+    """Validate an answer as the previous version of Stk500v2._recv_answer."""
+    head = bytearray(head)
+    answer = bytearray(body)
+    answ_chk = answer[-1]
+    del answer[-1]
+
+    head.extend(answer)
+
+    checksum = MESSAGE_START
+    for val in head:
+        checksum ^= val
+    del answer[0]
+    del answer[0]
+
+    return answer if checksum == answ_chk else None
+
+
+def read_answer(page_size):
+    """Build the answer of a read flash command of one page."""
+    frame = FrameCodec().encode(1, CMD_READ_FLASH_ISP, bytes([STATUS_CMD_OK]) + os.urandom(page_size) +
+                                bytes([STATUS_CMD_OK]))
+    return bytes(frame[1:5]), bytes(frame[5:])
+
+
+def run(page_size, number):
+    """Measure the microseconds per frame of each implementation.
+
+    :return: list of (name, legacy, codec) tuples.
+    :rtype: list
+    """
+    codec = FrameCodec()
+    page = bytearray(9) + os.urandom(page_size)
+    head, body = read_answer(page_size)
+    assert bytes(codec.decode(head, body)) == bytes(legacy_decode(head, body))
+    assert bytes(codec.encode(1, CMD_PROGRAM_FLASH_ISP, page)) == bytes(legacy_encode(1, CMD_PROGRAM_FLASH_ISP, page))
+
+    cases = [("encode program page", lambda: legacy_encode(1, CMD_PROGRAM_FLASH_ISP, page),
+              lambda: codec.encode(1, CMD_PROGRAM_FLASH_ISP, page)),
+             ("decode read page", lambda: legacy_decode(head, body), lambda: codec.decode(head, body))]
+
+    results = []
+    for name, legacy, new in cases:
+        legacy_time = min(timeit.repeat(legacy, number=number, repeat=5)) / number * 1e6
+        new_time = min(timeit.repeat(new, number=number, repeat=5)) / number * 1e6
+        results.append((name, legacy_time, new_time))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stk500v2 codec microbenchmark")
+    parser.add_argument("-s", "--page-size", type=int, default=256, help="page size in bytes")
+    parser.add_argument("-n", "--number", type=int, default=2000, help="frames per measure")
+    args = parser.parse_args()
+
+    print("{:<22}{:>12}{:>12}{:>10}".format("frame", "before us", "after us", "speedup"))
+    for name, legacy_time, new_time in run(args.page_size, args.number):
+        print("{:<22}{:>12.2f}{:>12.2f}{:>9.1f}x".format(name, legacy_time, new_time, legacy_time / new_time))
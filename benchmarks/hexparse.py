@@ -0,0 +1,95 @@
+'''
+Benchmark of the load of a firmware file and the planning of its pages,
+and of the save of the memory read from the board.
+
+Compares the IntelHex library, that keeps a dictionary entry per byte, with
+the streaming reader of the hexreader module. The pages are planned twice,
+as the write and the verification do. The dump compares the dictionary that
+the script built with the writer of the hexwriter module.
+
+    python -m benchmarks.hexparse -s 262144
+'''
+import argparse
+import os
+import random
+import tempfile
+import timeit
+
+from intelhex import IntelHex
+from hexreader import read_hex
+from hexwriter import write_hex
+from pageplanner import plan_pages
+
+
+def write_image(filename, size, seed=0):
+    """Write a firmware file without blank pages."""
+    generator = random.Random(seed)
+    ih = IntelHex()
+    ih.frombytes(bytes(generator.randrange(255) for _ in range(size)))
+    ih.tofile(filename, format='hex')
+
+
+def load_intelhex(filename, page_size):
+    ih = IntelHex()
+    ih.fromfile(filename, format='hex')
+    for _ in range(2):
+        for address, buffer in plan_pages(ih, page_size):
+            pass
+
+
+def load_hexreader(filename, page_size):
+    image = read_hex(filename)
+    for _ in range(2):
+        for address, buffer in plan_pages(image, page_size):
+            pass
+
+
+def dump_intelhex(filename, buffer):
+    dict_hex = dict()
+    for i in range(0, len(buffer)):
+        dict_hex[i] = buffer[i]
+
+    dict_hex["start_addr"] = 0
+    ih = IntelHex()
+    ih.fromdict(dict_hex)
+    ih.tofile(filename, 'hex')
+
+
+def dump_hexwriter(filename, buffer):
+    write_hex(filename, buffer)
+
+
+def measure(functions, arguments, number):
+    """Print the best time of each function and the speedup of the second."""
+    results = []
+    for name, function in functions:
+        seconds = min(timeit.repeat(lambda: function(*arguments), number=1, repeat=number))
+        results.append(seconds)
+        print("{:<12}{:>10.1f} ms".format(name, seconds * 1000))
+
+    print("speedup: {:.1f}x".format(results[0] / results[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="hexadecimal file load and dump benchmark")
+    parser.add_argument("-s", "--size", type=int, default=256 * 1024, help="bytes of the image")
+    parser.add_argument("-p", "--page-size", type=int, default=256, help="bytes of the flash page")
+    parser.add_argument("-n", "--number", type=int, default=5, help="loads and dumps measured")
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "image.hex")
+        write_image(filename, options.size)
+
+        print("load")
+        measure((("intelhex", load_intelhex), ("hexreader", load_hexreader)),
+                (filename, options.page_size), options.number)
+
+        buffer = bytes(random.Random(1).randrange(256) for _ in range(options.size))
+        print("dump")
+        measure((("intelhex", dump_intelhex), ("hexwriter", dump_hexwriter)),
+                (filename, buffer), options.number)
+
+
+if __name__ == '__main__':
+    main()
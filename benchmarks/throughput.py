@@ -0,0 +1,225 @@
+'''
+Throughput benchmark of the programmers against the bootloader emulator.
+
+Each scenario combines a protocol, a cpu geometry and a transport (a pseudo
+terminal for the serial port, or a local TCP socket for net:), and measures
+the full flash write, the verification and the dump of the memory.
+With --verify it also measures the write with each verification strategy,
+to compare their cost, for example with --program-error-rate.
+
+    python -m benchmarks.throughput -o after.json --compare before.json
+    python -m benchmarks.throughput -v after -v interleaved -v sampled --program-error-rate 0.01
+
+By default the emulator doesn't model the serial link, so the results show the
+cost of the host side and the round trips. Use --baudrate and --latency to
+simulate a real board.
+'''
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+from intelhex import IntelHex
+from arduinobootloader import ArduinoBootloader, AVR_ATMEL_CPUS, VERIFY_STRATEGIES
+from pageplanner import plan_pages, page_runs
+from stk500emulator import BootloaderEmulator, EmulatorPty, EmulatorServer
+
+SCENARIOS = [("Stk500v1", 0x1E950F), ("Stk500v2", 0x1E950F), ("Stk500v2", 0x1E9801)]
+"""Protocol and cpu signature, the Stk500v1 protocol only addresses 128 K bytes"""
+
+TRANSPORTS = ["serial", "net"]
+
+METRICS = {"bytes_per_s": 1, "pages_per_s": 1, "round_trips_per_page": -1, "cpu_ms_per_kb": -1}
+"""Metrics compared between runs, and the sign of the change that is an improvement"""
+
+
+def random_image(size, seed=0):
+    """Firmware image without blank pages.
+
+    :param size: bytes of the image.
+    :type size: int
+    :return: the image.
+    :rtype: IntelHex
+    """
+    generator = random.Random(seed)
+    ih = IntelHex()
+    ih.frombytes(bytes(generator.randrange(255) for _ in range(size)))
+    return ih
+
+
+def start_transport(transport, emulator):
+    """Serve the emulator.
+
+    :return: the port to open, and the server to close.
+    :rtype: tuple
+    """
+    if transport == "net":
+        server = EmulatorServer(emulator)
+        return "net:127.0.0.1:{}".format(server.port), server
+
+    server = EmulatorPty(emulator)
+    return server.port, server
+
+
+def measure(emulator, pages, operation):
+    """Run an operation and calculate its metrics.
+
+    :param operation: function that returns the transferred bytes, or None on error.
+    :return: the metrics of the operation.
+    :rtype: dict
+    """
+    transactions = emulator.transactions
+    cpu = time.thread_time()
+    start = time.perf_counter()
+    transferred = operation()
+    seconds = time.perf_counter() - start
+    cpu = time.thread_time() - cpu
+
+    if transferred is None:
+        raise RuntimeError("the operation failed")
+
+    return {"bytes": transferred,
+            "pages": pages,
+            "seconds": seconds,
+            "bytes_per_s": transferred / seconds,
+            "pages_per_s": pages / seconds,
+            "round_trips_per_page": (emulator.transactions - transactions) / pages,
+            "cpu_ms_per_kb": cpu * 1000 / (transferred / 1024)}
+
+
+def run_scenario(protocol, signature, transport, options):
+    """Write, verify and dump the flash memory of an emulated board.
+
+    :return: the results of each operation.
+    :rtype: list
+    """
+    cpu = AVR_ATMEL_CPUS[signature]
+    page_size = cpu[1]
+    size = min(options.size, cpu[1] * cpu[2]) if options.size else cpu[1] * cpu[2]
+    pages = list(plan_pages(random_image(size), page_size))
+
+    emulator = BootloaderEmulator(protocol, signature, baudrate=options.baudrate, latency=options.latency,
+                                  page_write_time=options.page_write_time, seed=0)
+    port, server = start_transport(transport, emulator)
+    ab = ArduinoBootloader()
+    prg = ab.select_programmer(protocol)
+    try:
+        if not prg.open(port=port, speed=115200) or not prg.cpu_signature():
+            raise RuntimeError("could not connect with the emulator")
+
+        def write():
+            return len(pages) * page_size if ab.write_pages(pages) else None
+
+        def verify():
+            transferred = 0
+            for start, length, run in page_runs(pages):
+                buffer = prg.read_range(start, length)
+                if buffer is None or any(buffer[address - start:address - start + len(data)] != data
+                                         for address, data in run):
+                    return None
+                transferred += length
+            return transferred
+
+        def dump():
+            buffer = prg.read_range(0, size)
+            return len(buffer) if buffer is not None else None
+
+        def write_verify(strategy):
+            """The programming errors are only injected in the writes that are verified."""
+            def operation():
+                emulator.program_error_rate = options.program_error_rate
+                try:
+                    return size if ab.write_pages(pages, verify=strategy) else None
+                finally:
+                    emulator.program_error_rate = 0.0
+            return operation
+
+        name = "{} {} {}".format(protocol, cpu[0], transport)
+        results = []
+        operations = [("write", write), ("verify", verify), ("dump", dump)]
+        operations += [("w+" + strategy, write_verify(strategy)) for strategy in options.verify or []]
+        for operation, function in operations:
+            metrics = measure(emulator, size // page_size, function)
+            metrics.update(scenario=name, operation=operation)
+            results.append(metrics)
+
+        prg.leave_bootloader()
+        return results
+    finally:
+        prg.close()
+        server.close()
+
+
+def compare(results, baseline, threshold):
+    """Find the metrics that are worse than the baseline.
+
+    :param threshold: percentage of change that is considered a regression.
+    :return: list of (scenario, operation, metric, before, after) tuples.
+    :rtype: list
+    """
+    before = {(result["scenario"], result["operation"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = before.get((result["scenario"], result["operation"]))
+        if old is None:
+            continue
+
+        for metric, sign in METRICS.items():
+            if old[metric] and sign * (result[metric] - old[metric]) / old[metric] * 100 < -threshold:
+                regressions.append((result["scenario"], result["operation"], metric, old[metric], result[metric]))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="programmers throughput benchmark")
+    parser.add_argument("-t", "--transport", choices=TRANSPORTS, action="append", help="transport, can be repeated")
+    parser.add_argument("-s", "--size", type=int, default=0, help="bytes of the image, 0 for the full flash")
+    parser.add_argument("-b", "--baudrate", type=int, default=0, help="emulated baudrate, 0 for an infinite speed")
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="emulated seconds per transaction")
+    parser.add_argument("-w", "--page-write-time", type=float, default=0.0, help="emulated seconds per page")
+    parser.add_argument("-v", "--verify", choices=VERIFY_STRATEGIES, action="append",
+                        help="measure the write with a verification strategy, can be repeated")
+    parser.add_argument("--program-error-rate", type=float, default=0.0,
+                        help="emulated probability of a wrong byte in each page programmed")
+    parser.add_argument("-o", "--output", help="save the results in a JSON file")
+    parser.add_argument("-c", "--compare", help="JSON file of a previous run")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percentage to flag a regression")
+    options = parser.parse_args()
+
+    results = []
+    print("{:<32}{:<14}{:>10}{:>10}{:>12}{:>12}".format("scenario", "", "bytes/s", "pages/s", "trips/page",
+                                                       "cpu ms/KB"))
+    for transport in options.transport or TRANSPORTS:
+        for protocol, signature in SCENARIOS:
+            for result in run_scenario(protocol, signature, transport, options):
+                print("{:<32}{:<14}{:>10.0f}{:>10.1f}{:>12.2f}{:>12.3f}".format(
+                    result["scenario"], result["operation"], result["bytes_per_s"], result["pages_per_s"],
+                    result["round_trips_per_page"], result["cpu_ms_per_kb"]))
+                results.append(result)
+
+    report = {"python": platform.python_version(),
+              "platform": platform.platform(),
+              "options": vars(options),
+              "results": results}
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if options.compare:
+        with open(options.compare) as file:
+            regressions = compare(results, json.load(file), options.threshold)
+
+        for scenario, operation, metric, before, after in regressions:
+            print("regression: {} {} {} {:.3f} -> {:.3f}".format(scenario, operation, metric, before, after))
+        if regressions:
+            return 1
+        print("no regressions")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
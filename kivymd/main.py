@@ -8,9 +8,9 @@ from kivymd.app import MDApp
 import threading
 from queue import Queue
 
-from intelhex import IntelHex
-from intelhex import AddressOverlapError
 from arduinobootloader import ArduinoBootloader
+from hexreader import read_hex, HexImage, HexFileError
+from pageplanner import plan_pages
 
 
 KV = '''
@@ -86,10 +86,32 @@ Screen:
                 helper_text_mode: "on_focus"
                 text:"test.hex"
         
+        MDBoxLayout:
+            orientation:"horizontal"
+            padding:10
+            spacing:10
+            
+            MDLabel:
+                text:"Only write the pages that changed (delta)"
+            MDCheckbox:
+                id:delta
+                size_hint:None, None
+                size:"48dp", "48dp"
+                active:False
+                on_active:app.on_delta(self.active)
+        
         MDBoxLayout:
             orientation: "horizontal"
             ScrollView:
                 MDList:
+
+                    ThreeLineAvatarListItem:
+                        on_release: app.on_sel_programmer(None, None)
+                        text: "Automatic detection"
+                        secondary_text: "tries the protocols and baudrates of the bootloaders"
+                        tertiary_text: "remembers the one found for each adapter"
+                        ImageLeftWidget:
+                            source: "images/arduino-nano.png"
                                      
                     ThreeLineAvatarListItem:
                         on_release: app.on_sel_programmer(115200, "Stk500v1")  
@@ -141,12 +163,14 @@ Screen:
 class MainApp(MDApp):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.ih = IntelHex()
+        self.ih = HexImage()
         self.ab = ArduinoBootloader()
         self.working_thread = None
         self.progress_queue = Queue(100)
-        self.protocol = "Stk500v1"
-        self.baudrate = 115200
+        self.protocol = None
+        self.baudrate = None
+        self.delta = False
+        self.verify = "after"
 
     def build(self):
         return Builder.load_string(KV)
@@ -155,17 +179,19 @@ class MainApp(MDApp):
         self.baudrate = baudrate
         self.protocol = protocol
 
+    def on_delta(self, active):
+        self.delta = active
+
     def on_flash(self):
         del self.ih
 
         try:
-            self.ih = IntelHex()
-            self.ih.fromfile(self.root.ids.file_name.text, format='hex')
+            self.ih = read_hex(self.root.ids.file_name.text)
         except FileNotFoundError:
             self.root.ids.file_info.text = "File not found"
             return
-        except AddressOverlapError:
-            self.root.ids.file_info.text = "File with address overlapped"
+        except HexFileError as e:
+            self.root.ids.file_info.text = "File format error, {}".format(e)
             return
 
         self.root.ids.file_info.text = "start address: {} size: {} bytes".format(self.ih.minaddr(), self.ih.maxaddr())
@@ -186,10 +212,16 @@ class MainApp(MDApp):
         on the Old or New version, the communication speed varies, for the new one you 
         have to use 115200 and for the old 57600.
         
-        The communication protocol for boards based on Mega 2560 is Stk500v2 at 115200."""
-        prg = self.ab.select_programmer(self.protocol)
+        The communication protocol for boards based on Mega 2560 is Stk500v2 at 115200.
+        Without selection, autodetect tries them and remembers the one found for the adapter."""
+        if self.protocol is None:
+            prg = self.ab.autodetect()
+        else:
+            prg = self.ab.select_programmer(self.protocol)
+            if not prg.open(speed=self.baudrate):
+                prg = None
 
-        if prg.open(speed=self.baudrate):
+        if prg is not None:
             if prg.board_request():
                 self.progress_queue.put(["board_request"])
                 Clock.schedule_once(self.progress_callback, 1 / 1000)
@@ -198,31 +230,21 @@ class MainApp(MDApp):
                 self.progress_queue.put(["cpu_signature"])
                 Clock.schedule_once(self.progress_callback, 1 / 1000)
 
-            """Iterate the firmware file into chunks of the page size in bytes, and 
-               use the write flash command to update the cpu."""
-            for address in range(0, self.ih.maxaddr(), self.ab.cpu_page_size):
-                buffer = self.ih.tobinarray(start=address, size=self.ab.cpu_page_size)
-                res_val = prg.write_memory(buffer, address)
-                if not res_val:
-                    break
+            """Iterate the pages of the firmware file that have data, and use the write
+               flash command to update the cpu. In delta mode the pages that already
+               have the same content are not written. With the interleaved verification
+               each page is read back after writing it, and the write stops at the first
+               page that can't be fixed."""
+            pages = list(plan_pages(self.ih, self.ab.cpu_page_size))
+            res_val = self.ab.write_pages(pages, delta=self.delta, progress=self.write_progress,
+                                          verify="none" if self.verify == "after" else self.verify)
 
-                self.progress_queue.put(["write", address / self.ih.maxaddr()])
-                Clock.schedule_once(self.progress_callback, 1 / 1000)
-
-            """If the write was successful, re-iterate the firmware file, and use the 
+            """If the write was successful, re-iterate the written pages, and use the 
                read flash command to update and compare them."""
-            if res_val:
-                for address in range(0, self.ih.maxaddr(), self.ab.cpu_page_size):
-                    buffer = self.ih.tobinarray(start=address, size=self.ab.cpu_page_size)
-                    read_buffer = prg.read_memory(address, self.ab.cpu_page_size)
-                    if not len(read_buffer) or (buffer != read_buffer):
-                        res_val = False
-                        break
-
-                    self.progress_queue.put(["read", address / self.ih.maxaddr()])
-                    Clock.schedule_once(self.progress_callback, 1 / 1000)
-
-            self.progress_queue.put(["result", "ok" if res_val else "error", address])
+            if res_val and self.verify == "after":
+                res_val = self.ab.verify_pages(pages, progress=self.read_progress)
+
+            self.progress_queue.put(["result", "ok" if res_val else "error", self.ab.mismatch_address])
             Clock.schedule_once(self.progress_callback, 1 / 1000)
 
             prg.leave_bootloader()
@@ -232,13 +254,25 @@ class MainApp(MDApp):
             self.progress_queue.put(["open_error"])
             Clock.schedule_once(self.progress_callback, 1 / 1000)
 
+    def write_progress(self, address):
+        self.progress_queue.put(["write", address / self.ih.maxaddr()])
+        Clock.schedule_once(self.progress_callback, 1 / 1000)
+
+    def read_progress(self, address):
+        self.progress_queue.put(["read", min(address / self.ih.maxaddr(), 1)])
+        Clock.schedule_once(self.progress_callback, 1 / 1000)
+
     def progress_callback(self, dt):
         """In kivy only the main thread can update the widgets. Schedule a clock
            event to read the message from the queue and update the progress."""
         value = self.progress_queue.get()
 
         if value[0] == "open_error":
-            self.root.ids.status.text = "Can't open bootloader {} at baudrate {}".format(self.protocol, self.baudrate)
+            if self.protocol is None:
+                self.root.ids.status.text = "Can't detect the bootloader"
+            else:
+                self.root.ids.status.text = "Can't open bootloader {} at baudrate {}".format(self.protocol,
+                                                                                              self.baudrate)
 
         if value[0] == "board_request":
             self.root.ids.sw_version.text = self.ab.sw_version
@@ -257,11 +291,15 @@ class MainApp(MDApp):
             self.root.ids.progress.value = value[1]
 
         if value[0] == "result" and value[1] == "ok":
-            self.root.ids.status.text = "Download done"
+            self.root.ids.status.text = "Download done, pages written: {} skipped: {}".format(
+                self.ab.pages_written, self.ab.pages_skipped)
             self.root.ids.progress.value = 1
 
         if value[0] == "result" and value[1] == "error":
-            self.root.ids.status.text = "Error writing"
+            if value[2] is not None:
+                self.root.ids.status.text = "Error, the page 0x{:X} doesn't match".format(value[2])
+            else:
+                self.root.ids.status.text = "Error writing"
 
 
 MainApp().run()
@@ -2,140 +2,435 @@
 
 """Arduino flash memory utility.
    It is used to write / verify and read the flash memory of an Arduino board.
-   The input / output file format is Intel Hexadecimal."""
+   The input / output file format is Intel Hexadecimal, the memory read can also
+   be saved in raw binary with the .bin extension.
+   Several boards can be updated at the same time repeating the device option,
+   with a pattern (for example /dev/ttyUSB*) or with --all, and several operations
+   can be done in the same connection with the board repeating -U memory:op:file."""
 
-VERSION = '0.3.0'
+VERSION = '0.4.0'
 
 import argparse
+import glob
+import json
 import sys
-
-from intelhex import IntelHex
-from intelhex import AddressOverlapError, HexRecordError
-from arduinobootloader import ArduinoBootloader
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from arduinobootloader import ArduinoBootloader, HANDSHAKE_PROFILES, VERIFY_STRATEGIES, FINGERPRINT_SAMPLES
+from bootloadercache import FlashJournal, FingerprintStore
+from bootloaderstats import SessionTrace
+from bootloadersession import BootloaderSession
+from hexreader import read_hex, HexFileError
+from hexwriter import write_hex, write_bin
+from manifest import build_manifest, load_manifest, page_sizes
 import progressbar
 
 parser = argparse.ArgumentParser(description="arduino flash utility")
 group = parser.add_mutually_exclusive_group()
-parser.add_argument("filename", help="filename in hexadecimal Intel format")
+parser.add_argument("filename", nargs="?", help="filename in hexadecimal Intel format")
 parser.add_argument("--version", action="store_true", help="script version")
 parser.add_argument("-e", "--eeprom", action="store_true", help="program eeprom")
-parser.add_argument("-d", "--device", help="specify the device. Use net: for TCP connection")
-parser.add_argument("-b", "--baudrate", type=int, required=True, help="old bootolader (57600) Optiboot (115200)")
-parser.add_argument("-p", "--programmer", required=True, help="programmer version - Nano (Stk500v1) Mega (Stk500v2)")
+parser.add_argument("-d", "--device", action="append",
+                    help="specify the device, can be repeated or a pattern. Use net: for TCP connection")
+parser.add_argument("-a", "--all", action="store_true", help="use all the ports where an Arduino board is found")
+parser.add_argument("-j", "--jobs", type=int, default=8, help="boards updated at the same time")
+parser.add_argument("-b", "--baudrate", type=int,
+                    help="old bootolader (57600) Optiboot (115200), detected when it is not given")
+parser.add_argument("-p", "--programmer",
+                    help="programmer version - Nano (Stk500v1) Mega (Stk500v2), detected when it is not given")
+parser.add_argument("--profile", choices=sorted(HANDSHAKE_PROFILES),
+                    help="timing of the reset and the sync of the board")
+parser.add_argument("--no-reset", action="store_true", help="the board is already in the bootloader")
+parser.add_argument("--adaptive-timeout", action="store_true",
+                    help="calculate the timeout of each command from the measured round trip time")
 group.add_argument("-r", "--read", action="store_true", help="read the cpu flash memory")
 group.add_argument("-u", "--update", action="store_true", help="update cpu flash memory")
+parser.add_argument("-U", "--operation", action="append", metavar="MEMORY:OP:FILE",
+                    help="flash or eeprom, w (write and verify) r (read) or v (verify), and the file. "
+                         "Can be repeated, the operations are done in order without resetting the board")
+parser.add_argument("--delta", action="store_true", help="only write the pages that differ from the memory")
+parser.add_argument("--verify", choices=VERIFY_STRATEGIES, default="after",
+                    help="read back the written pages after the write, right after each page (interleaved), "
+                         "a sample of them, or none")
+parser.add_argument("--retries", type=int, default=0,
+                    help="times that a page is tried again after a communication error, by default it gives up at "
+                         "the first one")
+parser.add_argument("--resume", action="store_true",
+                    help="keep a journal of the written pages, and continue an interrupted write of the same file")
+parser.add_argument("--skip-identical", action="store_true",
+                    help="remember the file written in each board, and don't write it again when a few pages match")
+parser.add_argument("--force", action="store_true",
+                    help="with --skip-identical, write the file even when the board already has it")
+parser.add_argument("--skip-blank", action="store_true",
+                    help="omit the blank regions (0xFF) of the memory in the file read")
+parser.add_argument("--stats", help="save the statistics of the commands of each board in a JSON file")
+parser.add_argument("--trace", help="save the timeline of the session in Chrome Trace format (Perfetto)")
 args = parser.parse_args()
 
-if args.version:
-    print("version {}".format(VERSION))
 
-if args.update:
-    print("update Arduino firmware with filename: {}".format(args.filename))
-elif args.read:
-    print("read the Arduino firmware and save in filename: {}".format(args.filename))
-else:
-    parser.print_help()
-    sys.exit()
+board_stats = dict()
+"""Summary of the command statistics of each board, saved with --stats"""
 
-ih = IntelHex()
-ab = ArduinoBootloader()
+session_trace = SessionTrace() if args.trace else None
+"""Timeline shared by all the boards, each one in the track of its thread"""
 
-prg = ab.select_programmer(args.programmer)
-if prg is None:
-    print("programmer version unsupported: {}".format(args.programmer))
-    sys.exit()
+flash_journal = FlashJournal() if args.resume else None
+"""Pages confirmed by each board, shared by all the boards, saved with --resume"""
+
+fingerprint_store = FingerprintStore() if args.skip_identical else None
+"""Image written in each board, to skip the boards that already have the file, saved with --skip-identical"""
+
+
+class BoardError(Exception):
+    """Error that aborts the operation with a board."""
 
 
-def exit_by_error(msg):
-    print("\nerror, {}".format(msg))
-    prg.leave_bootloader()
-    prg.close()
-    sys.exit(0)
+class NoProgressBar(object):
+    """Used instead of the progress bar when several boards are updated at the same time."""
+    def start(self):
+        pass
 
+    def update(self, value):
+        pass
 
-if prg.open(port=args.device, speed=args.baudrate):
-    print("AVR device initialized and ready to accept instructions")
-    address = 0
-    if not prg.board_request():
-        exit_by_error(msg="board request")
+    def finish(self):
+        pass
 
-    print("bootloader: {} version: {} hardware version: {}".format(ab.programmer_name,\
-                                                                   ab.sw_version, ab.hw_version))
 
-    if not prg.cpu_signature():
-        exit_by_error(msg="cpu signature")
+OPERATIONS = {"w": "write", "r": "read", "v": "verify"}
+"""Operations of the -U option"""
 
-    print("cpu name: {}".format(ab.cpu_name))
 
-    page_size = ab.cpu_page_size if not args.eeprom else ab.eeprom_page_size
-    if args.update:
-        print("reading input file: {}".format(args.filename))
+def parse_operations():
+    """Operations of the command line in order, -u or -r first.
 
+    :return: list of (memory, operation, filename) tuples.
+    :rtype: list
+    """
+    operations = []
+    if args.update or args.read:
+        if not args.filename:
+            raise BoardError("the filename is required")
+        operations.append(("flash" if not args.eeprom else "eeprom", "w" if args.update else "r", args.filename))
+
+    for operation in args.operation or []:
+        memory, _, rest = operation.partition(":")
+        op, _, filename = rest.partition(":")
+        if memory not in ("flash", "eeprom") or op not in OPERATIONS or not filename:
+            raise BoardError("invalid operation: {}".format(operation))
+        operations.append((memory, op, filename))
+
+    return operations
+
+
+def find_devices():
+    """Expand the patterns of the device option, and add the ports found with --all.
+
+    :return: the list of devices, [None] to search a single board.
+    :rtype: list
+    """
+    devices = []
+    for device in args.device or []:
+        if device[0:4] != 'net:' and glob.has_magic(device):
+            devices.extend(sorted(glob.glob(device)))
+        else:
+            devices.append(device)
+
+    if args.all:
+        devices.extend(port for port in ArduinoBootloader().find_device_ports() if port not in devices)
+
+    if not devices and not args.device and not args.all:
+        devices = [None]
+
+    return devices
+
+
+def read_firmware(operations):
+    """Read the files to write or verify once for all the boards. The files that are only
+    verified are not read when the manifest next to them is valid.
+
+    :return: dictionary of the (image, manifests) tuples by filename, the image is None when
+             the file is only verified.
+    :rtype: dict
+    """
+    images = dict()
+    for memory, op, filename in operations:
+        if op == "r" or filename in images:
+            continue
+
+        print("reading input file: {}".format(filename))
+        uses = [(memory, op) for memory, op, name in operations if name == filename and op != "r"]
+        sizes = sorted({size for memory, op in uses for size in page_sizes(memory == "flash")})
         try:
-            ih.fromfile(args.filename, format='hex')
+            ih = read_hex(filename) if any(op == "w" for memory, op in uses) else None
+            images[filename] = ih, load_manifest(filename, sizes, ih)
         except FileNotFoundError:
-            exit_by_error(msg="file not found")
-        except (AddressOverlapError, HexRecordError):
-            exit_by_error(msg="error, file format")
-
-        print("writing {}: {} bytes".format("flash" if not args.eeprom else "eeprom", ih.maxaddr()))
-        bar = progressbar.ProgressBar(maxval=ih.maxaddr())
+            raise BoardError("file not found")
+        except HexFileError as e:
+            raise BoardError("file format, {}".format(e))
+
+    return images
+
+
+def process_board(device, operations, images, verbose):
+    """Do the operations with the memory of a board in one session.
+
+    :param device: port of the board, None for automatic board search.
+    :param operations: list of (memory, operation, filename) tuples.
+    :param images: (image, manifests) tuples to write or verify by filename.
+    :param verbose: print the information of the board and the progress.
+    :return: the cpu name and the count of bytes written and read.
+    :rtype: tuple
+    """
+    ab = ArduinoBootloader()
+    ab.enable_adaptive_timeout(args.adaptive_timeout)
+    ab.enable_page_retry(args.retries > 0, args.retries)
+    if flash_journal is not None:
+        ab.enable_journal(flash_journal)
+    if fingerprint_store is not None:
+        ab.enable_fingerprints(fingerprint_store)
+    if args.stats:
+        ab.enable_stats()
+    if session_trace is not None:
+        ab.enable_trace(session_trace)
+        session_trace.name_track(str(device))
+
+    session = BootloaderSession(device, args.baudrate, args.programmer, args.profile, not args.no_reset, ab=ab)
+    try:
+        if not session.open():
+            if ab.time_to_sync is not None:
+                raise BoardError("reading the information of the board")
+            if session.candidates() is None:
+                raise BoardError("could not connect with arduino board - baudrate: {}".format(args.baudrate))
+            raise BoardError("could not detect the bootloader of the arduino board")
+
+        if verbose:
+            if session.candidates() is not None:
+                print("bootloader detected: {} baudrate: {}".format(type(session.programmer).__name__, ab.speed))
+            print("time to sync: {:.0f} ms".format(ab.time_to_sync * 1000))
+            print("AVR device initialized and ready to accept instructions")
+            print("bootloader: {} version: {} hardware version: {}".format(ab.programmer_name,
+                                                                           ab.sw_version, ab.hw_version))
+            print("cpu name: {}".format(ab.cpu_name))
+
+        transferred = 0
+        for memory, op, filename in operations:
+            transferred += transfer(session, memory, op, filename, images, verbose)
+
+        return ab.cpu_name, transferred
+    finally:
+        session.close()
+        if ab.stats is not None:
+            board_stats[ab.port or str(device)] = dict(ab.stats.summary(), time_to_sync=ab.time_to_sync,
+                                                       page_cache={"hits": ab.page_cache.hits,
+                                                                   "misses": ab.page_cache.misses},
+                                                       verify={"strategy": args.verify,
+                                                               "pages_verified": ab.pages_verified,
+                                                               "pages_rewritten": ab.pages_rewritten,
+                                                               "seconds": ab.verify_time})
+
+
+def save_reports():
+    """Write the statistics and the trace of the boards requested with --stats and --trace."""
+    try:
+        if args.stats:
+            with open(args.stats, "w") as file:
+                json.dump(board_stats, file, indent=2)
+        if session_trace is not None:
+            session_trace.save(args.trace)
+    except OSError:
+        print("error, the report file cannot be created")
+
+
+def transfer(session, memory, op, filename, images, verbose):
+    """Write and verify, verify or read a memory of the board.
+
+    :return: the count of bytes written and read.
+    :rtype: int
+    """
+    def progress_bar(maxval):
+        return progressbar.ProgressBar(maxval=maxval) if verbose else NoProgressBar()
+
+    ab = session.ab
+    flash = memory == "flash"
+    page_size = session.page_size(flash)
+    if op != "r" and not page_size:
+        raise BoardError("the {} memory of the cpu has no pages".format(memory))
+    transferred = 0
+    if op == "w":
+        ih, manifests = images[filename]
+        verify = args.verify if args.verify != "after" else "none"
+        if verbose:
+            print("writing {}: {} bytes".format(memory, ih.maxaddr()))
+        bar = progress_bar(ih.maxaddr())
         bar.start()
-        for address in range(0, ih.maxaddr(), page_size):
-            buffer = ih.tobinarray(start=address, size=page_size)
-            if not prg.write_memory(buffer, address, flash=not args.eeprom):
-                exit_by_error(msg="writing {} memory".format("flash" if not args.eeprom else "eeprom"))
+        if not session.write(ih, flash, args.delta, progress=bar.update, verify=verify, force=args.force,
+                             manifests=manifests):
+            if ab.mismatch_address is not None:
+                raise BoardError("file not match at address 0x{:X}".format(ab.mismatch_address))
+            raise BoardError("writing {} memory".format(memory))
 
-            bar.update(address)
+        bar.finish()
+        if ab.up_to_date:
+            """Nothing was written, but the pages are still verified with the requested strategy."""
+            if verbose:
+                print("{} memory already up to date, use --force to write it".format(memory))
+            transferred += min(FINGERPRINT_SAMPLES, ab.pages_skipped) * page_size
+        transferred += (ab.pages_written + ab.pages_verified + ab.pages_rewritten) * page_size
+        if ab.pages_resumed and verbose:
+            print("pages resumed from the journal: {}".format(ab.pages_resumed))
+        if args.delta and verbose:
+            print("pages written: {} skipped: {}".format(ab.pages_written, ab.pages_skipped))
+        if verify != "none" and verbose:
+            print("verify {}: pages read: {} written again: {} time: {:.2f} s".format(
+                verify, ab.pages_verified, ab.pages_rewritten, ab.verify_time))
+
+    if op == "v" or (op == "w" and args.verify == "after"):
+        ih, manifests = images[filename]
+        manifest = manifests.get(page_size)
+        if manifest is None:
+            """The page size of the board is not in the manifests, the pages of the image are hashed."""
+            try:
+                manifest = build_manifest(ih if ih is not None else read_hex(filename), page_size)
+            except HexFileError as e:
+                raise BoardError("file format, {}".format(e))
+            except FileNotFoundError:
+                raise BoardError("file not found")
+
+        runs = list(manifest.runs())
+        if verbose:
+            print("reading and verifying {} memory".format(memory))
+        bar = progress_bar(runs[-1][0] + runs[-1][1] if runs else 0)
+        bar.start()
+        if not session.verify_manifest({page_size: manifest}, flash, progress=bar.update):
+            if ab.mismatch_address is not None:
+                raise BoardError("file not match at address 0x{:X}".format(ab.mismatch_address))
+            raise BoardError("file not match")
 
         bar.finish()
+        if op == "w" and verbose:
+            print("verify after: pages read: {} time: {:.2f} s".format(ab.pages_verified, ab.verify_time))
+        return transferred + sum(length for start, length, run in runs)
 
-    dict_hex = dict()
+    if op == "w":
+        return transferred
 
-    if args.update:
-        max_address = ih.maxaddr()
-        print("reading and verifying {} memory".format("flash" if not args.eeprom else "eeprom"))
+    max_address = session.memory_size(flash)
+    if verbose:
+        print("reading {} memory".format(memory))
+    bar = progress_bar(max_address)
+    bar.start()
+    read_buffer = session.read(flash, progress=bar.update)
+    if read_buffer is None:
+        raise BoardError("reading {} memory".format(memory))
 
-    elif args.read:
-        if not args.eeprom:
-            max_address = int(ab.cpu_page_size * ab.cpu_pages)
+    bar.finish()
+    try:
+        if filename.lower().endswith(".bin"):
+            write_bin(filename, read_buffer, args.skip_blank)
         else:
-            max_address = int(ab.eeprom_page_size * ab.eeprom_pages)
-        print("reading {} memory".format("flash" if not args.eeprom else "eeprom"))
-    else:
-        max_address = 0
-        page_size = 0
+            write_hex(filename, read_buffer, skip_blank=args.skip_blank)
+    except OSError:
+        raise BoardError("the file cannot be created")
 
-    bar = progressbar.ProgressBar(maxval=max_address)
-    bar.start()
+    return max_address
 
-    for address in range(0, max_address, page_size):
-        read_buffer = prg.read_memory(address, page_size, flash=not args.eeprom)
-        if read_buffer is None:
-            exit_by_error(msg="reading {} memory".format("flash" if not args.eeprom else "eeprom"))
 
-        if args.update:
-            if read_buffer != ih.tobinarray(start=address, size=page_size):
-                exit_by_error(msg="file not match")
-        elif args.read:
-            for i in range(0, page_size):
-                dict_hex[address + i] = read_buffer[i]
+def run_single(device, operations):
+    """Process one board showing its information and the progress.
 
-        bar.update(address)
+    :return: the exit code, 1 when the board fails, as run_fleet.
+    :rtype: int
+    """
+    try:
+        images = read_firmware(operations)
+        process_board(device, operations, images, verbose=True)
+    except BoardError as e:
+        print("\nerror, {}".format(e))
+        save_reports()
+        return 1
 
-    bar.finish()
+    save_reports()
+    print("\nprogram done, thank you")
+    return 0
 
-    if args.read:
-        dict_hex["start_addr"] = 0
-        ih.fromdict(dict_hex)
+
+def run_fleet(devices, operations):
+    """Update and verify all the boards with a bounded pool of workers,
+    and show a table with the result of each one.
+
+    :return: the exit code, 1 when a board fails.
+    :rtype: int
+    """
+    if any(op == "r" for memory, op, filename in operations):
+        print("error, the memory can be read from only one board")
+        return 1
+
+    try:
+        images = read_firmware(operations)
+    except BoardError as e:
+        print("error, {}".format(e))
+        return 1
+
+    def worker(device):
+        start = time.monotonic()
         try:
-            ih.tofile(args.filename, 'hex')
-        except FileNotFoundError:
-            exit_by_error(msg="the file cannot be created")
+            cpu_name, transferred = process_board(device, operations, images, verbose=False)
+            return device, cpu_name, "ok", transferred, time.monotonic() - start
+        except Exception as e:
+            """A port that can't be opened must not stop the rest of the boards."""
+            return device, "", "error, {}".format(e), 0, time.monotonic() - start
+
+    print("updating {} boards, {} at the same time".format(len(devices), args.jobs))
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        results = list(executor.map(worker, devices))
+    elapsed = time.monotonic() - start
+    save_reports()
+
+    print("\n{:<24}{:<14}{:>10}{:>10}  {}".format("device", "cpu", "bytes", "seconds", "result"))
+    for device, cpu_name, result, transferred, seconds in results:
+        print("{:<24}{:<14}{:>10}{:>10.2f}  {}".format(device, cpu_name, transferred, seconds, result))
+
+    failed = sum(1 for result in results if result[2] != "ok")
+    total_bytes = sum(result[3] for result in results)
+    print("\nboards: {} ok: {} failed: {} time: {:.2f} s".format(len(results), len(results) - failed,
+                                                                  failed, elapsed))
+    if elapsed > 0:
+        print("throughput: {:.1f} boards/minute {:.0f} bytes/s".format(len(results) * 60 / elapsed,
+                                                                     total_bytes / elapsed))
+
+    return 1 if failed else 0
 
-    print("\nprogram done, thank you")
 
-    prg.leave_bootloader()
-    prg.close()
+if args.version:
+    print("version {}".format(VERSION))
+
+try:
+    operations = parse_operations()
+except BoardError as e:
+    print("error, {}".format(e))
+    sys.exit(1)
+
+if args.update:
+    print("update Arduino firmware with filename: {}".format(args.filename))
+elif args.read:
+    print("read the Arduino firmware and save in filename: {}".format(args.filename))
+elif not operations:
+    parser.print_help()
+    sys.exit()
+
+if args.programmer and ArduinoBootloader().select_programmer(args.programmer) is None:
+    print("programmer version unsupported: {}".format(args.programmer))
+    sys.exit()
+
+devices = find_devices()
+if not devices:
+    print("error, no arduino board found")
+    sys.exit(1)
+
+if len(devices) == 1:
+    sys.exit(run_single(devices[0], operations))
 else:
-    print("error, could not connect with arduino board - baudrate: {}".format(args.baudrate))
+    sys.exit(run_fleet(devices, operations))
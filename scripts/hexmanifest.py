@@ -0,0 +1,43 @@
+#!/usr/bin/python
+
+"""Compile the page manifest of firmware files.
+   The manifest has, for each page size of the cpus, the digest of the pages with
+   data, the bitmap of the blank pages and the digest of the image. It is saved next
+   to the file (firmware.hex.manifest.json), and arduinoflash uses it to verify the
+   boards and to know if they already have the file without parsing it."""
+
+import argparse
+import sys
+
+from hexreader import HexFileError
+from manifest import load_manifest, page_sizes, MANIFEST_SUFFIX
+
+parser = argparse.ArgumentParser(description="firmware page manifest compiler")
+parser.add_argument("filename", nargs="+", help="filename in hexadecimal Intel format")
+parser.add_argument("-e", "--eeprom", action="store_true", help="page sizes of the eeprom instead of the flash")
+parser.add_argument("-s", "--page-size", type=int, action="append",
+                    help="page size in bytes, can be repeated. All the sizes of the cpus when it is not given")
+args = parser.parse_args()
+
+sizes = args.page_size or page_sizes(not args.eeprom)
+failed = False
+for filename in args.filename:
+    try:
+        manifests = load_manifest(filename, sizes)
+    except FileNotFoundError:
+        print("error, file not found: {}".format(filename))
+        failed = True
+        continue
+    except HexFileError as e:
+        print("error, file format, {}: {}".format(filename, e))
+        failed = True
+        continue
+
+    print("{}{}".format(filename, MANIFEST_SUFFIX))
+    print("{:>10}{:>8}{:>8}  {}".format("page size", "pages", "blank", "image"))
+    for size, manifest in sorted(manifests.items()):
+        runs = list(manifest.runs())
+        span = (runs[-1][0] + runs[-1][1] - runs[0][0]) // size if runs else 0
+        print("{:>10}{:>8}{:>8}  {}".format(size, len(manifest), span - len(manifest), manifest.image))
+
+sys.exit(1 if failed else 0)
@@ -12,7 +12,7 @@ setup(
     name='arduinobootloader',
     version='0.0.6',
     package_dir={'': 'arduinobootloader'},
-    py_modules=['arduinobootloader'],
+    py_modules=['arduinobootloader', 'asyncbootloader', 'bootloadercache', 'bootloadersession', 'bootloaderstats', 'hexreader', 'hexwriter', 'manifest', 'pageplanner', 'stk500emulator'],
     url='https://github.com/jjsch-dev/PyArduinoFlash',
     install_requires=INSTALL_PACKAGES,
     license='MIT',
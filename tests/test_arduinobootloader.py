@@ -0,0 +1,265 @@
+import json
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "arduinobootloader"))
+
+from serial import SerialException
+
+from arduinobootloader import ArduinoBootloader, FrameCodec, FrameReader, MAX_FRAME_SIZE, CMD_SIGN_ON, \
+    VERIFY_SAMPLE_INTERVAL
+from bootloadercache import FlashJournal, FingerprintStore
+from stk500emulator import BootloaderEmulator, EmulatorServer
+
+
+class TestStk500v2ReadAddress(unittest.TestCase):
+    """The Stk500v2 reads only load the address when the bootloader counter can't be trusted."""
+
+    def setUp(self):
+        self.emulator = BootloaderEmulator("Stk500v2", 0x1E9801, baudrate=None)
+        rand = random.Random(0)
+        self.emulator.flash[:] = bytes(rand.getrandbits(8) for _ in range(len(self.emulator.flash)))
+        self.ab = ArduinoBootloader()
+        self.prg = self.ab.select_programmer("Stk500v2")
+        self.assertTrue(self.prg.open(port=self.emulator, speed=115200, reset=False))
+
+    def tearDown(self):
+        self.prg.close()
+
+    def load_addresses(self):
+        return self.ab.stats.summary()["commands"].get("CMD_LOAD_ADDRESS", {}).get("count", 0)
+
+    def test_consecutive_reads(self):
+        self.ab.enable_stats()
+        self.assertEqual(self.prg.read_range(0, 4096), self.emulator.flash[:4096])
+        self.assertEqual(self.load_addresses(), 1)
+
+    def test_resync(self):
+        self.ab.enable_stats()
+        self.assertTrue(self.prg.read_range(0, 256))
+        self.assertTrue(self.prg.get_sync())
+        """The bootloader could have been reset, so the address is loaded again."""
+        self.emulator._address = 0
+        self.assertEqual(self.prg.read_range(256, 256), self.emulator.flash[256:512])
+        self.assertEqual(self.load_addresses(), 2)
+
+    def test_retry(self):
+        """The corrupted answers advance the address of the bootloader, the retried reads load it again."""
+        self.ab.enable_page_retry(retries=20)
+        self.emulator.error_rate = 0.0005
+        self.emulator.random.seed(1)
+        self.assertEqual(self.prg.read_range(0, 32768, cache=False), self.emulator.flash[:32768])
+        self.assertGreater(self.emulator.errors_injected, 0)
+
+
+class TestAdaptiveTimeout(unittest.TestCase):
+    """The adaptive timeouts are opt-in, and a board that becomes slower is still read."""
+
+    def setUp(self):
+        self.emulator = BootloaderEmulator("Stk500v1", 0x1E950F, baudrate=None)
+        self.ab = ArduinoBootloader()
+        self.prg = self.ab.select_programmer("Stk500v1")
+
+    def tearDown(self):
+        self.prg.close()
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(self.ab.rtt)
+        self.assertTrue(self.prg.open(port=self.emulator, speed=115200, reset=False))
+        self.assertEqual(self.emulator.timeout, 1)
+
+    def test_slow_answer(self):
+        self.ab.enable_adaptive_timeout()
+        self.ab.enable_page_retry(retries=5)
+        self.ab.enable_stats()
+        self.assertTrue(self.prg.open(port=self.emulator, speed=115200, reset=False))
+        self.assertTrue(self.prg.cpu_signature())
+        self.emulator.latency = 0.2
+        self.assertGreater(self.emulator.latency, self.ab.rtt.timeout)
+        self.assertEqual(self.prg.read_memory(0, 128, cache=False), self.emulator.flash[:128])
+        self.assertGreater(self.ab.stats.summary()["commands"]["STK_LOAD_ADDRESS"]["timeouts"], 0)
+
+
+class TestVerifyStrategies(unittest.TestCase):
+    """A page programmed with a wrong byte is found and written again by each verification strategy."""
+
+    def setUp(self):
+        self.emulator = BootloaderEmulator("Stk500v2", 0x1E9801, baudrate=None)
+        self.ab = ArduinoBootloader()
+        self.prg = self.ab.select_programmer("Stk500v2")
+        self.assertTrue(self.prg.open(port=self.emulator, speed=115200, reset=False))
+        self.assertTrue(self.prg.cpu_signature())
+        size = self.ab.cpu_page_size
+        self.pages = [(address, bytearray([address // size]) * size)
+                      for address in range(0, 2 * VERIFY_SAMPLE_INTERVAL * size, size)]
+
+    def tearDown(self):
+        self.prg.close()
+
+    def corrupt_once(self, address):
+        """The first programming of the page at the address has a wrong byte."""
+        program_flash = self.emulator._program_flash
+        corrupted = []
+
+        def corrupt(start, data):
+            program_flash(start, data)
+            if start == address and not corrupted:
+                self.emulator.flash[start] ^= 0x01
+                corrupted.append(start)
+
+        self.emulator._program_flash = corrupt
+        return corrupted
+
+    def write_corrupted(self, verify):
+        """The sampled strategy reads the last page of each interval, so that one is corrupted."""
+        address = self.pages[VERIFY_SAMPLE_INTERVAL - 1][0]
+        corrupted = self.corrupt_once(address)
+        self.assertTrue(self.ab.write_pages(self.pages, verify=verify))
+        self.assertEqual(corrupted, [address])
+        self.assertEqual(self.ab.pages_rewritten, 1)
+        self.assertIsNone(self.ab.mismatch_address)
+        for address, buffer in self.pages:
+            self.assertEqual(self.emulator.flash[address:address + len(buffer)], buffer)
+
+    def test_after(self):
+        self.write_corrupted("after")
+
+    def test_interleaved(self):
+        self.write_corrupted("interleaved")
+
+    def test_sampled(self):
+        self.write_corrupted("sampled")
+        """The two samples, and the read of the page written again."""
+        self.assertEqual(self.ab.pages_verified, 2 + 1)
+
+    def test_not_fixed(self):
+        """A page that is always programmed wrong stops the write with its address."""
+        address = self.pages[2][0]
+        program_flash = self.emulator._program_flash
+
+        def corrupt(start, data):
+            program_flash(start, data)
+            if start == address:
+                self.emulator.flash[start] ^= 0x01
+
+        self.emulator._program_flash = corrupt
+        self.assertFalse(self.ab.write_pages(self.pages, verify="interleaved"))
+        self.assertEqual(self.ab.mismatch_address, address)
+        self.assertEqual(self.ab.pages_written, 3)
+
+
+class TestFrameReader(unittest.TestCase):
+    """The Stk500v2 answers are found in the receive buffer without trusting a corrupted length."""
+
+    def frame(self, sequence, data):
+        return bytes(FrameCodec().encode(sequence, CMD_SIGN_ON, data))
+
+    def test_frame_view(self):
+        reader = FrameReader()
+        frame = self.frame(1, b"\x00STK500_2")
+        reader.feed(frame)
+        head, body = reader.next_frame(1)
+        self.assertIsInstance(body, memoryview)
+        self.assertEqual(bytes(head) + bytes(body), frame[1:])
+        self.assertEqual(reader.bytes_discarded, 0)
+
+    def test_corrupted_length(self):
+        """A header with a length longer than the message buffer is skipped at once."""
+        reader = FrameReader()
+        reader.feed(bytes([0x1B, 1, 0xFF, 0xFF, 0x0E]))
+        self.assertIsNone(reader.next_frame(1))
+        self.assertEqual(reader.bytes_discarded, 5)
+        self.assertEqual(reader.missing(), 8)
+
+        frame = self.frame(1, b"\x00")
+        reader.feed(frame)
+        self.assertEqual(bytes(reader.next_frame(1)[1]), frame[5:])
+
+    def test_longer_feed(self):
+        """The buffer grows when more than a frame is fed at once."""
+        reader = FrameReader()
+        frames = [self.frame(sequence, bytes(250)) for sequence in range(4)]
+        reader.feed(b"".join(frames) + bytes(MAX_FRAME_SIZE))
+        for sequence, frame in enumerate(frames):
+            self.assertEqual(bytes(reader.next_frame(sequence)[1]), frame[5:])
+
+
+class TestJournalException(unittest.TestCase):
+    """A write interrupted by an exception keeps the confirmed pages in the journal."""
+
+    def setUp(self):
+        self.emulator = BootloaderEmulator("Stk500v2", 0x1E9801, baudrate=None)
+        self.server = EmulatorServer(self.emulator)
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "journal.json")
+        self.ab = ArduinoBootloader()
+        self.ab.enable_journal(FlashJournal(self.filename, interval=3600))
+        self.ab.enable_page_retry(False)
+        self.prg = self.ab.select_programmer("Stk500v2")
+        self.assertTrue(self.prg.open("net:127.0.0.1:{}".format(self.server.port)))
+        self.assertTrue(self.prg.cpu_signature())
+
+    def tearDown(self):
+        self.prg.close()
+        self.server.close()
+        self.directory.cleanup()
+
+    def test_exception_saves_pages(self):
+        size = self.ab.cpu_page_size
+        pages = [(address, bytearray([address // size]) * size) for address in range(0, 10 * size, size)]
+        written = []
+
+        def progress(address):
+            written.append(address)
+            if len(written) == 4:
+                raise SerialException("device disconnected")
+
+        with self.assertRaises(SerialException):
+            self.ab.write_pages(pages, progress=progress)
+
+        with open(self.filename) as file:
+            entries = json.load(file)
+        self.assertEqual([entry["ranges"] for entry in entries.values()], [[[0, 4 * size]]])
+
+
+
+class TestFingerprintVerify(unittest.TestCase):
+    """A board with the image of its fingerprint is still verified with the strategy."""
+
+    def setUp(self):
+        self.emulator = BootloaderEmulator("Stk500v2", 0x1E9801, baudrate=None)
+        self.server = EmulatorServer(self.emulator)
+        self.directory = tempfile.TemporaryDirectory()
+        self.ab = ArduinoBootloader()
+        self.ab.enable_fingerprints(FingerprintStore(os.path.join(self.directory.name, "fingerprints.json")))
+        self.prg = self.ab.select_programmer("Stk500v2")
+        self.assertTrue(self.prg.open("net:127.0.0.1:{}".format(self.server.port)))
+        self.assertTrue(self.prg.cpu_signature())
+        size = self.ab.cpu_page_size
+        self.pages = [(address, bytearray([address // size]) * size) for address in range(0, 10 * size, size)]
+        self.assertTrue(self.ab.write_pages(self.pages))
+
+    def tearDown(self):
+        self.prg.close()
+        self.server.close()
+        self.directory.cleanup()
+
+    def test_up_to_date(self):
+        self.assertTrue(self.ab.write_pages(self.pages, verify="after"))
+        self.assertTrue(self.ab.up_to_date)
+        self.assertEqual(self.ab.pages_verified, len(self.pages))
+
+    def test_page_not_sampled(self):
+        """The fingerprint only reads some pages, the verification finds the changed one and writes the image."""
+        address, buffer = self.pages[1]
+        self.emulator.flash[address:address + len(buffer)] = bytes(len(buffer))
+        self.assertTrue(self.ab.write_pages(self.pages, verify="interleaved"))
+        self.assertFalse(self.ab.up_to_date)
+        self.assertEqual(self.emulator.flash[address:address + len(buffer)], buffer)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import sys
+import unittest
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "arduinobootloader"))
+
+from asyncbootloader import AsyncArduinoBootloader
+from stk500emulator import BootloaderEmulator, EmulatorServer
+
+
+class TestAsyncWritePages(unittest.TestCase):
+    """The write_pages of the async programmers must await the commands and write the pages."""
+
+    def write_pages(self, protocol, signature):
+        emulator = BootloaderEmulator(protocol, signature, baudrate=None)
+        server = EmulatorServer(emulator)
+        try:
+            async def run():
+                ab = AsyncArduinoBootloader()
+                prg = ab.select_programmer(protocol)
+                self.assertTrue(await prg.open("net:127.0.0.1:{}".format(server.port)))
+                self.assertTrue(await prg.cpu_signature())
+                size = ab.cpu_page_size
+                pages = [(address, bytearray((address // size + i) & 0xFF for i in range(size)))
+                         for address in range(0, 20 * size, size)]
+                written = []
+                result = await prg.write_pages(pages, progress=written.append)
+                await prg.close()
+                return result, pages, written
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", RuntimeWarning)
+                result, pages, written = asyncio.run(run())
+        finally:
+            server.close()
+
+        self.assertTrue(result)
+        self.assertEqual(written, [address for address, buffer in pages])
+        for address, buffer in pages:
+            self.assertEqual(emulator.flash[address:address + len(buffer)], buffer)
+
+    def test_stk500v1(self):
+        self.write_pages("Stk500v1", 0x1E950F)
+
+    def test_stk500v2(self):
+        self.write_pages("Stk500v2", 0x1E9801)
+
+
+class TestAsyncPageCache(unittest.TestCase):
+    """Opening the port resets the board, so the pages cached before can't be used."""
+
+    def test_open_invalidates(self):
+        emulator = BootloaderEmulator("Stk500v2", 0x1E9801, baudrate=None)
+        server = EmulatorServer(emulator)
+        port = "net:127.0.0.1:{}".format(server.port)
+        try:
+            async def run():
+                ab = AsyncArduinoBootloader()
+                ab.enable_page_cache()
+                prg = ab.select_programmer("Stk500v2")
+                self.assertTrue(await prg.open(port))
+                first = await prg.read_memory(0, 256)
+                await prg.close()
+                emulator.flash[0:256] = bytes(256)
+                self.assertTrue(await prg.open(port))
+                second = await prg.read_memory(0, 256)
+                await prg.close()
+                return first, second
+
+            first, second = asyncio.run(run())
+        finally:
+            server.close()
+
+        self.assertEqual(first, bytes([0xFF]) * 256)
+        self.assertEqual(second, bytes(256))
+
+
+class TestAsyncDevice(unittest.TestCase):
+    """The async bootloader accepts the objects with the interface of the serial port, as the sync one."""
+
+    def test_emulator_object(self):
+        emulator = BootloaderEmulator("Stk500v1", 0x1E950F, baudrate=None)
+
+        async def run():
+            ab = AsyncArduinoBootloader()
+            prg = ab.select_programmer("Stk500v1")
+            self.assertTrue(await prg.open(emulator, reset=False))
+            self.assertTrue(await prg.cpu_signature())
+            size = ab.cpu_page_size
+            pages = [(address, bytearray([address // size]) * size) for address in range(0, 8 * size, size)]
+            result = await ab.write_pages(pages, verify="after")
+            verified = ab.pages_verified
+            await prg.close()
+            return result, pages, verified
+
+        result, pages, verified = asyncio.run(run())
+        self.assertTrue(result)
+        self.assertEqual(verified, len(pages))
+        for address, buffer in pages:
+            self.assertEqual(emulator.flash[address:address + len(buffer)], buffer)
+
+
+if __name__ == "__main__":
+    unittest.main()
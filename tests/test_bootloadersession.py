@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "arduinobootloader"))
+
+from serial import SerialException
+
+from bootloadersession import BootloaderSession
+from hexreader import HexImage
+from stk500emulator import BootloaderEmulator
+
+
+class TestKeepAliveError(unittest.TestCase):
+    """An exception of the sync of the keep alive makes the next operations fail."""
+
+    def setUp(self):
+        self.emulator = BootloaderEmulator("Stk500v1", 0x1E950F, baudrate=None)
+        self.session = BootloaderSession(self.emulator, 115200, "Stk500v1", reset=False, keepalive=0.01)
+        self.assertTrue(self.session.open())
+
+    def tearDown(self):
+        self.session.close()
+
+    def disconnect(self):
+        def get_sync():
+            raise SerialException("device disconnected")
+
+        self.session.programmer.get_sync = get_sync
+        deadline = time.monotonic() + 2
+        while self.session.error is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_operations_fail(self):
+        self.disconnect()
+        self.assertIsInstance(self.session.error, SerialException)
+        self.assertFalse(self.session.is_open)
+        self.assertFalse(self.session.open())
+        image = HexImage([(0, bytes(range(128)), 1)])
+        self.assertFalse(self.session.write(image))
+        self.assertFalse(self.session.verify(image))
+        self.assertIsNone(self.session.read(length=128))
+
+    def test_close_clears(self):
+        self.disconnect()
+        self.session.close()
+        self.assertIsNone(self.session.error)
+        self.assertTrue(self.session.open())
+        self.assertEqual(self.session.read(length=128), bytes([0xFF]) * 128)
+
+
+if __name__ == "__main__":
+    unittest.main()
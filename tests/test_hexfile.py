@@ -0,0 +1,96 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "arduinobootloader"))
+
+from hexreader import HexFileError, HexImage, parse_records, read_hex
+from hexwriter import EOF_LINE, hex_lines, write_hex
+
+
+def record(kind, address, data):
+    checksum = -(len(data) + (address >> 8) + (address & 0xFF) + kind + sum(data)) & 0xFF
+    return ":{:02X}{:04X}{:02X}{}{:02X}".format(len(data), address, kind, bytes(data).hex().upper(), checksum)
+
+
+class TestHexReader(unittest.TestCase):
+    """The records are parsed into the flat buffer, and the invalid ones have the number of their line."""
+
+    def image(self, lines):
+        return HexImage(parse_records(lines))
+
+    def test_extended_segment(self):
+        """The 02 record sets the base address in paragraphs of 16 bytes."""
+        image = self.image([record(2, 0, b"\x10\x00"), record(0, 0x0010, b"\x01\x02"), EOF_LINE])
+        self.assertEqual(image.segments(), [(0x10010, 0x10012)])
+        self.assertEqual(image.tobinarray(0x10010, 2), b"\x01\x02")
+
+    def test_extended_linear(self):
+        """The 04 record sets the upper 16 bits of the address."""
+        image = self.image([record(0, 0xFFFE, b"\xAA\xBB"), record(4, 0, b"\x00\x01"),
+                            record(0, 0x0000, b"\xCC"), EOF_LINE])
+        self.assertEqual(image.segments(), [(0xFFFE, 0x10001)])
+        self.assertEqual(image.tobinarray(0xFFFE, 3), b"\xAA\xBB\xCC")
+
+    def test_start_records(self):
+        """The 03 and 05 records have the start address of the cpu, they don't have data."""
+        image = self.image([record(3, 0, b"\x00\x00\x01\x00"), record(0, 0, b"\x55"),
+                            record(5, 0, b"\x00\x00\x01\x00"), EOF_LINE])
+        self.assertEqual(image.segments(), [(0, 1)])
+
+    def test_bad_checksum(self):
+        line = record(0, 0, b"\x01\x02")
+        line = line[:-2] + "{:02X}".format((int(line[-2:], 16) + 1) & 0xFF)
+        with self.assertRaises(HexFileError) as context:
+            self.image([record(0, 0x10, b"\x00"), line])
+        self.assertEqual(context.exception.line, 2)
+
+    def test_invalid_extended(self):
+        with self.assertRaises(HexFileError):
+            self.image([record(4, 0, b"\x01")])
+
+    def test_overlap(self):
+        with self.assertRaises(HexFileError) as context:
+            self.image([record(0, 0x10, bytes(16)), record(0, 0x00, bytes(32))])
+        self.assertEqual(context.exception.line, 2)
+
+    def test_unordered(self):
+        """The records that don't overlap can be in any order, the segments are joined."""
+        image = self.image([record(0, 0x20, b"\x03"), record(0, 0x00, b"\x01"), record(0, 0x01, b"\x02")])
+        self.assertEqual(image.segments(), [(0x00, 0x02), (0x20, 0x21)])
+        self.assertEqual(image.tobinarray(0, 3), b"\x01\x02\xFF")
+
+
+class TestHexWriter(unittest.TestCase):
+    """The files written are read back with the same content."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "dump.hex")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        """A region larger than 64 KB has the extended linear address records."""
+        rand = random.Random(0)
+        buffer = bytearray(rand.getrandbits(8) for _ in range(0x10000 + 100))
+        write_hex(self.filename, buffer, start=0x100)
+        image = read_hex(self.filename)
+        self.assertEqual(image.segments(), [(0x100, 0x100 + len(buffer))])
+        self.assertEqual(image.tobinarray(0x100, len(buffer)), buffer)
+
+    def test_skip_blank(self):
+        buffer = bytearray([0xFF]) * 64
+        buffer[40:42] = b"\x01\x02"
+        lines = list(hex_lines(buffer, skip_blank=True))
+        self.assertEqual(len(lines), 2)
+        image = HexImage(parse_records(lines))
+        self.assertEqual(image.segments(), [(32, 48)])
+        self.assertEqual(image.tobinarray(0, 64), buffer)
+
+
+if __name__ == "__main__":
+    unittest.main()
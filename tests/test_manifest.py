@@ -0,0 +1,93 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "arduinobootloader"))
+
+from arduinobootloader import ArduinoBootloader
+from hexreader import read_hex
+from hexwriter import write_hex
+from manifest import ManifestFile, MANIFEST_SUFFIX, load_manifest
+from pageplanner import plan_pages
+from stk500emulator import BootloaderEmulator
+
+
+class TestManifestFile(unittest.TestCase):
+    """The manifests are compiled once, and again only when the content of the image changes."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "firmware.hex")
+        write_hex(self.filename, bytes(range(256)) * 4)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_saved(self):
+        manifests = load_manifest(self.filename, sizes=[128, 256])
+        self.assertTrue(os.path.exists(self.filename + MANIFEST_SUFFIX))
+        with mock.patch("manifest.read_hex", side_effect=AssertionError("the image was parsed")):
+            cached = load_manifest(self.filename, sizes=[128, 256])
+        for size in (128, 256):
+            self.assertEqual(cached[size].image, manifests[size].image)
+            self.assertEqual(cached[size].pages(), manifests[size].pages())
+
+    def test_new_size(self):
+        """A page size that is not in the file is compiled and added to it."""
+        load_manifest(self.filename, sizes=[128])
+        manifests = ManifestFile(self.filename).manifests([128, 256])
+        with mock.patch("manifest.read_hex", side_effect=AssertionError("the image was parsed")):
+            self.assertEqual(load_manifest(self.filename, sizes=[256])[256].image, manifests[256].image)
+
+    def test_image_changed(self):
+        first = load_manifest(self.filename, sizes=[128])[128]
+        write_hex(self.filename, bytes(1024))
+        second = load_manifest(self.filename, sizes=[128])[128]
+        self.assertNotEqual(first.image, second.image)
+
+    def test_corrupted_file(self):
+        """A manifest file that can't be read is compiled again."""
+        manifest = load_manifest(self.filename, sizes=[128])[128]
+        with open(self.filename + MANIFEST_SUFFIX, "w") as file:
+            file.write("{\"version\": ")
+        self.assertEqual(load_manifest(self.filename, sizes=[128])[128].pages(), manifest.pages())
+
+
+class TestManifestVerify(unittest.TestCase):
+    """The board is verified and compared with the digests of the manifest, without the image."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "firmware.hex")
+        self.emulator = BootloaderEmulator("Stk500v2", 0x1E9801, baudrate=None)
+        self.ab = ArduinoBootloader()
+        self.prg = self.ab.select_programmer("Stk500v2")
+        self.assertTrue(self.prg.open(port=self.emulator, speed=115200, reset=False))
+        self.assertTrue(self.prg.cpu_signature())
+        size = self.ab.cpu_page_size
+        buffer = bytearray(address // size for address in range(8 * size))
+        buffer[3 * size:4 * size] = bytes([0xFF]) * size
+        write_hex(self.filename, buffer)
+        self.assertTrue(self.ab.write_pages(plan_pages(read_hex(self.filename), size)))
+        self.manifest = load_manifest(self.filename, sizes=[size])[size]
+
+    def tearDown(self):
+        self.prg.close()
+        self.directory.cleanup()
+
+    def test_verify(self):
+        self.assertTrue(self.ab.verify_manifest(self.manifest))
+        self.assertEqual(self.ab.pages_verified, len(self.manifest))
+
+    def test_changed_pages(self):
+        size = self.ab.cpu_page_size
+        self.emulator.flash[5 * size] ^= 0xFF
+        self.assertEqual(self.ab.changed_pages(self.manifest), [5 * size])
+        self.assertFalse(self.ab.verify_manifest(self.manifest))
+        self.assertEqual(self.ab.mismatch_address, 5 * size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "arduinobootloader"))
+
+from arduinobootloader import ArduinoBootloader
+from hexreader import HexImage
+from pageplanner import plan_pages
+from stk500emulator import BootloaderEmulator
+
+
+class TestSkipBlank(unittest.TestCase):
+    """Only the pages where every byte is 0xFF are skipped, a page with some data is written whole."""
+
+    def setUp(self):
+        self.emulator = BootloaderEmulator("Stk500v1", 0x1E950F, baudrate=None)
+        self.emulator.flash[:] = bytes(len(self.emulator.flash))
+        self.ab = ArduinoBootloader()
+        self.prg = self.ab.select_programmer("Stk500v1")
+        self.assertTrue(self.prg.open(port=self.emulator, speed=115200, reset=False))
+        self.assertTrue(self.prg.cpu_signature())
+        self.size = self.ab.cpu_page_size
+
+    def tearDown(self):
+        self.prg.close()
+
+    def test_partial_page(self):
+        size = self.size
+        buffer = bytearray([0xFF]) * (3 * size)
+        buffer[2 * size - 1] = 0x5A
+        image = HexImage([(0, buffer, 1)])
+
+        pages = list(plan_pages(image, size))
+        self.assertEqual([address for address, page in pages], [size])
+        self.assertEqual(pages[0][1], buffer[size:2 * size])
+
+        self.assertTrue(self.ab.write_pages(pages, verify="after"))
+        self.assertEqual(self.emulator.flash[size:2 * size], buffer[size:2 * size])
+        """The blank pages are not written, so they keep the previous content of the memory."""
+        self.assertEqual(self.emulator.flash[0:size], bytes(size))
+        self.assertEqual(self.emulator.flash[2 * size:3 * size], bytes(size))
+
+    def test_partial_record(self):
+        """A record that only covers a few bytes of a page gets the rest of the page filled with 0xFF."""
+        image = HexImage([(self.size + 4, b"\x01\x02", 1)])
+        pages = list(plan_pages(image, self.size))
+        self.assertEqual(len(pages), 1)
+        self.assertTrue(self.ab.write_pages(pages))
+        expected = bytearray([0xFF]) * self.size
+        expected[4:6] = b"\x01\x02"
+        self.assertEqual(self.emulator.flash[self.size:2 * self.size], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "arduinobootloader"))
+
+from arduinobootloader import ArduinoBootloader
+from stk500emulator import BootloaderEmulator
+
+
+class TestOptibootRead(unittest.TestCase):
+    """The Stk500v1 reads longer than 256 bytes must work with the 8 bits length of Optiboot."""
+
+    def setUp(self):
+        self.emulator = BootloaderEmulator("Stk500v1", 0x1E950F, baudrate=None)
+        self.emulator.flash[:] = bytes(range(256)) * (len(self.emulator.flash) // 256)
+        self.ab = ArduinoBootloader()
+        self.prg = self.ab.select_programmer("Stk500v1")
+        self.assertTrue(self.prg.open(port=self.emulator, speed=115200, reset=False))
+
+    def tearDown(self):
+        self.prg.close()
+
+    def test_default_is_optiboot(self):
+        self.assertTrue(self.emulator.optiboot)
+
+    def test_length_low_byte(self):
+        """The emulator answers the low byte of the length, as Optiboot does."""
+        self.assertTrue(self.ab._run(self.prg._set_address(0, True)))
+        self.emulator.write(bytes([ord('t'), 0x01, 0x04, ord('F'), ord(' ')]))
+        self.assertEqual(len(self.emulator.read(1 + 4 + 1)), 6)
+
+    def test_read_range(self):
+        buffer = self.prg.read_range(0, 4096)
+        self.assertEqual(buffer, self.emulator.flash[:4096])
+
+    def test_read_range_unaligned(self):
+        buffer = self.prg.read_range(100, 1000)
+        self.assertEqual(buffer, self.emulator.flash[100:1100])
+
+
+class TestStk500v1WritePages(unittest.TestCase):
+    """The Stk500v1 writes each page with one round trip, and recovers from a corrupted answer."""
+
+    def setUp(self):
+        self.emulator = BootloaderEmulator("Stk500v1", 0x1E950F, baudrate=None, seed=1)
+        self.ab = ArduinoBootloader()
+        self.ab.enable_stats()
+        self.prg = self.ab.select_programmer("Stk500v1")
+        self.assertTrue(self.prg.open(port=self.emulator, speed=115200, reset=False))
+        self.assertTrue(self.prg.cpu_signature())
+        size = self.ab.cpu_page_size
+        self.pages = [(address, bytearray([address // size]) * size) for address in range(0, 32 * size, size)]
+
+    def tearDown(self):
+        self.prg.close()
+
+    def assertWritten(self):
+        for address, buffer in self.pages:
+            self.assertEqual(self.emulator.flash[address:address + len(buffer)], buffer)
+
+    def test_round_trip_per_page(self):
+        self.assertTrue(self.prg.write_pages(self.pages))
+        self.assertWritten()
+        commands = self.ab.stats.summary()["commands"]
+        self.assertEqual(commands["STK_PROG_PAGE"]["count"], len(self.pages))
+        self.assertNotIn("STK_LOAD_ADDRESS", commands)
+
+    def test_corrupted_answer(self):
+        self.ab.enable_page_retry(retries=20)
+        self.emulator.error_rate = 0.01
+        self.assertTrue(self.prg.write_pages(self.pages))
+        self.emulator.error_rate = 0.0
+        self.assertGreater(self.emulator.errors_injected, 0)
+        self.assertGreater(self.ab.stats.resyncs, 0)
+        self.assertWritten()
+
+
+if __name__ == "__main__":
+    unittest.main()